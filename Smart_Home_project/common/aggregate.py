@@ -0,0 +1,112 @@
+"""
+Aggregate state messages, deal with the compact binary state of a node
+
+Code in this file is responsible for:
+- Packing all the boolean states and the temperature of a node in one message.
+- Decoding such a message on the master in a single pass.
+
+A node publishes its aggregate state, retained, on ``home/aggregate/<node>``
+next to its usual per-device topics. The payload is 8 bytes (``!BHHBh``):
+
+- the layout version;
+- a boot epoch, drawn at random when the node boots;
+- a sequence number, incremented by every message of the node and
+  restarting from 0 on boot;
+- a bitfield, bit ``i`` being the state of the ``i``-th field of the node
+  in ``NODE_FIELDS``;
+- the temperature in tenths of a degree, ``NO_TEMPERATURE`` if none.
+"""
+
+# Standard library imports
+import random
+import struct
+
+
+AGGREGATE_TOPIC_PREFIX = b"home/aggregate/"
+AGGREGATE_FORMAT = "!BHHBh"
+AGGREGATE_SIZE = 8
+AGGREGATE_VERSION = 2
+NO_TEMPERATURE = -32768
+
+# Boolean fields of each node, bit 0 first. Shared by the nodes and the
+# master: fields can only be appended, never reordered.
+NODE_FIELDS = {
+    b"lights": ("soggiorno", "cucina", "camera"),
+    b"climate": ("riscaldamento", "aria_condizionata"),
+}
+
+
+class AggregatePublisher:
+    """
+    Publishes the aggregate state of a node.
+    """
+    def __init__(self, node):
+        """
+        Initializes the AggregatePublisher.
+
+        :param node: The node name, a key of ``NODE_FIELDS``.
+        :type node: bytes
+        """
+        self.topic = AGGREGATE_TOPIC_PREFIX + node
+        self.fields = NODE_FIELDS[node]
+        # The sequence numbers restart on boot, the epoch tells boots apart
+        self.epoch = random.getrandbits(16)
+        self._seq = 0
+
+    def publish(self, client, states, temperature=None):
+        """
+        Publishes the aggregate state (retained, QoS 0).
+
+        :param client: The MQTT client.
+        :type client: umqtt.aio.MQTTClient
+        :param states: The boolean states by field name; missing fields are off.
+        :type states: dict
+        :param temperature: The temperature in degrees Celsius, if any.
+        :type temperature: float, optional
+        """
+        bits = 0
+        for i, name in enumerate(self.fields):
+            if states.get(name):
+                bits |= 1 << i
+        if temperature is None:
+            temp = NO_TEMPERATURE
+        else:
+            temp = max(-32767, min(32767, int(round(temperature * 10))))
+        msg = struct.pack(AGGREGATE_FORMAT, AGGREGATE_VERSION, self.epoch, self._seq, bits, temp)
+        self._seq = (self._seq + 1) & 0xFFFF
+        client.publish(self.topic, msg, retain=True)
+
+
+def decode(msg):
+    """
+    Decodes an aggregate state message.
+
+    :param msg: The message payload.
+    :type msg: bytes or memoryview
+    :return: The boot epoch, the sequence number, the bitfield and the
+        temperature (None if absent).
+    :rtype: tuple
+    :raises ValueError: If the payload is not a known aggregate layout.
+    """
+    if len(msg) != AGGREGATE_SIZE or msg[0] != AGGREGATE_VERSION:
+        raise ValueError("unknown aggregate state layout")
+    _, epoch, seq, bits, temp = struct.unpack(AGGREGATE_FORMAT, msg)
+    return epoch, seq, bits, None if temp == NO_TEMPERATURE else temp / 10
+
+
+def is_newer(epoch, seq, last):
+    """
+    Checks whether an aggregate state follows the last one seen from the
+    node. A new epoch is always accepted, as the node rebooted and restarted
+    its sequence numbers, whatever the first one that got through; within
+    an epoch the sequence number must follow, modulo 65536.
+
+    :param epoch: The received boot epoch.
+    :type epoch: int
+    :param seq: The received sequence number.
+    :type seq: int
+    :param last: The ``(epoch, seq)`` of the last aggregate seen, or None.
+    :type last: tuple
+    :rtype: bool
+    """
+    return last is None or epoch != last[0] or 0 < (seq - last[1]) & 0xFFFF < 0x8000
@@ -0,0 +1,579 @@
+"""
+Broker and LocalClient classes, a small MQTT broker embedded in the master
+
+Code in this file is responsible for:
+- Accepting the MQTT 3.1.1 connections of the nodes on the local network.
+- Routing published messages to the subscribed clients with QoS 0 and 1,
+  wildcards included.
+- Keeping the retained messages, the persistent sessions and the wills.
+- Delivering the messages of the master itself in-process, without going
+  through the network.
+
+The module only needs asyncio, so it also runs under CPython (see
+``utils/broker_sim.py``).
+"""
+
+# Standard library imports
+import struct
+
+try:
+    import uasyncio as asyncio
+except ImportError:  # CPython
+    import asyncio
+
+
+def topic_matches(topic_filter, topic):
+    """
+    Checks whether a topic matches a topic filter.
+
+    :param topic_filter: The filter, with the ``+`` and ``#`` wildcards.
+    :type topic_filter: bytes
+    :param topic: The topic of a message.
+    :type topic: bytes
+    :rtype: bool
+    """
+    # Wildcards don't match the first level of $-topics (e.g. $SYS)
+    if topic[:1] == b"$" and topic_filter[:1] in (b"+", b"#"):
+        return False
+    levels = topic.split(b"/")
+    filter_levels = topic_filter.split(b"/")
+    for i, level in enumerate(filter_levels):
+        if level == b"#":
+            return True
+        if i >= len(levels) or (level != b"+" and level != levels[i]):
+            return False
+    return len(filter_levels) == len(levels)
+
+
+def _valid_filter(topic_filter):
+    levels = topic_filter.split(b"/")
+    for i, level in enumerate(levels):
+        if (b"+" in level or b"#" in level) and len(level) > 1:
+            return False
+        if level == b"#" and i < len(levels) - 1:
+            return False
+    return bool(topic_filter)
+
+
+def _packet(op, *parts):
+    """Builds a packet from its type byte and the parts of its body."""
+    size = 0
+    for part in parts:
+        size += len(part)
+    head = bytearray((op,))
+    while True:
+        b = size & 0x7F
+        size >>= 7
+        head.append(b | 0x80 if size else b)
+        if not size:
+            break
+    return bytes(head) + b"".join(parts)
+
+
+def _field(data, i):
+    """Reads a length-prefixed field at i; returns it and the index after it."""
+    n = data[i] << 8 | data[i + 1]
+    end = i + 2 + n
+    if end > len(data):
+        raise ValueError("Truncated field")
+    return bytes(data[i + 2 : end]), end
+
+
+def _str(s):
+    return struct.pack("!H", len(s)) + s
+
+
+async def _read_packet(reader, max_size):
+    op = (await reader.readexactly(1))[0]
+    size = 0
+    shift = 0
+    while True:
+        b = (await reader.readexactly(1))[0]
+        size |= (b & 0x7F) << shift
+        if not b & 0x80:
+            break
+        shift += 7
+        if shift > 21:
+            raise ValueError("Malformed packet length")
+    if size > max_size:
+        raise ValueError("Packet too large")
+    return op, (await reader.readexactly(size)) if size else b""
+
+
+class _Session:
+    """
+    State of one client ID, kept between its connections when it asks for
+    a persistent session: its subscriptions, and the messages waiting to be
+    sent or acknowledged.
+    """
+    def __init__(self, broker, client_id):
+        self.broker = broker
+        self.client_id = client_id
+        self.clean = True
+        # Topic filter -> granted QoS
+        self.subscriptions = {}
+        # Messages to send, as (topic, msg, qos, retain), oldest first
+        self.queue = []
+        # Sent QoS 1 messages awaiting their PUBACK: pid -> message
+        self.inflight = {}
+        # Packet ids of received QoS 2 messages awaiting their PUBREL
+        self.qos2_rx = []
+        self.will = None
+        self.keepalive = 0
+        self.writer = None
+        # Task running send_loop() for the current connection
+        self.sender = None
+        self._pid = 0
+        self._event = asyncio.Event()
+
+    @property
+    def online(self):
+        return self.writer is not None
+
+    def deliver(self, topic, msg, qos, retain):
+        """Queues a message for the client; QoS 0 ones only while it is connected."""
+        if not self.online and not qos:
+            return
+        if len(self.queue) >= self.broker.max_queue:
+            index = 0
+            for i, message in enumerate(self.queue):
+                if not message[2]:
+                    index = i
+                    break
+            dropped = self.queue.pop(index)
+            print(f"Broker: Queue of '{self.client_id.decode()}' full, dropped message on {dropped[0]}.")
+        self.queue.append((topic, msg, qos, retain))
+        self._event.set()
+
+    def subscribe_many(self, filters):
+        """
+        Adds subscriptions and queues the retained messages they match, once
+        each. Returns the granted QoS of each filter, 0x80 for a rejected one.
+        """
+        granted = bytearray()
+        for topic_filter, qos in filters:
+            if (not _valid_filter(topic_filter) or qos > 2 or (topic_filter not in self.subscriptions
+                    and len(self.subscriptions) >= self.broker.max_subscriptions)):
+                granted.append(0x80)
+                continue
+            qos = min(qos, 1)
+            self.subscriptions[topic_filter] = qos
+            granted.append(qos)
+        for topic, (msg, retained_qos) in self.broker.retained.items():
+            best = -1
+            for (topic_filter, _), qos in zip(filters, granted):
+                if best < qos < 0x80 and topic_matches(topic_filter, topic):
+                    best = qos
+            if best >= 0:
+                self.deliver(topic, msg, min(best, retained_qos), True)
+        return bytes(granted)
+
+    def acked(self, pid):
+        if self.inflight.pop(pid, None) is not None:
+            self._event.set()
+
+    async def write(self, packet):
+        self.writer.write(packet)
+        await self.writer.drain()
+
+    async def send_loop(self):
+        """Writes the queued messages out while the client is connected."""
+        # Whatever is still in flight was sent on a previous connection
+        for pid, (topic, msg, qos, retain) in list(self.inflight.items()):
+            await self._send_publish(topic, msg, qos, retain, pid, True)
+        self._event.set()
+        while True:
+            await self._event.wait()
+            self._event.clear()
+            while self.queue and len(self.inflight) < self.broker.max_inflight:
+                message = self.queue.pop(0)
+                pid = 0
+                if message[2]:
+                    pid = self._next_pid()
+                    self.inflight[pid] = message
+                await self._send_publish(*message, pid)
+
+    def _next_pid(self):
+        self._pid = self._pid % 65535 + 1
+        while self._pid in self.inflight:
+            self._pid = self._pid % 65535 + 1
+        return self._pid
+
+    async def _send_publish(self, topic, msg, qos, retain, pid=0, dup=False):
+        op = 0x30 | dup << 3 | qos << 1 | retain
+        if qos:
+            await self.write(_packet(op, _str(topic), struct.pack("!H", pid), msg))
+        else:
+            await self.write(_packet(op, _str(topic), msg))
+
+
+class LocalClient(_Session):
+    """
+    Client of the master itself on the embedded broker.
+
+    It offers the calls of ``umqtt.aio.MQTTClient`` used by the master
+    (``publish()``, ``subscribe_many()``, ``run()``, ``reconnect()``), so it
+    can replace it, but its messages never touch the network: a publish is
+    routed directly to the subscribers, and the messages for the master are
+    passed to its callback by ``run()``.
+    """
+    def __init__(self, broker, client_id, callback):
+        """
+        Initializes the LocalClient. Use ``Broker.local_client()`` instead.
+
+        :param broker: The broker the client is attached to.
+        :type broker: Broker
+        :param client_id: The client ID of the master.
+        :type client_id: bytes
+        :param callback: The function called with the topic and payload of
+            every message for the master.
+        :type callback: function
+        """
+        super().__init__(broker, client_id)
+        self.clean = False
+        self.cb = callback
+        self.stats = None
+
+    @property
+    def online(self):
+        return True
+
+    def set_callback(self, f):
+        """
+        Sets the function called with every message for the master.
+
+        :param f: The callback.
+        :type f: function
+        """
+        self.cb = f
+
+    def publish(self, topic, msg, retain=False, qos=0):
+        """
+        Publishes a message to the subscribers of the broker.
+
+        :param topic: The topic to publish to.
+        :type topic: bytes
+        :param msg: The message payload.
+        :type msg: bytes
+        :param retain: Whether the broker keeps the message for new subscribers.
+        :type retain: bool, optional
+        :param qos: The QoS of the message, at most 1 is used for delivery.
+        :type qos: int, optional
+        """
+        if isinstance(topic, str):
+            topic = topic.encode()
+        if isinstance(msg, str):
+            msg = msg.encode()
+        self.broker.publish(topic, msg, min(qos, 1), retain)
+
+    def subscribe(self, topic, qos=0):
+        """Subscribes to one topic filter, see ``subscribe_many()``."""
+        return self.subscribe_many(((topic, qos),))
+
+    def subscribe_many(self, filters):
+        """
+        Subscribes to several topic filters.
+
+        :param filters: ``(topic_filter, qos)`` tuples.
+        :type filters: list
+        :return: The QoS granted for each filter.
+        :rtype: bytes
+        """
+        filters = [(f.encode() if isinstance(f, str) else f, qos) for f, qos in filters]
+        return super().subscribe_many(filters)
+
+    async def reconnect(self, timeout=None):
+        """Does nothing: the local client cannot lose its connection."""
+        return True
+
+    async def run(self):
+        """Passes the messages for the master to its callback. Never returns."""
+        while True:
+            await self._event.wait()
+            self._event.clear()
+            while self.queue:
+                topic, msg = self.queue.pop(0)[:2]
+                try:
+                    self.cb(topic, msg)
+                except Exception as e:
+                    print(f"Broker: Error in local callback for {topic}: {e}")
+
+
+class Broker:
+    """
+    MQTT 3.1.1 broker for the nodes of the house, run by the master.
+
+    Messages are delivered with QoS 0 or 1: a QoS 2 publish is accepted
+    (exactly once) and forwarded with QoS 1, and subscriptions are granted
+    at most QoS 1. Retained messages, wildcard subscriptions, persistent
+    sessions and wills are supported; authentication is not, the broker is
+    meant for the local network only.
+
+    Memory is bounded per client: incoming packets are limited to
+    ``max_packet`` bytes, a client holds at most ``max_subscriptions``
+    filters and ``max_queue`` queued plus ``max_inflight`` unacknowledged
+    messages (the oldest QoS 0 message is dropped first when its queue is
+    full), and at most ``max_clients`` clients are connected at once.
+    """
+    def __init__(self, port=1883, host="0.0.0.0", max_clients=8, max_packet=1024,
+                 max_subscriptions=16, max_queue=32, max_inflight=4, max_retained=64):
+        """
+        Initializes the Broker.
+
+        :param port: The TCP port to listen on.
+        :type port: int, optional
+        :param host: The address to listen on.
+        :type host: str, optional
+        :param max_clients: Network clients connected at most.
+        :type max_clients: int, optional
+        :param max_packet: Largest packet accepted, in bytes.
+        :type max_packet: int, optional
+        :param max_subscriptions: Topic filters per client.
+        :type max_subscriptions: int, optional
+        :param max_queue: Messages queued per client.
+        :type max_queue: int, optional
+        :param max_inflight: QoS 1 messages awaiting a PUBACK per client.
+        :type max_inflight: int, optional
+        :param max_retained: Retained messages kept at most.
+        :type max_retained: int, optional
+        """
+        self.port = port
+        self.host = host
+        self.max_clients = max_clients
+        self.max_packet = max_packet
+        self.max_subscriptions = max_subscriptions
+        self.max_queue = max_queue
+        self.max_inflight = max_inflight
+        self.max_retained = max_retained
+        # Topic -> (msg, qos)
+        self.retained = {}
+        # Client ID -> session, connected or persistent
+        self._sessions = {}
+        self._connections = 0
+        self._auto_id = 0
+
+    def local_client(self, client_id, callback):
+        """
+        Creates the in-process client of the master.
+
+        :param client_id: The client ID of the master.
+        :type client_id: str
+        :param callback: The function called with every message for the master.
+        :type callback: function
+        :return: The client, to use in place of the one of ``connect_mqtt()``.
+        :rtype: LocalClient
+        """
+        if isinstance(client_id, str):
+            client_id = client_id.encode()
+        client = LocalClient(self, client_id, callback)
+        self._sessions[client_id] = client
+        return client
+
+    def publish(self, topic, msg, qos=0, retain=False):
+        """
+        Routes a message to every client subscribed to its topic.
+
+        Each client gets one copy, with the highest QoS of its matching
+        subscriptions, capped by ``qos``.
+
+        :param topic: The topic of the message.
+        :type topic: bytes
+        :param msg: The message payload.
+        :type msg: bytes
+        :param qos: The QoS of the message.
+        :type qos: int, optional
+        :param retain: Whether to keep the message for new subscribers; an
+            empty retained message deletes the one kept.
+        :type retain: bool, optional
+        """
+        if retain:
+            if not msg:
+                self.retained.pop(topic, None)
+            elif topic in self.retained or len(self.retained) < self.max_retained:
+                self.retained[topic] = (msg, qos)
+            else:
+                print(f"Broker: Too many retained messages, not keeping {topic}.")
+        for session in self._sessions.values():
+            best = -1
+            for topic_filter, granted in session.subscriptions.items():
+                if granted > best and topic_matches(topic_filter, topic):
+                    best = granted
+            if best >= 0:
+                session.deliver(topic, msg, min(qos, best), False)
+
+    async def start(self):
+        """
+        Starts listening for clients.
+
+        :return: The asyncio server.
+        """
+        server = await asyncio.start_server(self._serve, self.host, self.port)
+        print(f"Broker: Listening on port {self.port}.")
+        return server
+
+    async def run(self):
+        """Accepts the connections of the clients. Never returns."""
+        server = await self.start()
+        try:
+            while True:
+                await asyncio.sleep(3600)
+        finally:
+            server.close()
+
+    async def _serve(self, reader, writer):
+        session = None
+        sender = None
+        try:
+            session = await self._connect(reader, writer)
+            if session is None:
+                return
+            sender = session.sender = asyncio.create_task(session.send_loop())
+            await self._serve_session(session, reader)
+            session.will = None  # Clean DISCONNECT
+        except (OSError, ValueError, EOFError, IndexError, asyncio.TimeoutError) as e:
+            if session is not None:
+                print(f"Broker: Client '{session.client_id.decode()}' dropped: {e!r}")
+        finally:
+            if sender is not None:
+                sender.cancel()
+            if session is not None and session.writer is writer:
+                self._disconnect(session)
+            try:
+                writer.close()
+                await writer.wait_closed()
+            except Exception:
+                pass
+
+    def _disconnect(self, session):
+        session.writer = None
+        self._connections -= 1
+        if session.clean and self._sessions.get(session.client_id) is session:
+            del self._sessions[session.client_id]
+        if session.will is not None:
+            topic, msg, qos, retain = session.will
+            session.will = None
+            self.publish(topic, msg, qos, retain)
+        print(f"Broker: Client '{session.client_id.decode()}' disconnected.")
+
+    async def _connect(self, reader, writer):
+        op, data = await asyncio.wait_for(_read_packet(reader, self.max_packet), 10)
+        if op != 0x10:
+            raise ValueError("Expected CONNECT")
+        name, i = _field(data, 0)
+        if name != b"MQTT" or data[i] != 4:
+            writer.write(b"\x20\x02\x00\x01")  # Unacceptable protocol version
+            return None
+        flags = data[i + 1]
+        keepalive = data[i + 2] << 8 | data[i + 3]
+        client_id, i = _field(data, i + 4)
+        clean = bool(flags & 0x02)
+        will = None
+        if flags & 0x04:
+            will_topic, i = _field(data, i)
+            will_msg, i = _field(data, i)
+            will = (will_topic, will_msg, min(flags >> 3 & 3, 1), bool(flags & 0x20))
+        if not client_id:
+            if not clean:
+                writer.write(b"\x20\x02\x00\x02")  # Identifier rejected
+                return None
+            self._auto_id += 1
+            client_id = ("auto-%d" % self._auto_id).encode()
+        session = self._sessions.get(client_id)
+        if session is not None and session.online:
+            if isinstance(session, LocalClient):
+                writer.write(b"\x20\x02\x00\x02")
+                return None
+            # The client reconnected before its old connection timed out:
+            # its send loop must not write to the new one
+            old = session.writer
+            if session.sender is not None:
+                session.sender.cancel()
+                session.sender = None
+            self._disconnect(session)
+            old.close()
+            # A clean session was discarded with the old connection
+            session = self._sessions.get(client_id)
+        if self._connections >= self.max_clients:
+            writer.write(b"\x20\x02\x00\x03")  # Server unavailable
+            return None
+        present = session is not None and not clean
+        if not present:
+            session = _Session(self, client_id)
+            self._sessions[client_id] = session
+        session.clean = clean
+        session.will = will
+        session.keepalive = keepalive
+        session.writer = writer
+        self._connections += 1
+        await session.write(bytes((0x20, 2, present, 0)))
+        print(f"Broker: Client '{client_id.decode()}' connected{' (session resumed)' if present else ''}.")
+        return session
+
+    async def _serve_session(self, session, reader):
+        # A client silent for one and a half keepalive periods is dead
+        timeout = session.keepalive * 1.5 if session.keepalive else None
+        while True:
+            if timeout:
+                op, data = await asyncio.wait_for(_read_packet(reader, self.max_packet), timeout)
+            else:
+                op, data = await _read_packet(reader, self.max_packet)
+            kind = op & 0xF0
+            if kind == 0x30:  # PUBLISH
+                await self._on_publish(session, op, data)
+            elif kind == 0x40:  # PUBACK
+                session.acked(data[0] << 8 | data[1])
+            elif op == 0x62:  # PUBREL
+                pid = data[0] << 8 | data[1]
+                if pid in session.qos2_rx:
+                    session.qos2_rx.remove(pid)
+                await session.write(_packet(0x70, data[:2]))  # PUBCOMP
+            elif op == 0x82:  # SUBSCRIBE
+                await self._on_subscribe(session, data)
+            elif op == 0xA2:  # UNSUBSCRIBE
+                i = 2
+                while i < len(data):
+                    topic_filter, i = _field(data, i)
+                    session.subscriptions.pop(topic_filter, None)
+                await session.write(_packet(0xB0, data[:2]))  # UNSUBACK
+            elif op == 0xC0:  # PINGREQ
+                await session.write(b"\xd0\x00")
+            elif op == 0xE0:  # DISCONNECT
+                return
+            else:
+                raise ValueError(f"Unexpected packet 0x{op:02x}")
+
+    async def _on_publish(self, session, op, data):
+        qos = op >> 1 & 3
+        topic, i = _field(data, 0)
+        if qos == 3 or not topic or b"+" in topic or b"#" in topic:
+            raise ValueError("Invalid PUBLISH")
+        pid = None
+        if qos:
+            pid = data[i : i + 2]
+            i += 2
+        msg = bytes(data[i:])
+        if qos == 2:
+            # Route once, a retransmission before the PUBREL is only
+            # acknowledged again
+            n = pid[0] << 8 | pid[1]
+            if n not in session.qos2_rx:
+                if len(session.qos2_rx) >= 16:
+                    session.qos2_rx.pop(0)
+                session.qos2_rx.append(n)
+                self.publish(topic, msg, 1, bool(op & 1))
+            await session.write(_packet(0x50, pid))  # PUBREC
+            return
+        self.publish(topic, msg, qos, bool(op & 1))
+        if qos:
+            await session.write(_packet(0x40, pid))  # PUBACK
+
+    async def _on_subscribe(self, session, data):
+        filters = []
+        i = 2
+        while i < len(data):
+            topic_filter, i = _field(data, i)
+            filters.append((topic_filter, data[i]))
+            i += 1
+        # The retained messages queued by subscribe_many() go out after the
+        # SUBACK
+        await session.write(_packet(0x90, data[:2], session.subscribe_many(filters)))
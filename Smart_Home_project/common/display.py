@@ -44,6 +44,17 @@ class DisplayManager:
     PAGE_AUTO_SETTINGS = "auto_settings"
     PAGE_TAPPARELLE = "tapparelle"
     PAGE_ALLARME = "allarme"
+
+    # Devices whose node is offline are drawn in grey
+    OFFLINE_COLOR = color565(70, 70, 70)
+
+    # States drawn on each page, next to the temperature in the header
+    PAGE_KEYS = {
+        PAGE_LUCI: ("soggiorno", "cucina", "camera"),
+        PAGE_RISCALDAMENTO: ("desired_temperature", "auto_mode", "riscaldamento", "aria_condizionata"),
+        PAGE_TAPPARELLE: ("tapparella_state",),
+        PAGE_ALLARME: ("allarme",),
+    }
     
     def __init__(self, state_manager, device_manager, standby_timeout=60):
         """
@@ -70,6 +81,10 @@ class DisplayManager:
         self.tapparella_feedback_state = None
         self.tapparella_feedback_time = 0
 
+        # Redraw when a state shown on the current page changes, whoever
+        # changed it (touch, web server or MQTT)
+        state_manager.subscribe(("*",), self._on_state_change)
+
     def _init_hardware(self):
         """Initializes the display and touch controller hardware."""
         # Display SPI
@@ -107,6 +122,21 @@ class DisplayManager:
         self.backlight.value(1 if on else 0)
 
 
+    def _on_state_change(self, changes):
+        """
+        Redraws the page if it shows one of the changed states.
+
+        :param changes: The changed states, as ``{key: (old, new)}``.
+        :type changes: dict
+        """
+        if "current_temperature" in changes:
+            self.draw_page()
+            return
+        for key in self.PAGE_KEYS.get(self.current_page, ()):
+            if key in changes:
+                self.draw_page()
+                return
+
     def draw_page(self):
         """Clears the screen and draws the current page."""
         if self.standby:
@@ -150,9 +180,12 @@ class DisplayManager:
         for label, device_id, y in lights:
             state = self.state_manager.get_state(device_id, False)
             color = color565(0, 200, 0) if state else color565(200, 0, 0)
+            status = "ON" if state else "OFF"
+            if not self.device_manager.is_device_online(device_id):
+                color = self.OFFLINE_COLOR
+                status = "OFFLINE"
             self.display.fill_rect(20, y, 200, 40, color)
             self.display.rect(20, y, 200, 40, color565(255, 255, 255))
-            status = "ON" if state else "OFF"
             self.display.text(font, f"{label}: {status}", 30, y + 15, color565(255, 255, 255))
 
 
@@ -168,8 +201,11 @@ class DisplayManager:
         temp = self.state_manager.get_state('current_temperature')
         desired = self.state_manager.get_state('desired_temperature', 22.0)
         auto_mode = self.state_manager.get_state('auto_mode', False)
+        online = self.device_manager.is_device_online('riscaldamento')
         
-        if temp is not None:
+        if not online:
+            self.display.text(font, "Temp: OFFLINE", 20, 50, color565(150, 150, 150))
+        elif temp is not None:
             self.display.text(font, f"Temp: {temp:.1f}C", 20, 50, color565(255, 255, 255))
         self.display.text(font, f"Target: {desired:.1f}C", 20, 80, color565(255, 255, 255))
         
@@ -185,6 +221,8 @@ class DisplayManager:
             
             risc_color = color565(200, 100, 0) if risc_state else color565(100, 100, 100)
             aria_color = color565(0, 100, 200) if aria_state else color565(100, 100, 100)
+            if not online:
+                risc_color = aria_color = self.OFFLINE_COLOR
             
             self.display.fill_rect(20, 150, 90, 30, risc_color)
             self.display.text(font, "RISC", 35, 160, color565(255, 255, 255))
@@ -210,6 +248,8 @@ class DisplayManager:
         
         # Shutter state
         shutter_state = self.state_manager.get_state('tapparella_state', 'unknown')
+        if not self.device_manager.is_device_online('tapparella'):
+            shutter_state = 'offline'
         self.display.text(font, f"Stato: {shutter_state}", 20, 50, color565(255, 255, 255))
         
         # Control buttons
@@ -232,6 +272,9 @@ class DisplayManager:
         alarm_state = self.state_manager.get_state('allarme', False)
         state_color = color565(200, 0, 0) if alarm_state else color565(0, 200, 0)
         state_text = "ATTIVO" if alarm_state else "DISATTIVO"
+        if not self.device_manager.is_device_online('allarme'):
+            state_color = self.OFFLINE_COLOR
+            state_text = "OFFLINE"
         
         self.display.fill_rect(20, 80, 200, 50, state_color)
         self.display.text(font, f"Stato: {state_text}", 30, 100, color565(255, 255, 255))
@@ -294,7 +337,6 @@ class DisplayManager:
             if 20 <= x <= 220 and button_y <= y <= button_y + 40:
                 current_state = self.state_manager.get_state(device_id, False)
                 self.device_manager.set_device_state(device_id, not current_state)
-                self.draw_page()
                 break
 
 
@@ -310,8 +352,6 @@ class DisplayManager:
         if 20 <= x <= 220 and 110 <= y <= 140:
             current_auto = self.state_manager.get_state('auto_mode', False)
             self.state_manager.set_state('auto_mode', not current_auto)
-            self.device_manager.evaluate_auto_logic()
-            self.draw_page()
             return
             
         auto_mode = self.state_manager.get_state('auto_mode', False)
@@ -322,14 +362,12 @@ class DisplayManager:
             if 20 <= x <= 110 and 150 <= y <= 180:
                 current_state = self.state_manager.get_state('riscaldamento', False)
                 self.device_manager.set_device_state('riscaldamento', not current_state)
-                self.draw_page()
                 return
                 
             # AC button
             if 120 <= x <= 210 and 150 <= y <= 180:
                 current_state = self.state_manager.get_state('aria_condizionata', False)
                 self.device_manager.set_device_state('aria_condizionata', not current_state)
-                self.draw_page()
                 return
         
         # Temperature adjustment buttons
@@ -337,14 +375,10 @@ class DisplayManager:
             current_temp = self.state_manager.get_state('desired_temperature', 22.0)
             new_temp = min(current_temp + 0.5, 30.0)
             self.state_manager.set_state('desired_temperature', new_temp)
-            self.device_manager.evaluate_auto_logic()
-            self.draw_page()
         elif 70 <= x <= 110 and 200 <= y <= 240:  # - button
             current_temp = self.state_manager.get_state('desired_temperature', 22.0)
             new_temp = max(current_temp - 0.5, 16.0)
             self.state_manager.set_state('desired_temperature', new_temp)
-            self.device_manager.evaluate_auto_logic()
-            self.draw_page()
 
 
     def _handle_tapparelle_touch(self, x, y):
@@ -358,11 +392,9 @@ class DisplayManager:
         # Up button
         if 20 <= x <= 100 and 100 <= y <= 150:
             self.device_manager.pubblish_shutter_command("up")
-            self.draw_page()
         # Down button
         elif 120 <= x <= 200 and 100 <= y <= 150:
             self.device_manager.pubblish_shutter_command("down")
-            self.draw_page()
 
 
     def _handle_allarme_touch(self, x, y):
@@ -377,7 +409,6 @@ class DisplayManager:
         if 20 <= x <= 220 and 150 <= y <= 190:
             current_state = self.state_manager.get_state('allarme', False)
             self.device_manager.set_device_state('allarme', not current_state)
-            self.draw_page()
 
 
     async def standby_task(self):
@@ -0,0 +1,184 @@
+"""
+TimeSeries and StateHistory classes, deal with the recent history of the states
+
+Code in this file is responsible for:
+- Keeping timestamped samples in fixed-size ring buffers backed by arrays,
+  without one object per sample.
+- Recording the temperature and the on/off transitions of the devices of
+  the master, as they change.
+- Answering time range queries without copying the samples.
+"""
+
+# Standard library imports
+import time
+from array import array
+
+
+class TimeSeries:
+    """
+    Ring buffer of ``(timestamp, value)`` samples, oldest first.
+
+    Timestamps (``time.time()`` seconds) and values are kept in two arrays
+    allocated once, so appending never allocates and the RAM used doesn't
+    grow with the history: once full, each sample replaces the oldest one.
+    Timestamps never decrease, a clock set back is clamped to the last
+    sample, so a time range is found by bisection.
+    """
+    def __init__(self, size, typecode="h"):
+        """
+        Initializes the TimeSeries.
+
+        :param size: The number of samples kept.
+        :type size: int
+        :param typecode: The ``array`` typecode of the values.
+        :type typecode: str
+        """
+        self._times = array("L", [0] * size)
+        self._values = array(typecode, [0] * size)
+        self._start = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def append(self, t, value):
+        """
+        Appends a sample, dropping the oldest one if the buffer is full.
+
+        :param t: The timestamp in seconds.
+        :type t: int
+        :param value: The value, fitting the typecode.
+        :type value: int
+        """
+        size = len(self._times)
+        if self._count:
+            t = max(t, self._times[(self._start + self._count - 1) % size])
+        full = self._count == size
+        i = (self._start + self._count) % size
+        self._times[i] = t
+        self._values[i] = value
+        if full:
+            self._start = (self._start + 1) % size
+        else:
+            self._count += 1
+
+    def _bisect(self, t):
+        """Position, oldest first, of the first sample not older than t."""
+        size = len(self._times)
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._times[(self._start + mid) % size] < t:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def range(self, start=None, end=None):
+        """
+        Iterates over the samples with ``start <= timestamp < end``.
+
+        The samples are read from the buffer as they are iterated, so
+        appending meanwhile may skip or repeat some.
+
+        :param start: The first timestamp, from the oldest sample if None.
+        :type start: int, optional
+        :param end: The timestamp after the last one, to the newest sample if None.
+        :type end: int, optional
+        :return: A generator of ``(timestamp, value)`` tuples.
+        """
+        size = len(self._times)
+        k = 0 if start is None else self._bisect(start)
+        while k < self._count:
+            i = (self._start + k) % size
+            if end is not None and self._times[i] >= end:
+                return
+            yield self._times[i], self._values[i]
+            k += 1
+
+    def latest(self):
+        """
+        Gets the newest sample.
+
+        :return: The ``(timestamp, value)`` tuple, None if there is none.
+        :rtype: tuple
+        """
+        if not self._count:
+            return None
+        i = (self._start + self._count - 1) % len(self._times)
+        return self._times[i], self._values[i]
+
+
+class StateHistory:
+    """
+    Records the temperature and the device transitions of a StateManager.
+
+    The temperature is kept in tenths of a degree. Transitions are kept in
+    a single series shared by all devices, each value being the index of
+    the device in ``devices`` shifted left by one, or-ed with the new state.
+    Changes are observed through :meth:`StateManager.subscribe`, so a
+    device switched on and off again within one event loop tick leaves no
+    trace.
+    """
+    def __init__(self, state_manager, devices, temperature_size=256, transition_size=128):
+        """
+        Initializes the StateHistory and starts recording.
+
+        :param state_manager: An instance of StateManager.
+        :type state_manager: StateManager
+        :param devices: The names of the devices whose transitions are recorded.
+        :type devices: tuple
+        :param temperature_size: The number of temperature samples kept.
+        :type temperature_size: int
+        :param transition_size: The number of transitions kept, all devices together.
+        :type transition_size: int
+        """
+        self.devices = tuple(devices)
+        self.temperature = TimeSeries(temperature_size, "h")
+        self.transitions = TimeSeries(transition_size, "B")
+        state_manager.subscribe(("current_temperature",) + self.devices, self._on_change)
+
+    def _on_change(self, changes):
+        """
+        Appends the changed states to their series.
+
+        :param changes: The changed states, as ``{key: (old, new)}``.
+        :type changes: dict
+        """
+        now = int(time.time())
+        for key, (old, new) in changes.items():
+            if key == "current_temperature":
+                if new is not None:
+                    self.temperature.append(now, max(-32767, min(32767, int(round(new * 10)))))
+            else:
+                self.transitions.append(now, self.devices.index(key) << 1 | bool(new))
+
+    def temperatures(self, start=None, end=None):
+        """
+        Iterates over the temperature samples of a time range.
+
+        :param start: The first timestamp, from the oldest sample if None.
+        :type start: int, optional
+        :param end: The timestamp after the last one, to the newest sample if None.
+        :type end: int, optional
+        :return: A generator of ``(timestamp, degrees)`` tuples.
+        """
+        for t, value in self.temperature.range(start, end):
+            yield t, value / 10
+
+    def device_transitions(self, name=None, start=None, end=None):
+        """
+        Iterates over the on/off transitions of a time range.
+
+        :param name: The device, all of them if None.
+        :type name: str, optional
+        :param start: The first timestamp, from the oldest transition if None.
+        :type start: int, optional
+        :param end: The timestamp after the last one, to the newest transition if None.
+        :type end: int, optional
+        :return: A generator of ``(timestamp, device, on)`` tuples.
+        """
+        index = None if name is None else self.devices.index(name)
+        for t, value in self.transitions.range(start, end):
+            if index is None or value >> 1 == index:
+                yield t, self.devices[value >> 1], bool(value & 1)
@@ -16,6 +16,8 @@ STYLE_CSS = """
     .btn-on, .on { background: #00b894; } /* Green */
     .btn-off, .off { background: #d63031; } /* Red */
     .btn-action { background: #0984e3; }
+    .card.offline { opacity: 0.5; filter: grayscale(1); }
+    .card.offline h3::after { content: " (offline)"; }
     hr { margin: 15px 0; border: none; border-top: 1px solid #eee; }
 </style>
 """
@@ -46,7 +48,7 @@ MAIN_TEMPLATE = """
 
 # HTML template for a single device card (e.g., a light).
 DEVICE_CARD_TEMPLATE = """
-<div class="card">
+<div class="card {{CARD_CLASS}}">
     <h3>{{DEVICE_NAME}}</h3>
     <div class="status-group">
         <p>Stato: <span class="{{STATUS_CLASS}}">{{STATUS_TEXT}}</span></p>
@@ -60,7 +62,7 @@ DEVICE_CARD_TEMPLATE = """
 
 # Specific card for the climate control system.
 CLIMATE_CARD_TEMPLATE = """
-<div class="card">
+<div class="card {{CARD_CLASS}}">
     <h3>Clima</h3>
     <div class="status-group">
         <p>Temperatura Attuale: <span class="status">{{TEMP}} °C</span></p>
@@ -77,7 +79,7 @@ CLIMATE_CARD_TEMPLATE = """
 
 # Specific card for the shutters.
 SHUTTERS_CARD_TEMPLATE = """
-<div class="card">
+<div class="card {{CARD_CLASS}}">
     <h3>Tapparelle</h3>
     <div class="status-group">
         <p>Stato: <span>{{SHUTTER_STATE}}</span></p>
@@ -91,7 +93,7 @@ SHUTTERS_CARD_TEMPLATE = """
 
 # Specific card for the alarm.
 ALARM_CARD_TEMPLATE = """
-<div class="card">
+<div class="card {{CARD_CLASS}}">
     <h3>Allarme</h3>
     <div class="status-group">
         <p>Stato: <span class="{{ALARM_CLASS}}">{{ALARM_TEXT}}</span></p>
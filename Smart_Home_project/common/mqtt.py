@@ -1,33 +1,407 @@
 # smarthome/common/mqtt.py
 
-from umqtt.simple import MQTTClient
+import json
+import random
+import uasyncio as asyncio
 
-def connect_mqtt(client_id, broker, callback, subscriptions=None):
+from umqtt.aio import MQTTClient
+from smarthome.common.storage import PublishJournal
+
+# Keepalive announced to the broker, in seconds. The client pings after a
+# quarter of it without traffic, so a dead link is noticed within a few
+# seconds (ping interval plus the 2 s PINGRESP timeout).
+MQTT_KEEPALIVE = 10
+# Timeout of the initial connection, in seconds
+MQTT_CONNECT_TIMEOUT = 5
+# Client statistics are published, retained, under this prefix followed by
+# the client ID, every MQTT_STATS_INTERVAL seconds
+MQTT_STATS_TOPIC = b"home/sys/"
+MQTT_STATS_INTERVAL = 60
+# Presence of the nodes: a node publishes MQTT_ONLINE (its birth) on
+# MQTT_PRESENCE_TOPIC + <node> on every connection, and the broker publishes
+# its will MQTT_OFFLINE there once the connection is lost. Both are retained.
+MQTT_PRESENCE_TOPIC = b"home/presence/"
+MQTT_ONLINE = b"online"
+MQTT_OFFLINE = b"offline"
+
+def connect_mqtt(client_id, broker, callback, subscriptions=None, publish_interval_ms=20, keepalive=MQTT_KEEPALIVE, persistent=False, outbox_file=None, stats=False, node=None, tls=False, ca_file=None):
     """
     Connects to an MQTT broker and subscribes to topics.
 
+    The returned client is asyncio-native: incoming messages are dispatched
+    to ``callback`` by awaiting ``client.run()`` in a task. ``publish()``
+    only queues the message; the queue is sent while ``client.run()`` is
+    active, keeping only the latest value of each retained topic.
+
+    While ``client.run()`` is active the link is supervised by keepalive
+    pings; when it drops, ``run()`` raises ``OSError`` and awaiting
+    ``client.reconnect()`` restores the connection and subscriptions in
+    place, without blocking the other tasks. ``ReconnectManager`` wraps
+    both for the nodes.
+
+    With ``persistent`` the session is not cleaned: the broker keeps the
+    subscriptions and queues QoS 1/2 messages while the node is away, so a
+    reconnection that finds the session does not subscribe again and does
+    not get every retained message replayed. QoS 0 messages published
+    meanwhile are lost: a node needing their retained values subscribes to
+    those filters again on reconnection, see ``replay_retained()``. This needs a client ID that is
+    stable across reboots and unique to the node. The subscriptions are
+    still sent once at boot, as they may have changed with the firmware.
+
+    With ``outbox_file``, messages published while the connection is down
+    are kept in a ``PublishJournal`` on flash instead of being queued in RAM,
+    and are sent at a limited rate once reconnected.
+
+    With ``node``, the client announces the presence of the node: it sets a
+    will publishing ``offline`` on ``home/presence/<node>`` and publishes
+    ``online`` there after every connection.
+
+    With ``tls`` the connection is encrypted (port 8883). The TLS context is
+    created once and kept by the client, so the CA certificate is only
+    parsed once. Where the ``ssl`` module supports it (CPython), every
+    reconnection also offers the TLS session of the previous one, so the
+    broker can resume it with an abbreviated handshake (see the ``tls``
+    benchmark of ``utils/mqtt_bench.py``); the ``ssl`` module of
+    MicroPython has no session resumption, so on the nodes each
+    reconnection is a full handshake. The broker certificate is verified
+    against ``ca_file`` when given.
+
+    With ``stats``, the client counts its traffic per topic class and times
+    publishes, acknowledgements, reconnections and callbacks; the figures
+    are read with ``client.stats.snapshot()`` and published by
+    ``publish_stats()``.
+
     :param client_id: The unique client ID for the MQTT connection.
     :type client_id: str
     :param broker: The address of the MQTT broker.
     :type broker: str
-    :param callback: The function to call when a message is received.
+    :param callback: The function to call when a message is received, with
+        the topic and payload as memoryviews only valid during the call.
     :type callback: function
-    :param subscriptions: A list of topics to subscribe to.
+    :param subscriptions: A list of topics to subscribe to. An entry may be
+        a ``(topic, qos)`` tuple to subscribe with a QoS other than 0.
     :type subscriptions: list, optional
+    :param publish_interval_ms: Minimum delay between two queued publishes.
+    :type publish_interval_ms: int, optional
+    :param keepalive: The MQTT keepalive in seconds, 0 disables the pings.
+    :type keepalive: int, optional
+    :param persistent: Whether to use a persistent session.
+    :type persistent: bool, optional
+    :param outbox_file: Path of the offline outbox on flash.
+    :type outbox_file: str, optional
+    :param stats: Whether to collect client statistics.
+    :type stats: bool, optional
+    :param node: The name of the node, to announce its presence.
+    :type node: str, optional
+    :param tls: Whether to connect with TLS.
+    :type tls: bool, optional
+    :param ca_file: Path of the CA certificate of the broker.
+    :type ca_file: str, optional
     :return: The MQTT client object.
-    :rtype: MQTTClient
+    :rtype: umqtt.aio.MQTTClient
     """
-    client = MQTTClient(client_id, broker)
-    client.set_callback(callback)
+    outbox = PublishJournal(outbox_file) if outbox_file else None
+    ssl_context = tls_context(ca_file) if tls else None
+    client = MQTTClient(client_id, broker, keepalive=keepalive, ssl=ssl_context, publish_interval_ms=publish_interval_ms, outbox=outbox)
+    client.set_callback(callback, copy=False)
+    if stats:
+        client.enable_stats()
+    if node:
+        topic = MQTT_PRESENCE_TOPIC + node.encode()
+        client.set_last_will(topic, MQTT_OFFLINE, retain=True, qos=1)
+        client.set_birth(topic, MQTT_ONLINE, retain=True, qos=1)
     
-    print(f"Connecting to MQTT broker at {broker}...")
-    client.connect()
-    print("Successfully connected to MQTT broker.")
+    print(f"Connecting to MQTT broker at {broker}{' (TLS)' if tls else ''}...")
+    present = client.connect(clean_session=not persistent, timeout=MQTT_CONNECT_TIMEOUT)
+    print(f"Successfully connected to MQTT broker{' (session resumed)' if present else ''}.")
     
     if subscriptions:
-        for topic in subscriptions:
-            client.subscribe(topic)
-            print(f"Subscribed to topic: {topic.decode()}")
+        # All the filters go in one SUBSCRIBE packet: a single round-trip
+        filters = [topic if isinstance(topic, tuple) else (topic, 0) for topic in subscriptions]
+        client.subscribe_many(filters)
+        for topic, qos in filters:
+            print(f"Subscribed to topic: {topic.decode()} (QoS {qos})")
             
     return client
 
+
+def replay_retained(client, subscriptions):
+    """
+    Builds the ``on_connect`` hook of ``ReconnectManager`` for a client with
+    a persistent session. A resumed session only queued the messages of the
+    QoS 1/2 filters, so the QoS 0 filters are subscribed to again: the
+    broker then replays their retained values, e.g. the last commands
+    published while the node was away.
+
+    :param client: A client returned by ``connect_mqtt()``.
+    :type client: umqtt.aio.MQTTClient
+    :param subscriptions: The subscriptions given to ``connect_mqtt()``.
+    :type subscriptions: list
+    :return: The hook, called with whether the broker still had the session.
+    :rtype: function
+    """
+    filters = [topic if isinstance(topic, tuple) else (topic, 0) for topic in subscriptions]
+    filters = [(topic, qos) for topic, qos in filters if not qos]
+
+    def on_connect(session_present):
+        if session_present and filters:
+            client.subscribe_many(filters)
+    return on_connect
+
+
+def tls_context(ca_file=None):
+    """
+    Creates the TLS context of MQTT connections.
+
+    :param ca_file: Path of the CA certificate to verify the broker with.
+        Without it the connection is encrypted but the broker is not
+        authenticated.
+    :type ca_file: str, optional
+    :return: The context, to pass as ``ssl`` to the MQTT client.
+    :rtype: ssl.SSLContext
+    """
+    import ssl
+
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    # The broker is addressed by IP on the local network
+    if hasattr(context, "check_hostname"):  # CPython
+        context.check_hostname = False
+    if ca_file:
+        context.load_verify_locations(cafile=ca_file)
+        context.verify_mode = ssl.CERT_REQUIRED
+    else:
+        context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+async def publish_stats(client, interval=MQTT_STATS_INTERVAL):
+    """
+    Publishes the statistics of a client periodically, as a retained JSON
+    message on ``home/sys/<client_id>/mqtt``, in the manner of the ``$SYS``
+    topics of brokers. Comparing the ``traffic`` of the nodes shows which of
+    them loads the broker link, and with which topics. Never returns.
+
+    :param client: A client returned by ``connect_mqtt()`` with ``stats``.
+    :type client: umqtt.aio.MQTTClient
+    :param interval: Delay between two publishes, in seconds.
+    :type interval: int, optional
+    """
+    client_id = client.client_id
+    if isinstance(client_id, str):
+        client_id = client_id.encode()
+    topic = MQTT_STATS_TOPIC + client_id + b"/mqtt"
+    while True:
+        await asyncio.sleep(interval)
+        client.publish(topic, json.dumps(client.stats.snapshot()), retain=True)
+
+
+class ReconnectManager:
+    """
+    Keeps an asyncio MQTT client connected without blocking the other tasks.
+
+    ``run()`` dispatches messages with ``client.run()``; when the link drops
+    it retries ``client.reconnect()`` (which also subscribes again) with a
+    capped exponential backoff. Each delay is randomised between half and
+    all of its nominal value, so the nodes do not all hit a restarted
+    broker at the same moment. Between attempts the event loop keeps
+    running, and during them too: an attempt is awaited, bounded by
+    ``connect_timeout`` seconds, and only the name resolution of the broker
+    blocks, which is immediate for an IP address.
+    """
+    def __init__(self, client, on_connect=None, on_disconnect=None,
+                 min_delay_ms=500, max_delay_ms=60000, connect_timeout=MQTT_CONNECT_TIMEOUT):
+        """
+        Initializes the ReconnectManager.
+
+        :param client: A connected client, as returned by ``connect_mqtt()``.
+        :type client: umqtt.aio.MQTTClient
+        :param on_connect: Called after every reconnection, with whether the
+            broker still had the session of the client.
+        :type on_connect: function, optional
+        :param on_disconnect: Called with the error when the link drops.
+        :type on_disconnect: function, optional
+        :param min_delay_ms: Nominal delay before the first attempt.
+        :type min_delay_ms: int, optional
+        :param max_delay_ms: Cap of the nominal delay.
+        :type max_delay_ms: int, optional
+        :param connect_timeout: Timeout of one connection attempt, in seconds.
+        :type connect_timeout: int, optional
+        """
+        self.client = client
+        self.on_connect = on_connect
+        self.on_disconnect = on_disconnect
+        self.min_delay_ms = min_delay_ms
+        self.max_delay_ms = max_delay_ms
+        self.connect_timeout = connect_timeout
+        self.connected = True
+
+    def delay_ms(self, attempt):
+        """
+        Computes the delay before a reconnection attempt.
+
+        :param attempt: Number of failed attempts so far.
+        :type attempt: int
+        :return: The delay in milliseconds.
+        :rtype: int
+        """
+        delay = min(self.min_delay_ms << min(attempt, 16), self.max_delay_ms)
+        half = delay // 2
+        return half + (half * random.getrandbits(16) >> 16)
+
+    async def run(self):
+        """Dispatches incoming messages and reconnects whenever the link drops. Never returns."""
+        while True:
+            error = None
+            try:
+                await self.client.run()
+            except Exception as e:
+                error = e
+            self._set_connected(False, error)
+            attempt = 0
+            while True:
+                delay = self.delay_ms(attempt)
+                print(f"MQTT: Reconnecting in {delay} ms...")
+                await asyncio.sleep_ms(delay)
+                try:
+                    present = await self.client.reconnect(self.connect_timeout)
+                    break
+                except Exception as e:
+                    print(f"MQTT: Reconnect attempt {attempt + 1} failed: {e}")
+                    attempt += 1
+            self._set_connected(True, present=present)
+
+    def _set_connected(self, connected, error=None, present=False):
+        self.connected = connected
+        if connected:
+            print(f"MQTT: Reconnected to broker{' (session resumed)' if present else ''}.")
+            callback = self.on_connect
+            args = (bool(present),)
+        else:
+            print(f"MQTT: Connection lost: {error}")
+            callback = self.on_disconnect
+            args = (error,)
+        if callback:
+            try:
+                callback(*args)
+            except Exception as e:
+                print(f"MQTT: Error in connection hook: {e}")
+
+
+class TopicRouter:
+    """
+    Dispatches incoming MQTT messages to handlers by topic filter.
+
+    Topic filters, with the ``+`` and ``#`` wildcards, are compiled into a
+    trie with one level per topic segment, so a message is routed by
+    walking its topic once instead of testing every filter, however many
+    devices are registered. Topics are matched as raw ``bytes`` and never
+    decoded.
+
+    Handlers are called as ``handler(topic, msg, *wildcards)``, where
+    ``wildcards`` are the topic segments matched by the ``+`` of the filter,
+    in order. Managers declare their handlers in an ``MQTT_ROUTES`` tuple of
+    ``(topic_filter, qos, method_name)`` entries and are added with
+    ``register()``.
+
+    The topic is copied once to ``bytes``, as the trie is keyed by its
+    segments, but the payload is passed on as received: usually a
+    memoryview into the receive buffer of the client, only valid until the
+    handler returns. Handlers keeping or parsing it copy it with
+    ``bytes()``; comparing it with ``==`` needs no copy.
+    """
+    def __init__(self):
+        """Initializes an empty TopicRouter."""
+        # Trie nodes are dicts from segment to child node; the handlers of
+        # the filter ending at a node are stored under the None key
+        self._root = {}
+        self._subscriptions = {}
+
+    def add(self, topic_filter, handler, qos=0):
+        """
+        Adds a handler for a topic filter.
+
+        :param topic_filter: The topic filter, e.g. ``b"home/led/+/state"``.
+        :type topic_filter: bytes
+        :param handler: The function called for every matching message.
+        :type handler: function
+        :param qos: The QoS to subscribe to the filter with.
+        :type qos: int, optional
+        :raises ValueError: If ``#`` is not the last segment of the filter.
+        """
+        if isinstance(topic_filter, str):
+            topic_filter = topic_filter.encode()
+        levels = topic_filter.split(b"/")
+        if b"#" in levels[:-1]:
+            raise ValueError("'#' must be the last level of a topic filter")
+        node = self._root
+        for level in levels:
+            child = node.get(level)
+            if child is None:
+                child = node[level] = {}
+            node = child
+        handlers = node.get(None)
+        if handlers is None:
+            handlers = node[None] = []
+        handlers.append(handler)
+        self._subscriptions[topic_filter] = max(qos, self._subscriptions.get(topic_filter, 0))
+
+    def register(self, manager):
+        """
+        Adds the handlers declared in the ``MQTT_ROUTES`` of a manager.
+
+        :param manager: An object with an ``MQTT_ROUTES`` attribute.
+        """
+        for topic_filter, qos, name in manager.MQTT_ROUTES:
+            self.add(topic_filter, getattr(manager, name), qos)
+
+    def subscriptions(self):
+        """
+        Lists the filters to subscribe to, in the format of ``connect_mqtt()``.
+
+        :return: A list of ``(topic_filter, qos)`` tuples.
+        :rtype: list
+        """
+        return list(self._subscriptions.items())
+
+    def dispatch(self, topic, msg):
+        """
+        Calls the handlers of every filter matching the topic. Can be used
+        directly as the MQTT client callback.
+
+        :param topic: The topic the message was received on.
+        :type topic: bytes or memoryview
+        :param msg: The message payload.
+        :type msg: bytes or memoryview
+        :return: The number of handlers called.
+        :rtype: int
+        """
+        if not isinstance(topic, bytes):
+            topic = bytes(topic)
+        return self._walk(self._root, topic.split(b"/"), 0, topic, msg, ())
+
+    def _walk(self, node, levels, i, topic, msg, wildcards):
+        # Wildcards don't match the first level of $-topics (e.g. $SYS)
+        system = i == 0 and levels[0][:1] == b"$"
+        count = 0
+        child = node.get(b"#")
+        if child is not None and not system:
+            # "a/#" also matches "a" itself
+            count += self._call(child, topic, msg, wildcards)
+        if i == len(levels):
+            return count + self._call(node, topic, msg, wildcards)
+        level = levels[i]
+        child = node.get(level)
+        if child is not None:
+            count += self._walk(child, levels, i + 1, topic, msg, wildcards)
+        child = node.get(b"+")
+        if child is not None and not system:
+            count += self._walk(child, levels, i + 1, topic, msg, wildcards + (level,))
+        return count
+
+    def _call(self, node, topic, msg, wildcards):
+        handlers = node.get(None)
+        if handlers is None:
+            return 0
+        for handler in handlers:
+            handler(topic, msg, *wildcards)
+        return len(handlers)
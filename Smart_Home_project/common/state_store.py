@@ -0,0 +1,331 @@
+"""
+StateStore class, deals with the compact typed states of the master
+
+Code in this file is responsible for:
+- Declaring the states once, in a schema giving their type and default.
+- Keeping the values packed: booleans as bits, temperatures as fixed-point
+  integers and enumerations as indexes, instead of one object per value.
+- Tracking which states changed since they were last persisted.
+- Offering the dictionary API of the old free-form states.
+
+A schema is a tuple of fields built with :func:`boolean`, :func:`fixed`
+and :func:`enum`. The values are persisted by name, so fields can be added
+or reordered freely.
+"""
+
+# Standard library imports
+from array import array
+
+
+BOOL = 0
+FIXED = 1
+ENUM = 2
+# Raw value of a fixed-point field without a value (None)
+NO_VALUE = -32768
+
+
+def boolean(name, default=False, persist=True):
+    """
+    Declares a boolean field, stored as one bit.
+
+    :param name: The name of the field.
+    :type name: str
+    :param default: The initial value.
+    :type default: bool
+    :param persist: Whether changes of the field are persisted.
+    :type persist: bool
+    :return: The field, for a schema.
+    :rtype: tuple
+    """
+    return (name, BOOL, default, persist, None)
+
+
+def fixed(name, default=None, decimals=1, persist=True):
+    """
+    Declares a number field, stored as a 16 bit fixed-point integer.
+
+    With one decimal the range is -3276.7 to 3276.7. The field can also
+    hold None.
+
+    :param name: The name of the field.
+    :type name: str
+    :param default: The initial value.
+    :type default: float, optional
+    :param decimals: The number of decimals kept.
+    :type decimals: int
+    :param persist: Whether changes of the field are persisted.
+    :type persist: bool
+    :return: The field, for a schema.
+    :rtype: tuple
+    """
+    return (name, FIXED, default, persist, 10 ** decimals)
+
+
+def enum(name, choices, default=None, persist=True):
+    """
+    Declares a field taking one of a few strings, stored as one byte.
+
+    :param name: The name of the field.
+    :type name: str
+    :param choices: The possible values.
+    :type choices: tuple
+    :param default: The initial value, the first choice if not given.
+    :type default: str, optional
+    :param persist: Whether changes of the field are persisted.
+    :type persist: bool
+    :return: The field, for a schema.
+    :rtype: tuple
+    """
+    return (name, ENUM, choices[0] if default is None else default, persist, tuple(choices))
+
+
+class StateStore:
+    """
+    Typed states declared by a schema, with per-field dirty bits.
+
+    Fields are addressed by name, or by the number returned by
+    :meth:`field` to skip the name lookup in hot paths. Keys outside the
+    schema are still accepted and kept in a plain dictionary, so the store
+    can stand in for the old states dictionary.
+    """
+    def __init__(self, fields):
+        """
+        Initializes the StateStore with the defaults of the schema.
+
+        :param fields: The schema.
+        :type fields: tuple
+        """
+        self._fields = fields
+        self._index = {}
+        # Kind and position in the storage of the kind, by field number
+        self._kinds = bytearray(len(fields))
+        self._slots = bytearray(len(fields))
+        self._persist = 0
+        counts = [0, 0, 0]
+        for i, (name, kind, _, persist, _) in enumerate(fields):
+            self._index[name] = i
+            self._kinds[i] = kind
+            self._slots[i] = counts[kind]
+            counts[kind] += 1
+            if persist:
+                self._persist |= 1 << i
+        self._bits = bytearray((counts[BOOL] + 7) // 8)
+        self._fixed = array("h", [NO_VALUE] * counts[FIXED])
+        self._enums = bytearray(counts[ENUM])
+        self._extra = {}
+        self._dirty = 0
+        self._dirty_extra = set()
+        for i, field in enumerate(fields):
+            self.set_field(i, field[2], mark=False)
+
+    def field(self, name):
+        """
+        Gets the number of a field.
+
+        :param name: The name of the field.
+        :type name: str
+        :return: The field number, for :meth:`get_field` and :meth:`set_field`.
+        :rtype: int
+        :raises KeyError: If the schema has no such field.
+        """
+        return self._index[name]
+
+    def get_raw(self, i):
+        """
+        Gets the stored value of a field: the bit of a boolean, the integer
+        of a fixed-point number (``NO_VALUE`` for None) or the index of an
+        enumeration.
+
+        :param i: The field number.
+        :type i: int
+        :rtype: int
+        """
+        slot = self._slots[i]
+        kind = self._kinds[i]
+        if kind == BOOL:
+            return self._bits[slot >> 3] >> (slot & 7) & 1
+        if kind == FIXED:
+            return self._fixed[slot]
+        return self._enums[slot]
+
+    def get_field(self, i):
+        """
+        Gets the value of a field.
+
+        :param i: The field number.
+        :type i: int
+        :return: A bool, a float or None, or a string, by kind.
+        """
+        raw = self.get_raw(i)
+        kind = self._kinds[i]
+        if kind == BOOL:
+            return bool(raw)
+        if kind == FIXED:
+            return None if raw == NO_VALUE else raw / self._fields[i][4]
+        return self._fields[i][4][raw]
+
+    def set_field(self, i, value, mark=True):
+        """
+        Sets the value of a field.
+
+        :param i: The field number.
+        :type i: int
+        :param value: The new value.
+        :param mark: Whether a change sets the dirty bit of the field.
+        :type mark: bool
+        :return: Whether the stored value changed.
+        :rtype: bool
+        :raises ValueError: If the value doesn't fit the field.
+        """
+        slot = self._slots[i]
+        kind = self._kinds[i]
+        if kind == BOOL:
+            byte = self._bits[slot >> 3]
+            bit = 1 << (slot & 7)
+            new = byte | bit if value else byte & ~bit
+            if new == byte:
+                return False
+            self._bits[slot >> 3] = new
+        elif kind == FIXED:
+            if value is None:
+                raw = NO_VALUE
+            else:
+                raw = max(-32767, min(32767, int(round(value * self._fields[i][4]))))
+            if raw == self._fixed[slot]:
+                return False
+            self._fixed[slot] = raw
+        else:
+            raw = self._fields[i][4].index(value)
+            if raw == self._enums[slot]:
+                return False
+            self._enums[slot] = raw
+        if mark:
+            self._dirty |= 1 << i & self._persist
+        return True
+
+    def get(self, name, default=None):
+        """
+        Gets the value of a field, or of a key outside the schema.
+
+        :param name: The name of the field.
+        :type name: str
+        :param default: The value returned for an unknown key or a field holding None.
+        :return: The value.
+        """
+        i = self._index.get(name)
+        if i is None:
+            return self._extra.get(name, default)
+        value = self.get_field(i)
+        return default if value is None else value
+
+    def set(self, name, value, mark=True):
+        """
+        Sets the value of a field, or of a key outside the schema.
+
+        :param name: The name of the field.
+        :type name: str
+        :param value: The new value.
+        :param mark: Whether a change sets the dirty bit of the field.
+        :type mark: bool
+        :return: Whether the value changed.
+        :rtype: bool
+        :raises ValueError: If the value doesn't fit the field.
+        """
+        i = self._index.get(name)
+        if i is not None:
+            return self.set_field(i, value, mark)
+        if name in self._extra and self._extra[name] == value:
+            return False
+        self._extra[name] = value
+        if mark:
+            self._dirty_extra.add(name)
+        return True
+
+    def load(self, states):
+        """
+        Sets values without marking them dirty, e.g. those read from flash.
+        Values not fitting their field are skipped.
+
+        :param states: The values by name.
+        :type states: dict
+        """
+        for name, value in states.items():
+            try:
+                self.set(name, value, mark=False)
+            except (ValueError, TypeError):
+                print(f"Storage: Ignoring invalid state {name}={value}.")
+
+    def mark(self, name):
+        """
+        Sets the dirty bit of a field, if it is persisted.
+
+        :param name: The name of the field.
+        :type name: str
+        """
+        i = self._index.get(name)
+        if i is None:
+            self._dirty_extra.add(name)
+        else:
+            self._dirty |= 1 << i & self._persist
+
+    @property
+    def dirty(self):
+        """Whether some persisted field changed since :meth:`take_dirty`."""
+        return bool(self._dirty or self._dirty_extra)
+
+    def take_dirty(self):
+        """
+        Gets the changed persisted fields and clears their dirty bits.
+
+        :return: The values of the changed fields by name.
+        :rtype: dict
+        """
+        changes = {}
+        for i in range(len(self._fields)):
+            if self._dirty >> i & 1:
+                changes[self._fields[i][0]] = self.get_field(i)
+        for name in self._dirty_extra:
+            changes[name] = self._extra[name]
+        self._dirty = 0
+        self._dirty_extra = set()
+        return changes
+
+    def to_dict(self, persistent=False):
+        """
+        Copies the values into a plain dictionary.
+
+        :param persistent: Whether to leave out the fields that aren't persisted.
+        :type persistent: bool
+        :rtype: dict
+        """
+        states = {}
+        for i, field in enumerate(self._fields):
+            if not persistent or self._persist >> i & 1:
+                states[field[0]] = self.get_field(i)
+        states.update(self._extra)
+        return states
+
+    # Dictionary API of the old states
+    def keys(self):
+        return [field[0] for field in self._fields] + list(self._extra)
+
+    def items(self):
+        return [(name, self[name]) for name in self.keys()]
+
+    def __contains__(self, name):
+        return name in self._index or name in self._extra
+
+    def __getitem__(self, name):
+        i = self._index.get(name)
+        if i is None:
+            return self._extra[name]
+        return self.get_field(i)
+
+    def __setitem__(self, name, value):
+        self.set(name, value)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self._fields) + len(self._extra)
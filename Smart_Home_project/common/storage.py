@@ -0,0 +1,440 @@
+"""
+StateJournal and PublishJournal classes, deal with persistent storage on flash
+
+Code in this file is responsible for:
+- Keeping a compacted JSON snapshot of the states in two crash-safe slots.
+- Appending every change as a small record to a journal file.
+- Replaying the journal on boot and compacting it once it grows too large.
+- Keeping the MQTT messages published while offline until they are sent.
+"""
+
+# Standard library imports
+import binascii
+import json
+import os
+import struct
+
+
+def _replace(src, dst):
+    """Renames src over dst."""
+    try:
+        os.rename(src, dst)
+    except OSError:
+        # Some filesystems refuse to rename over an existing file
+        os.remove(dst)
+        os.rename(src, dst)
+
+
+class SlotFile:
+    """
+    File written alternately to two slots, ``<path>.a`` and ``<path>.b``.
+
+    Each slot holds a ``!4sIII`` header (magic, sequence number, payload
+    length and CRC32 of the payload) followed by the payload. A write goes
+    to the slot not holding the latest data, with the next sequence number,
+    so a reset during the write leaves that slot invalid and the other one
+    intact. The slot to read is chosen from the headers and the file sizes
+    alone; only its payload is read and checked against the CRC, falling
+    back to the other slot if it doesn't match.
+    """
+    MAGIC = b"SHS1"
+    HEADER = "!4sIII"
+    HEADER_SIZE = 16
+
+    def __init__(self, path):
+        """
+        Initializes the SlotFile.
+
+        :param path: The path the slot names derive from.
+        :type path: str
+        """
+        self._paths = (path + ".a", path + ".b")
+        # Sequence number and slot of the latest data; call read() first
+        # so a write doesn't overwrite it
+        self._seq = 0
+        self._slot = 1
+
+    def _header(self, index):
+        """Reads the header of a slot, None if it cannot be valid."""
+        path = self._paths[index]
+        try:
+            size = os.stat(path)[6]
+            with open(path, "rb") as f:
+                header = f.read(self.HEADER_SIZE)
+        except OSError:
+            return None
+        if len(header) < self.HEADER_SIZE:
+            return None
+        magic, seq, length, crc = struct.unpack(self.HEADER, header)
+        if magic != self.MAGIC or size != self.HEADER_SIZE + length:
+            return None  # Torn write
+        return seq, length, crc
+
+    def read(self):
+        """
+        Reads the payload of the latest valid slot.
+
+        :return: The payload, or None if no slot is valid.
+        :rtype: bytes
+        """
+        headers = [self._header(0), self._header(1)]
+        order = [i for i in (0, 1) if headers[i]]
+        order.sort(key=lambda i: headers[i][0], reverse=True)
+        for index in order:
+            seq, length, crc = headers[index]
+            try:
+                with open(self._paths[index], "rb") as f:
+                    f.seek(self.HEADER_SIZE)
+                    data = f.read(length)
+            except OSError:
+                continue
+            if len(data) == length and binascii.crc32(data) & 0xFFFFFFFF == crc:
+                self._seq = seq
+                self._slot = index
+                return data
+            print(f"Storage: Ignoring corrupt slot '{self._paths[index]}'.")
+        return None
+
+    def write(self, data):
+        """
+        Writes a payload to the slot not holding the latest data.
+
+        :param data: The payload.
+        :type data: bytes
+        :raises OSError: If the slot cannot be written.
+        """
+        index = 1 - self._slot
+        seq = self._seq + 1
+        with open(self._paths[index], "wb") as f:
+            f.write(struct.pack(self.HEADER, self.MAGIC, seq, len(data), binascii.crc32(data) & 0xFFFFFFFF))
+            f.write(data)
+        self._seq = seq
+        self._slot = index
+
+
+class StateJournal:
+    """
+    Append-only journal of key/value changes on top of a compacted snapshot.
+
+    The snapshot is a JSON dictionary kept in a :class:`SlotFile`, so a
+    reset while it is rewritten leaves the previous one readable. Every
+    change is appended to ``<path>.log`` as one JSON line ``[key, value]``, so
+    a save costs a short sequential write instead of a full rewrite.
+
+    A plain JSON file at ``path`` (the old state file format) is read when
+    no slot is valid yet, and replaced by the slots at the first compaction.
+    """
+    def __init__(self, path, max_journal_size=4096):
+        """
+        Initializes the StateJournal.
+
+        :param path: The path of the snapshot file.
+        :type path: str
+        :param max_journal_size: Journal size in bytes above which it is compacted.
+        :type max_journal_size: int
+        """
+        self._path = path
+        self._journal_path = path + ".log"
+        self._max_journal_size = max_journal_size
+        self._snapshot = SlotFile(path)
+        self._torn = False
+        self._legacy = False
+        try:
+            self._journal_size = os.stat(self._journal_path)[6]
+        except OSError:
+            self._journal_size = 0
+
+    def load_snapshot(self):
+        """
+        Loads the compacted snapshot from the latest valid slot, or from the
+        old state file if there is none.
+
+        :return: The states stored in the snapshot.
+        :rtype: dict
+        :raises OSError: If there is no snapshot.
+        :raises ValueError: If the old state file is not valid JSON.
+        """
+        data = self._snapshot.read()
+        if data is not None:
+            return json.loads(data)
+        with open(self._path, "r") as f:
+            states = json.load(f)
+        # Moved to the slots by the next compaction
+        self._legacy = True
+        return states
+
+    def replay(self, states):
+        """
+        Applies the journal records on top of the given states.
+
+        A torn record at the end of the journal (e.g. after a reset during a
+        write) ends the replay; every record before it is kept and the
+        journal is flagged for compaction so new records are not appended
+        after the torn one. So is a last record missing its newline.
+
+        :param states: The states to update in place.
+        :type states: dict
+        :return: The number of records applied.
+        :rtype: int
+        """
+        count = 0
+        try:
+            with open(self._journal_path, "r") as f:
+                for line in f:
+                    try:
+                        key, value = json.loads(line)
+                    except (ValueError, TypeError):
+                        print(f"Storage: Ignoring torn record in '{self._journal_path}'.")
+                        self._torn = True
+                        break
+                    states[key] = value
+                    count += 1
+                    if not line.endswith("\n"):
+                        # Complete record cut before its newline: the next
+                        # one would be appended on the same line
+                        self._torn = True
+        except OSError:
+            pass  # No journal yet
+        return count
+
+    def append(self, changes):
+        """
+        Appends one record per changed key to the journal.
+
+        :param changes: The changed keys and their new values.
+        :type changes: dict
+        :raises OSError: If the journal cannot be written.
+        """
+        if not changes:
+            return
+        data = "".join(json.dumps([key, value]) + "\n" for key, value in changes.items())
+        with open(self._journal_path, "a") as f:
+            f.write(data)
+        self._journal_size += len(data)
+
+    def needs_compaction(self):
+        """
+        Checks whether the journal has grown past its size threshold, ends
+        with a torn record or sits on top of an old state file.
+
+        :rtype: bool
+        """
+        return self._torn or self._legacy or self._journal_size > self._max_journal_size
+
+    def compact(self, states):
+        """
+        Writes a new snapshot of the given states and empties the journal.
+
+        A reset during compaction leaves either the old snapshot plus the
+        journal or the new snapshot behind: the journal is only emptied once
+        the new slot is written, and replaying it again is harmless.
+
+        :param states: The complete current states.
+        :type states: dict
+        :raises OSError: If the snapshot cannot be written.
+        """
+        self._snapshot.write(json.dumps(states).encode())
+        with open(self._journal_path, "w"):
+            pass
+        self._journal_size = 0
+        self._torn = False
+        if self._legacy:
+            try:
+                os.remove(self._path)
+            except OSError:
+                pass
+            self._legacy = False
+        print(f"Storage: Compacted '{self._path}'.")
+
+
+class PublishJournal:
+    """
+    Bounded outbox on flash for the MQTT messages published while offline.
+
+    Used as the ``outbox`` of a ``umqtt.aio.MQTTClient``. Each message is
+    appended to the file as a binary record (a ``!BHH`` header with the
+    retain flag and QoS, the topic length and the payload length, then the
+    topic and payload), so it survives a reset and binary payloads are kept
+    as they are. A copy of the pending messages is kept in RAM. A message
+    handed to the MQTT client, or superseded, is forgotten by appending a
+    removal record (the ``TAKEN`` flag and its topic, without payload), so
+    it isn't sent again after a reset.
+
+    Retained QoS 0 messages are states: only the latest one of each topic
+    is kept, and they are never dropped, as they are bounded by the number
+    of topics. Other messages are events and are all kept, up to
+    ``max_entries`` events; past that the oldest QoS 0 event is dropped, or
+    the oldest event if all are QoS 1 or 2.
+    """
+    HEADER = "!BHH"
+    HEADER_SIZE = 5
+    # Flag of the removal records: the first pending message with the same
+    # topic, retain flag and QoS is forgotten
+    TAKEN = 0x80
+
+    def __init__(self, path, max_entries=64):
+        """
+        Initializes the PublishJournal, loading the messages left in the file.
+
+        :param path: The path of the journal file.
+        :type path: str
+        :param max_entries: Number of pending events kept at most, states apart.
+        :type max_entries: int
+        """
+        self._path = path
+        self._max_entries = max_entries
+        # Entries are [topic, msg, retain, qos]
+        self._entries = []
+        # Records in the file, superseded and dropped ones included
+        self._records = 0
+        self._load()
+        if self._entries:
+            print(f"Storage: {len(self._entries)} messages pending in '{self._path}'.")
+
+    def _load(self):
+        try:
+            f = open(self._path, "rb")
+        except OSError:
+            return  # No journal yet
+        torn = False
+        with f:
+            while True:
+                header = f.read(self.HEADER_SIZE)
+                if len(header) < self.HEADER_SIZE:
+                    torn = bool(header)
+                    break
+                flags, topic_len, msg_len = struct.unpack(self.HEADER, header)
+                topic = f.read(topic_len)
+                msg = f.read(msg_len)
+                if len(topic) < topic_len or len(msg) < msg_len:
+                    torn = True
+                    break
+                if flags & self.TAKEN:
+                    self._remove(topic, bool(flags & 1), flags >> 1 & 3)
+                else:
+                    self._add(topic, msg, bool(flags & 1), flags >> 1)
+                self._records += 1
+        if torn:
+            print(f"Storage: Ignoring torn record in '{self._path}'.")
+        if torn or self._records > len(self._entries):
+            self._rewrite()
+
+    def _add(self, topic, msg, retain, qos):
+        if retain and not qos:
+            for entry in self._entries:
+                if entry[0] == topic and entry[2] and not entry[3]:
+                    entry[1] = msg
+                    return
+        else:
+            # Count the events, finding the oldest one and the oldest QoS 0 one
+            events = 0
+            oldest = oldest_qos0 = None
+            for i, entry in enumerate(self._entries):
+                if entry[2] and not entry[3]:
+                    continue  # State
+                events += 1
+                if oldest is None:
+                    oldest = i
+                if oldest_qos0 is None and not entry[3]:
+                    oldest_qos0 = i
+            if events >= self._max_entries:
+                dropped = self._entries.pop(oldest if oldest_qos0 is None else oldest_qos0)
+                print(f"Storage: Outbox full, dropped message on {dropped[0]}.")
+        self._entries.append([topic, msg, retain, qos])
+
+    def _remove(self, topic, retain, qos):
+        for i, entry in enumerate(self._entries):
+            if entry[0] == topic and entry[2] == retain and entry[3] == qos:
+                return self._entries.pop(i)
+        return None
+
+    def _forget(self, entry):
+        if self._entries:
+            self._write(self.TAKEN | entry[2] | entry[3] << 1, entry[0], b"")
+        else:
+            # Nothing left to send
+            self._rewrite()
+
+    def _write(self, flags, topic, msg):
+        try:
+            with open(self._path, "ab") as f:
+                f.write(struct.pack(self.HEADER, flags, len(topic), len(msg)) + topic + msg)
+            self._records += 1
+            if self._records > len(self._entries) + self._max_entries:
+                self._rewrite()
+        except OSError as e:
+            # Still up to date in RAM
+            print(f"Storage: Could not write to '{self._path}': {e}")
+
+    def append(self, topic, msg, retain=False, qos=0):
+        """
+        Stores a message until it can be published.
+
+        :param topic: The topic to publish to.
+        :type topic: bytes
+        :param msg: The message payload.
+        :type msg: bytes
+        :param retain: The retain flag of the message.
+        :type retain: bool
+        :param qos: The QoS of the message.
+        :type qos: int
+        """
+        if isinstance(topic, str):
+            topic = topic.encode()
+        if isinstance(msg, str):
+            msg = msg.encode()
+        self._add(topic, msg, retain, qos)
+        self._write(retain | qos << 1, topic, msg)
+
+    def take(self):
+        """
+        Removes the oldest pending message, as it is handed to the MQTT client.
+
+        :return: The ``[topic, msg, retain, qos]`` entry, None if there is none.
+        :rtype: list
+        """
+        if not self._entries:
+            return None
+        entry = self._entries.pop(0)
+        self._forget(entry)
+        return entry
+
+    def discard(self, topic):
+        """
+        Forgets the pending state (retained QoS 0 message) of a topic, once a
+        newer one was published online.
+
+        :param topic: The topic of the state.
+        :type topic: bytes
+        """
+        if isinstance(topic, str):
+            topic = topic.encode()
+        entry = self._remove(topic, True, 0)
+        if entry is not None:
+            self._forget(entry)
+
+    def entries(self):
+        """
+        Lists the pending messages, oldest first.
+
+        :return: A list of ``[topic, msg, retain, qos]`` entries.
+        :rtype: list
+        """
+        return list(self._entries)
+
+    def clear(self):
+        """Forgets every pending message, once they have all been published."""
+        self._entries = []
+        self._rewrite()
+
+    def _rewrite(self):
+        """Writes the pending messages to a new file, without the superseded ones."""
+        tmp_path = self._path + ".tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                for topic, msg, retain, qos in self._entries:
+                    f.write(struct.pack(self.HEADER, retain | qos << 1, len(topic), len(msg)) + topic + msg)
+            _replace(tmp_path, self._path)
+            self._records = len(self._entries)
+        except OSError as e:
+            print(f"Storage: Could not rewrite '{self._path}': {e}")
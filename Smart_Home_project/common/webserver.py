@@ -5,6 +5,9 @@ Code in this file is responsible for:
 - Running a Microdot web server for remote control via Wi-Fi.
 """
 
+# Standard library imports
+import json
+
 from microdot_asyncio import Microdot, Response, redirect
 
 # Local imports
@@ -21,17 +24,20 @@ class WebServer:
     # We store the managers as class variables so the route functions can access them.
     state_manager = None
     device_manager = None
+    state_history = None
 
-    def __init__(self, state_manager, device_manager):
+    def __init__(self, state_manager, device_manager, history=None):
         """
         Initializes the WebServer.
 
         :param state_manager: An instance of StateManager.
         :param device_manager: An instance of DeviceManager.
+        :param history: An instance of StateHistory, to serve ``/history``.
         """
         # Assign the managers to the class variables
         WebServer.state_manager = state_manager
         WebServer.device_manager = device_manager
+        WebServer.state_history = history
 
     @staticmethod
     def _render_template(template, **kwargs):
@@ -55,6 +61,11 @@ class WebServer:
         """
         cards_html = ""
         sm = WebServer.state_manager # Shortcut
+        dm = WebServer.device_manager
+
+        def card_class(device_id):
+            # Cards of devices whose node is offline are greyed out
+            return "" if dm.is_device_online(device_id) else "offline"
         
         # --- Climate Card ---
         temp = sm.get_state('current_temperature', '--')
@@ -68,7 +79,8 @@ class WebServer:
             TEMP=f"{temp:.1f}" if isinstance(temp, float) else temp,
             DES_TEMP=f"{desired_temp:.1f}",
             AUTO_MODE="ON" if auto_mode else "OFF",
-            AUTO_MODE_CLASS="on" if auto_mode else "off"
+            AUTO_MODE_CLASS="on" if auto_mode else "off",
+            CARD_CLASS=card_class('riscaldamento')
         )
         
         # --- Shutter and Alarm Cards ---
@@ -76,14 +88,16 @@ class WebServer:
         shutter_state = sm.get_state('tapparella_state', 'unknown')
         cards_html += WebServer._render_template(
             html_templates.SHUTTERS_CARD_TEMPLATE, 
-            SHUTTER_STATE=shutter_state.replace('_', ' ').title()
+            SHUTTER_STATE=shutter_state.replace('_', ' ').title(),
+            CARD_CLASS=card_class('tapparella')
         )
 
         alarm_on = sm.get_state('allarme', False)
         cards_html += WebServer._render_template(
             html_templates.ALARM_CARD_TEMPLATE,
             ALARM_TEXT="ATTIVO" if alarm_on else "DISATTIVATO",
-            ALARM_CLASS="on" if alarm_on else "off"
+            ALARM_CLASS="on" if alarm_on else "off",
+            CARD_CLASS=card_class('allarme')
         )
 
         # --- Dynamic Light Cards ---
@@ -95,7 +109,8 @@ class WebServer:
                 DEVICE_NAME=device_id.replace('_', ' ').title(),
                 DEVICE_ID=device_id,
                 STATUS_TEXT="ON" if state else "OFF",
-                STATUS_CLASS="on" if state else "off"
+                STATUS_CLASS="on" if state else "off",
+                CARD_CLASS=card_class(device_id)
             )
             
         return cards_html
@@ -114,13 +129,54 @@ class WebServer:
         )
         return Response(body=html, headers={"Content-Type": "text/html"})
 
+    @app.route("/states")
+    async def states(request):
+        """
+        Serves the states as JSON. With ``since`` (and ``epoch``) from a
+        previous answer, only the states changed since then are included,
+        unless the server no longer knows them all (``full`` is then true).
+        """
+        try:
+            since = int(request.args.get("since", 0))
+            epoch = request.args.get("epoch")
+            epoch = None if epoch is None else int(epoch)
+        except ValueError:
+            return Response("Invalid request", status_code=400)
+        sm = WebServer.state_manager
+        version, full, states = sm.changes_since(since, epoch)
+        body = json.dumps({"epoch": sm.epoch, "version": version, "full": full, "states": states})
+        return Response(body=body, headers={"Content-Type": "application/json"})
+
+    @app.route("/history")
+    async def history(request):
+        """
+        Serves the recorded temperatures and device transitions as JSON,
+        from the ``start`` timestamp (in seconds) if given.
+        """
+        history = WebServer.state_history
+        if history is None:
+            return Response("Not Found", status_code=404)
+        try:
+            start = request.args.get("start")
+            start = None if start is None else int(start)
+        except ValueError:
+            return Response("Invalid request", status_code=400)
+        body = json.dumps({
+            "temperature": [[t, temp] for t, temp in history.temperatures(start)],
+            "transitions": [[t, name, on] for t, name, on in history.device_transitions(start=start)],
+        })
+        return Response(body=body, headers={"Content-Type": "application/json"})
+
     @app.route("/update")
     async def update(request):
         """Handles requests to update a device's state (lights, alarm)."""
         device_id = request.args.get("id")
         state_str = request.args.get("state")
         
-        if device_id in WebServer.state_manager.states and state_str in ["ON", "OFF"]:
+        # Only the on/off devices: the states also hold the shutter, the
+        # temperatures and the modes, which aren't set this way
+        devices = WebServer.device_manager.mqtt_command_topics
+        if device_id in devices and device_id != "tapparella" and state_str in ["ON", "OFF"]:
             new_state = (state_str == "ON")
             WebServer.device_manager.set_device_state(device_id, new_state)
         else:
@@ -132,20 +188,17 @@ class WebServer:
         """Handles actions related to the climate control card."""
         action = request.args.get("action")
         sm = WebServer.state_manager
-        dm = WebServer.device_manager
 
+        # The auto mode and the display observe these states
         if action == "auto_toggle":
             current_auto = sm.get_state("auto_mode", False)
             sm.set_state("auto_mode", not current_auto)
-            dm.evaluate_auto_logic()
         elif action == "temp_up":
             current_temp = sm.get_state("desired_temperature", 22.0)
             sm.set_state("desired_temperature", min(current_temp + 0.5, 30.0))
-            dm.evaluate_auto_logic()
         elif action == "temp_down":
             current_temp = sm.get_state("desired_temperature", 22.0)
             sm.set_state("desired_temperature", max(current_temp - 0.5, 16.0))
-            dm.evaluate_auto_logic()
         
         return redirect("/")
 
@@ -154,11 +207,8 @@ class WebServer:
         """Handles actions for the shutters."""
         action = request.args.get("action")
         if action in ["up", "down"]:
-            topic = MQTT_COMMAND_TOPICS.get("tapparella")
-            if topic:
-                WebServer.device_manager.mqtt_client.publish(topic, action)
-        
-        WebServer.display_manager.draw_page()
+            # Goes through the device manager, which holds it if the node is offline
+            WebServer.device_manager.pubblish_shutter_command(action)
         return redirect("/")
 
     async def run(self):
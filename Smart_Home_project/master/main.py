@@ -10,7 +10,7 @@ This script is responsible for:
 """
 
 # Standard library imports
-import json
+import random
 import time
 import uasyncio as asyncio
 
@@ -19,9 +19,12 @@ from machine import reset
 from machine import Pin, SPI
 
 # Local application/library specific imports
-from smarthome.common import wifi, mqtt
+from smarthome.common import wifi, mqtt, aggregate, state_store
 from smarthome.common.webserver import WebServer
 from smarthome.common.display import DisplayManager
+from smarthome.common.storage import StateJournal
+from smarthome.common.history import StateHistory
+from smarthome.common.broker import Broker
 
 
 # ==============================
@@ -35,11 +38,38 @@ WIFI_PASS = "YOUR_WIFI_PASSWORD"
 # --- MQTT Configuration ---
 MQTT_BROKER = "YOUR_MQTT_BROKER_IP"
 MQTT_CLIENT_ID = "esp32-master-display"
+# Run the MQTT broker on the master itself instead of using MQTT_BROKER; the
+# slaves then use the address of the master as their MQTT_BROKER
+MQTT_EMBEDDED_BROKER = False
+# Slaves publishing their aggregate state (MQTT_AGGREGATE_STATE on the node):
+# the master follows their devices by it alone, without the per-device
+# state topics
+MQTT_AGGREGATE_NODES = ("lights", "climate")
 
 
 # --- Application Settings ---
 STANDBY_TIMEOUT = 60  # Seconds before display goes into standby
 STATE_FILE = "states.json" # File to store persistent states
+STATE_FLUSH_INTERVAL_MS = 5000  # Write-behind window for the state file (0 = write-through)
+STATE_JOURNAL_MAX_SIZE = 4096   # Bytes of journal before it is compacted into the state file
+STATE_HISTORY_SIZE = 32  # Recent changes kept for changes_since(), older versions get a full snapshot
+TEMPERATURE_HISTORY_SIZE = 256  # Temperature samples kept in RAM
+TRANSITION_HISTORY_SIZE = 128   # Device on/off transitions kept in RAM, all devices together
+
+# --- States ---
+# Every state of the master, with its type and default value
+STATE_FIELDS = (
+    state_store.boolean("soggiorno"),
+    state_store.boolean("cucina"),
+    state_store.boolean("camera"),
+    state_store.boolean("aria_condizionata"),
+    state_store.boolean("riscaldamento"),
+    state_store.boolean("allarme"),
+    state_store.boolean("auto_mode"),
+    state_store.fixed("desired_temperature", 22.0),
+    state_store.fixed("current_temperature", persist=False),
+    state_store.enum("tapparella_state", ("unknown", "moving_up", "moving_down")),
+)
 
 # --- Hardware Pin Configuration ---
 PIN_DISP_BL = 21
@@ -58,70 +88,253 @@ MQTT_COMMAND_TOPICS = {
     "tapparella": "home/actuator/tapparella/set"
 }
 
+# QoS of the command topics that need delivery guarantees (default 0).
+# Relays and the shutter motor use QoS 2 so a command is never applied twice.
+MQTT_COMMAND_QOS = {
+    "allarme": 1,
+    "aria_condizionata": 2,
+    "riscaldamento": 2,
+    "tapparella": 2
+}
 
-# Topics to subscribe to for state updates from slaves.
-MQTT_SUBSCRIPTIONS = [
-    b"home/led/+/state",
-    b"home/status/temperature",
-    b"home/sensor/alarm/state",
-]
+# Slave node driving each device, as announced on home/presence/<node>
+DEVICE_NODES = {
+    "soggiorno": "lights",
+    "cucina": "lights",
+    "camera": "lights",
+    "aria_condizionata": "climate",
+    "riscaldamento": "climate",
+    "allarme": "alarm",
+    "tapparella": "shutters"
+}
 
 
 class StateManager:
     """
     Manages the state of all devices and application settings.
 
-    This class handles loading states from and saving states to a JSON file,
-    ensuring persistence across reboots.
+    This class handles loading states from and saving states to flash,
+    ensuring persistence across reboots. Changes are appended to a journal
+    and folded back into a snapshot only when the journal grows past
+    ``STATE_JOURNAL_MAX_SIZE``. The snapshot alternates between two slots
+    checked by CRC, so a reset while it is written doesn't lose the states.
+
+    Saves are write-behind: changes only mark the store dirty and
+    :meth:`flush_task` writes the file at most once per flush window, so a
+    burst of changes costs a single flash write.
+
+    The states are a :class:`~smarthome.common.state_store.StateStore` of
+    the ``STATE_FIELDS`` schema, which also answers the old dictionary API.
+    Only the fields that actually changed are written to the journal.
+
+    Consumers observe the keys they care about with :meth:`subscribe`. The
+    changes made within one event loop tick are delivered together by
+    :meth:`notify_task`, once per observer, as ``{key: (old, new)}``.
+
+    Every change increments :attr:`version` and stamps the changed key with
+    it, so a client that remembers the version it last saw can pull only
+    the newer changes with :meth:`changes_since`. Versions restart on boot;
+    :attr:`epoch` tells the boots apart.
     """
-    def __init__(self, state_file):
+    def __init__(self, state_file, flush_interval_ms=STATE_FLUSH_INTERVAL_MS, history_size=STATE_HISTORY_SIZE):
         """
         Initializes the StateManager.
 
         :param state_file: The path to the file used for state persistence.
         :type state_file: str
+        :param flush_interval_ms: Write-behind window in milliseconds. 0 saves on every change.
+        :type flush_interval_ms: int
+        :param history_size: Number of recent changes kept for :meth:`changes_since`.
+        :type history_size: int
         """
         self._state_file = state_file
+        self._flush_interval_ms = flush_interval_ms
+        self._journal = StateJournal(state_file, max_journal_size=STATE_JOURNAL_MAX_SIZE)
+        self._dirty_event = asyncio.Event()
+        # Observers as (keys, key prefixes, callback)
+        self._observers = []
+        # Changes not delivered yet, as {key: (old, new)}
+        self._changes = {}
+        self._changes_event = asyncio.Event()
+        # Version of the last change, and version of the last change of each key
+        self.version = 0
+        self.epoch = random.getrandbits(30)
+        self._key_versions = {}
+        # Key changed by each of the last versions, version v at v % size
+        self._history = [None] * history_size
         self.states = self._load_states()
 
     def _load_states(self):
         """
-        Loads device states from the JSON file.
+        Loads device states from the JSON file and replays the journal.
 
-        If the file doesn't exist or is invalid, it returns a default state.
+        If the file doesn't exist or is invalid, the journal is replayed on
+        top of the defaults of ``STATE_FIELDS``.
 
-        :return: A dictionary containing the device states.
-        :rtype: dict
+        :return: The device states.
+        :rtype: StateStore
         """
         try:
-            with open(self._state_file, "r") as f:
-                states = json.load(f)
-                print("Master: States loaded from file.")
-                return states
+            states = self._journal.load_snapshot()
+            print("Master: States loaded from file.")
         except (OSError, ValueError) as e:
             print(f"Master: Could not load state file '{self._state_file}': {e}. Using defaults.")
-            return {
-                "soggiorno": False,
-                "cucina": False,
-                "camera": False,
-                "aria_condizionata": False,
-                "riscaldamento": False,
-                "allarme": False,
-                "auto_mode": False,
-                "desired_temperature": 22.0
-            }
+            states = {}
+        replayed = self._journal.replay(states)
+        if replayed:
+            print(f"Master: Replayed {replayed} journal records.")
+        store = state_store.StateStore(STATE_FIELDS)
+        store.load(states)
+        if self._journal.needs_compaction():
+            try:
+                self._journal.compact(store.to_dict(persistent=True))
+            except OSError as e:
+                print(f"Master: Error compacting '{self._state_file}': {e}")
+        return store
 
     def save_states(self):
         """
-        Saves the current device states to the JSON file.
+        Saves the changed states by appending them to the journal.
+
+        The journal is compacted into the JSON file once it exceeds its size
+        threshold.
         """
+        changes = self.states.take_dirty()
         try:
-            with open(self._state_file, "w") as f:
-                json.dump(self.states, f)
+            self._journal.append(changes)
+            if self._journal.needs_compaction():
+                self._journal.compact(self.states.to_dict(persistent=True))
             print("Master: States saved to file.")
         except OSError as e:
+            # Keep the keys dirty so the next save retries them
+            for key in changes:
+                self.states.mark(key)
             print(f"Master: Error saving states to '{self._state_file}': {e}")
 
+    def mark_dirty(self, key):
+        """
+        Schedules a save of a changed state.
+
+        With write-behind disabled the change is written immediately.
+
+        :param key: The key of the changed state.
+        :type key: str
+        """
+        self.states.mark(key)
+        if not self._flush_interval_ms:
+            self.save_states()
+            return
+        self._dirty_event.set()
+
+    def flush(self):
+        """
+        Writes pending changes to the file, if any.
+
+        Call this before a reset so no change is lost.
+        """
+        self._dirty_event.clear()
+        if self.states.dirty:
+            self.save_states()
+
+    async def flush_task(self):
+        """Asynchronous task that writes pending changes once per flush window."""
+        while True:
+            await self._dirty_event.wait()
+            # Let further changes pile up before touching the flash
+            await asyncio.sleep_ms(self._flush_interval_ms)
+            self.flush()
+
+    def subscribe(self, keys, callback):
+        """
+        Calls a callback when some of the given states change.
+
+        :param keys: The keys to observe. A key ending with ``*`` is a
+            prefix, ``"*"`` alone observes every state.
+        :type keys: tuple
+        :param callback: Function called with the changes of the observed
+            keys since the last call, as ``{key: (old, new)}``.
+        """
+        exact = set()
+        prefixes = []
+        for key in keys:
+            if key.endswith("*"):
+                prefixes.append(key[:-1])
+            else:
+                exact.add(key)
+        self._observers.append((exact, tuple(prefixes), callback))
+
+    def unsubscribe(self, callback):
+        """
+        Stops calling a callback given to :meth:`subscribe`.
+
+        :param callback: The callback.
+        """
+        self._observers = [o for o in self._observers if o[2] != callback]
+
+    def notify(self):
+        """
+        Delivers the pending changes to their observers now.
+
+        Changes made by the observers themselves are delivered by the next
+        call.
+        """
+        self._changes_event.clear()
+        changes = self._changes
+        self._changes = {}
+        for exact, prefixes, callback in self._observers:
+            observed = {}
+            for key, change in changes.items():
+                if change[0] == change[1]:
+                    continue  # Changed back within the tick
+                if key in exact or any(key.startswith(p) for p in prefixes):
+                    observed[key] = change
+            if observed:
+                try:
+                    callback(observed)
+                except Exception as e:
+                    print(f"Master: Error in state observer: {e}")
+
+    async def notify_task(self):
+        """Asynchronous task that delivers the changes of each tick to the observers."""
+        while True:
+            await self._changes_event.wait()
+            self.notify()
+
+    def get_version(self, key):
+        """
+        Gets the version at which a state last changed.
+
+        :param key: The key of the state.
+        :type key: str
+        :return: The version, 0 if it didn't change since boot.
+        :rtype: int
+        """
+        return self._key_versions.get(key, 0)
+
+    def changes_since(self, version, epoch=None):
+        """
+        Gets the states changed after a version.
+
+        When the version is older than the recent changes kept, or comes
+        from another boot, every state is returned instead.
+
+        :param version: The version the caller last saw, 0 for everything.
+        :type version: int
+        :param epoch: The epoch that version belongs to, if known.
+        :type epoch: int, optional
+        :return: The current version, whether the states are a full
+            snapshot, and the current values of the states by key.
+        :rtype: tuple
+        """
+        size = len(self._history)
+        if (epoch is not None and epoch != self.epoch) or not 0 < version <= self.version or self.version - version > size:
+            return self.version, True, self.states.to_dict()
+        changes = {}
+        for v in range(version + 1, self.version + 1):
+            key = self._history[v % size]
+            changes[key] = self.states.get(key)
+        return self.version, False, changes
+
     def get_state(self, key, default=None):
         """
         Gets the state of a specific device or setting.
@@ -140,18 +353,39 @@ class StateManager:
         :param key: The key for the state to set.
         :type key: str
         :param value: The new value for the state.
-        :param save: Whether to immediately save the states to the file.
+        :param save: Whether the change should be persisted to the file.
         :type save: bool
+        :return: Whether the state changed.
+        :rtype: bool
         """
-        self.states[key] = value
+        old = self.states.get(key)
+        if not self.states.set(key, value, mark=False):
+            return False
         if save:
-            self.save_states()
+            self.mark_dirty(key)
+        self.version += 1
+        self._key_versions[key] = self.version
+        self._history[self.version % len(self._history)] = key
+        # Coalesced with the earlier changes of the tick
+        pending = self._changes.get(key)
+        self._changes[key] = (pending[0] if pending else old, self.states.get(key))
+        self._changes_event.set()
+        return True
 
 
 class DeviceManager:
     """
     Manages device logic, state changes, and MQTT communication.
     """
+    # Incoming MQTT messages: (topic filter, QoS, handler method)
+    MQTT_ROUTES = (
+        (b"home/led/+/state", 0, "_on_device_state"),
+        (b"home/status/temperature", 0, "_on_temperature"),
+        (b"home/sensor/alarm/state", 0, "_on_alarm_state"),
+        (aggregate.AGGREGATE_TOPIC_PREFIX + b"+", 0, "_on_aggregate_state"),
+        (mqtt.MQTT_PRESENCE_TOPIC + b"+", 1, "_on_presence"),
+    )
+
     def __init__(self, state_manager, mqtt_command_topics):
         """
         Initializes the DeviceManager.
@@ -166,6 +400,17 @@ class DeviceManager:
         self.mqtt_client = None
         self.published_states = {}
         self._ui_update_callback = None
+        # (epoch, sequence number) of the last aggregate state by node
+        self._aggregate_seq = {}
+        # The per-device states of the nodes publishing an aggregate state
+        # are redundant with it: the filter is only kept for the other nodes
+        if all(DEVICE_NODES[name] in MQTT_AGGREGATE_NODES for name, topic in mqtt_command_topics.items() if topic.startswith("home/led/")):
+            self.MQTT_ROUTES = tuple(route for route in DeviceManager.MQTT_ROUTES if route[2] != "_on_device_state")
+        # Liveness of the slaves by node name, from their birth and will
+        # messages; a node not heard of yet is assumed online
+        self.node_online = {}
+        # The climate auto mode follows its inputs, whoever changes them
+        state_manager.subscribe(("auto_mode", "desired_temperature", "current_temperature"), self._on_climate_change)
 
     def set_mqtt_client(self, client):
         """
@@ -178,12 +423,25 @@ class DeviceManager:
 
     def set_ui_update_callback(self, callback):
         """
-        Sets a callback function to notify UI of state changes.
+        Sets a callback function to notify UI of changes that are not states,
+        i.e. the liveness of the nodes. State changes are observed with
+        :meth:`StateManager.subscribe`.
 
         :param callback: Function to call when UI should be updated
         """
         self._ui_update_callback = callback
 
+    def is_device_online(self, name):
+        """
+        Checks whether the node driving a device is connected.
+
+        :param name: The name of the device (e.g., "soggiorno").
+        :type name: str
+        :return: False if the node of the device is known to be offline.
+        :rtype: bool
+        """
+        return self.node_online.get(DEVICE_NODES.get(name), True)
+
     def set_device_state(self, name, new_state):
         """
         Sets the state of a device and publishes the change via MQTT.
@@ -202,9 +460,6 @@ class DeviceManager:
             
         self._publish_state(name)
 
-        if self._ui_update_callback:
-            self._ui_update_callback()
-
     def _publish_state(self, name):
         """
         Publishes a device's state to its MQTT command topic.
@@ -227,10 +482,16 @@ class DeviceManager:
         if name == "tapparella":
             return # Shutters are handled differently
 
+        # Hold the command until the node is back, see _on_presence()
+        if not self.is_device_online(name):
+            print(f"Master: → MQTT: {DEVICE_NODES[name]} offline, holding {name} command.")
+            return
+
         # Publish only if state has changed since last publish
         if self.published_states.get(name) != value:
             try:
-                self.mqtt_client.publish(topic, value, retain=True)
+                qos = MQTT_COMMAND_QOS.get(name, 0)
+                self.mqtt_client.publish(topic, value, retain=True, qos=qos)
                 self.published_states[name] = value
                 print(f"Master: → MQTT: Published {topic} = {value.decode()}")
             except Exception as e:
@@ -244,6 +505,25 @@ class DeviceManager:
             if name != "tapparella": # Don't publish shutter state on startup
                 self._publish_state(name)
 
+    def on_mqtt_reconnect(self, session_present):
+        """
+        Publishes all states again after a reconnection, unless the broker
+        kept the session (and so the retained messages).
+
+        A kept session only queued the QoS 1 messages, not those of the
+        QoS 0 state filters: they are subscribed again, so that the broker
+        replays their retained values and the states changed by the slaves
+        while the master was away are not lost.
+
+        :param session_present: Whether the broker still had the session.
+        :type session_present: bool
+        """
+        if session_present:
+            self.mqtt_client.subscribe_many([(topic_filter, qos) for topic_filter, qos, _ in self.MQTT_ROUTES if not qos])
+        else:
+            self.published_states.clear()
+            self.publish_all_states()
+
     def pubblish_shutter_command(self, direction):
         """
         Publishes a shutter command (up/down)
@@ -254,52 +534,136 @@ class DeviceManager:
         if not self.mqtt_client:
             return
 
+        if not self.is_device_online("tapparella"):
+            print("Master: → MQTT: shutters offline, command dropped.")
+            return
+
         topic = self.mqtt_command_topics.get("tapparella")
         if topic and direction in ["up", "down"]:
             try:
-                self.mqtt_client.publish(topic, direction.encode())
+                self.mqtt_client.publish(topic, direction.encode(), qos=MQTT_COMMAND_QOS.get("tapparella", 0))
                 self.state_manager.set_state("tapparella_state", f"moving_{direction}")
                 print("Master: → MQTT: Shutter command {direction}")
             except Exception as e:
                 print("Master: MQTT shutter publish error: {e}")
 
-    def mqtt_callback(self, topic, msg):
+    def _on_temperature(self, topic, msg):
         """
-        Callback function for handling incoming MQTT messages.
+        Handles the temperature reported by the climate node.
 
         :param topic: The topic the message was received on.
         :type topic: bytes
-        :param msg: The message payload.
-        :type msg: bytes
+        :param msg: The temperature, e.g. ``b"21.5"``.
+        :type msg: memoryview
         """
-        topic_str = topic.decode()
-        msg_str = msg.decode().strip().lower()
-        print(f"Master: MQTT received: {topic_str} = {msg_str}")
+        msg = bytes(msg)
+        try:
+            temp = float(msg)
+        except (ValueError, TypeError):
+            print(f"Master: Invalid temperature value received: {msg}")
+            return
+        # A retained replay of the value already known changes nothing
+        self.state_manager.set_state('current_temperature', temp, save=False)
 
-        updated = False
-        
-        # Handle temperature updates
-        if topic_str == "home/status/temperature":
-            try:
-                temp = float(msg_str)
-                self.state_manager.set_state('current_temperature', temp, save=False)
-                if self.state_manager.get_state("auto_mode"):
-                    self.evaluate_auto_logic()
-                updated = True
-            except (ValueError, TypeError):
-                print(f"Master: Invalid temperature value received: {msg_str}")
-
-        # Handle state updates from other devices
-        elif topic_str.endswith("/state"):
-            parts = topic_str.split('/')
-            if len(parts) >= 3:
-                device_name = parts[-2]
-                if device_name in self.state_manager.states:
-                    new_state = (msg_str == "on")
-                    self.state_manager.set_state(device_name, new_state, save=True)
-                    updated = True
-        
-        if updated and self._ui_update_callback:
+    def _on_device_state(self, topic, msg, device):
+        """
+        Handles a state reported by a slave on ``home/led/<device>/state``.
+        The devices of the nodes in ``MQTT_AGGREGATE_NODES`` are left to
+        their aggregate state.
+
+        :param topic: The topic the message was received on.
+        :type topic: bytes
+        :param msg: The state, ``b"ON"`` or ``b"OFF"``.
+        :type msg: memoryview
+        :param device: The device segment of the topic.
+        :type device: bytes
+        """
+        device_name = device.decode()
+        if DEVICE_NODES.get(device_name) in MQTT_AGGREGATE_NODES:
+            return  # Followed by the aggregate state of its node
+        if device_name in self.state_manager.states:
+            new_state = bytes(msg).strip().lower() == b"on"
+            # A retained replay matching the cached state changes nothing:
+            # no write, no redraw
+            self.state_manager.set_state(device_name, new_state, save=True)
+
+    def _on_alarm_state(self, topic, msg):
+        """
+        Handles the state reported by the alarm node (disarmed/triggered).
+
+        :param topic: The topic the message was received on.
+        :type topic: bytes
+        :param msg: The alarm state.
+        :type msg: memoryview
+        """
+        print(f"Master: Alarm reported: {bytes(msg)}")
+
+    def _on_aggregate_state(self, topic, msg, node):
+        """
+        Handles the binary aggregate state of a node, applying all its
+        states and its temperature. The observers get them all at once.
+
+        :param topic: The topic the message was received on.
+        :type topic: bytes
+        :param msg: The aggregate state, see ``common/aggregate.py``.
+        :type msg: memoryview
+        :param node: The node segment of the topic.
+        :type node: bytes
+        """
+        fields = aggregate.NODE_FIELDS.get(node)
+        if fields is None:
+            return
+        try:
+            epoch, seq, bits, temp = aggregate.decode(msg)
+        except ValueError as e:
+            print(f"Master: Invalid aggregate state from {node}: {e}")
+            return
+        if not aggregate.is_newer(epoch, seq, self._aggregate_seq.get(node)):
+            return  # Replay or out of order
+        self._aggregate_seq[node] = (epoch, seq)
+
+        for i, name in enumerate(fields):
+            if name in self.state_manager.states:
+                self.state_manager.set_state(name, bool(bits >> i & 1), save=True)
+        if temp is not None:
+            self.state_manager.set_state('current_temperature', temp, save=False)
+
+    def _on_presence(self, topic, msg, node):
+        """
+        Handles the birth (``online``) or will (``offline``) of a slave,
+        updating the liveness table. The commands held while the node was
+        offline are published once it is back.
+
+        :param topic: The topic the message was received on.
+        :type topic: bytes
+        :param msg: ``b"online"`` or ``b"offline"``.
+        :type msg: memoryview
+        :param node: The node segment of the topic.
+        :type node: bytes
+        """
+        name = node.decode()
+        online = msg == mqtt.MQTT_ONLINE
+        if self.node_online.get(name) == online:
+            return  # Retained replay
+        self.node_online[name] = online
+        print(f"Master: Node {name} is {'online' if online else 'offline'}.")
+        if online:
+            for device, device_node in DEVICE_NODES.items():
+                if device_node == name and device != "tapparella":
+                    self._publish_state(device)
+        self._notify_ui()
+
+    def _on_climate_change(self, changes):
+        """
+        Evaluates the auto mode again when one of its inputs changed.
+
+        :param changes: The changed states, as ``{key: (old, new)}``.
+        :type changes: dict
+        """
+        self.evaluate_auto_logic()
+
+    def _notify_ui(self):
+        if self._ui_update_callback:
             self._ui_update_callback()
 
     def evaluate_auto_logic(self):
@@ -342,6 +706,7 @@ class DeviceManager:
 
 async def main():
     """The main asynchronous entry point of the application."""
+    state_manager = None
     try:
         # 1. Connect to network
         wifi.connect_wifi(WIFI_SSID, WIFI_PASS)
@@ -349,6 +714,11 @@ async def main():
         # 2. Initialize managers
         state_manager = StateManager(STATE_FILE)
         device_manager = DeviceManager(state_manager)
+        history = StateHistory(
+            state_manager,
+            [name for name in MQTT_COMMAND_TOPICS if name != "tapparella"],
+            temperature_size=TEMPERATURE_HISTORY_SIZE,
+            transition_size=TRANSITION_HISTORY_SIZE)
 
         # 3. Inizialize display with configuration
         display_manager = DisplayManager(
@@ -357,18 +727,30 @@ async def main():
             standby_timeout=STANDBY_TIMEOUT)
 
         # 4. Initialize web server
-        web_server = WebServer(state_manager, device_manager)
+        web_server = WebServer(state_manager, device_manager, history)
 
         # 5. Set up cross-references
         device_manager.set_ui_update_callback(display_manager.draw_page)
 
-        # 6. Connect to MQTT
-        mqtt_client = mqtt.connect_mqtt(
-            MQTT_CLIENT_ID,
-            MQTT_BROKER,
-            callback=device_manager.mqtt_callback,
-            subscriptions=MQTT_SUBSCRIPTIONS
-        )
+        # 6. Connect to MQTT, routing messages to the device manager. With
+        # the embedded broker the master is a local client of it, whose
+        # messages never go through the network.
+        router = mqtt.TopicRouter()
+        router.register(device_manager)
+        mqtt_broker = None
+        if MQTT_EMBEDDED_BROKER:
+            mqtt_broker = Broker()
+            mqtt_client = mqtt_broker.local_client(MQTT_CLIENT_ID, router.dispatch)
+            mqtt_client.subscribe_many(router.subscriptions())
+        else:
+            mqtt_client = mqtt.connect_mqtt(
+                MQTT_CLIENT_ID,
+                MQTT_BROKER,
+                callback=router.dispatch,
+                subscriptions=router.subscriptions(),
+                persistent=True,
+                stats=True
+            )
         device_manager.set_mqtt_client(mqtt_client)
         
         # 7. Publish initial states and draw UI
@@ -381,30 +763,43 @@ async def main():
 
         # 9. Start all concurrent tasks
         print("Master: Starting all system tasks.")
-        await asyncio.gather(
+        tasks = [
             display_manager.standby_task(),
             display_manager.touch_loop(),
             web_server.run(),
-            mqtt_check_loop(mqtt_client)
-        )
+            state_manager.flush_task(),
+            state_manager.notify_task(),
+            mqtt_loop(mqtt_client, device_manager, state_manager)
+        ]
+        if mqtt_broker:
+            tasks.append(mqtt_broker.run())
+        else:
+            tasks.append(mqtt.publish_stats(mqtt_client))
+        await asyncio.gather(*tasks)
 
     except Exception as e:
         print(f"Master: A fatal error occurred: {e}")
+        if state_manager:
+            state_manager.flush()
         # Consider a safe shutdown or reboot here
         time.sleep(10)
-        machine.reset()
+        reset()
+    finally:
+        if state_manager:
+            state_manager.flush()
 
 
-async def mqtt_check_loop(client):
-    """Periodically checks for incoming MQTT messages."""
-    while True:
-        try:
-            client.check_msg()
-        except Exception as e:
-            print(f"Master: MQTT check_msg error: {e}. Reconnecting...")
-            time.sleep(5)
-            reset() 
-        await asyncio.sleep(1)
+async def mqtt_loop(client, device_manager, state_manager):
+    """
+    Dispatches incoming MQTT messages as soon as they arrive, reconnects with
+    backoff when the link drops. The states are flushed on disconnection and
+    published again once reconnected if the broker lost the session.
+    """
+    await mqtt.ReconnectManager(
+        client,
+        on_connect=device_manager.on_mqtt_reconnect,
+        on_disconnect=lambda e: state_manager.flush()
+    ).run()
 
 
 
@@ -29,6 +29,7 @@ WIFI_PASS = "YOUR_WIFI_PASSWORD"
 # --- MQTT Configuration ---
 MQTT_BROKER = "YOUR_MQTT_BROKER_IP"
 MQTT_CLIENT_ID = "esp32-alarm-slave"
+MQTT_OUTBOX_FILE = "outbox.bin"  # Messages published while offline, sent once reconnected
 
 # --- Hardware Pin Configuration ---
 PIN_SENSORS = [1, 2]
@@ -39,13 +40,16 @@ PIN_LED = 4
 TOPIC_STATE_REPORT = b"home/sensor/alarm/state"  # To report triggered/disarmed
 TOPIC_ARM_CMD = b"home/sensor/alarm/set"         # To receive arm/disarm commands
 
-MQTT_SUBSCRIPTIONS = [TOPIC_ARM_CMD]
-
 
 class AlarmManager:
     """
     Manages the state and logic of the alarm system.
     """
+    # Incoming MQTT messages: (topic filter, QoS, handler method)
+    MQTT_ROUTES = (
+        (TOPIC_ARM_CMD, 1, "_on_arm_command"),
+    )
+
     def __init__(self):
         """Initializes the AlarmManager."""
         self.mqtt_client = None
@@ -98,7 +102,8 @@ class AlarmManager:
         if not self.mqtt_client:   #if not configured client, ends without errors
             return 
         try:
-            self.mqtt_client.publish(TOPIC_STATE_REPORT, state_msg, retain=True)
+            # QoS 1: alarm events must reach the broker even on a flaky link
+            self.mqtt_client.publish(TOPIC_STATE_REPORT, state_msg, retain=True, qos=1)
             print(f"Alarm: → MQTT: Published state: {state_msg.decode()}")
         except Exception as e:
             print(f"Alarm: MQTT publish error: {e}")  #confirm if publish workerd and capture exceptions
@@ -108,9 +113,15 @@ class AlarmManager:
         if not self.is_armed:
             self.is_armed = True
             print("Alarm: Alarm system ARMED.")
-            # Short blink to confirm arming
-            self.led.on()
-            await uasyncio.sleep_ms(100) # non blocking
+            # Short blink to confirm arming, without blocking the caller
+            # (the MQTT callback)
+            uasyncio.create_task(self._blink_once())
+
+    async def _blink_once(self):
+        """Lights the LED for 100 ms."""
+        self.led.on()
+        await uasyncio.sleep_ms(100) # non blocking
+        if not self.is_triggered:  # The blinking task owns the LED then
             self.led.off()
 
     def disarm_system(self):
@@ -130,22 +141,21 @@ class AlarmManager:
             self._publish_state(b"triggered")
             # The async blinking task will take over the LED.
 
-    def mqtt_callback(self, topic, msg):
+    def _on_arm_command(self, topic, msg):
         """
-        Callback for handling incoming MQTT arm/disarm commands.
+        Handles the MQTT arm/disarm commands.
 
         :param topic: The topic the message was received on.
         :type topic: bytes
         :param msg: The message payload.
-        :type msg: bytes
+        :type msg: memoryview
         """
-        if topic == TOPIC_ARM_CMD:                               #check if comes from right topic
-            command = msg.decode().strip().lower()
-            print(f"Alarm: MQTT command received: {command}")    #converts form byte to string and log the recived command
-            if command == "on":
-                self.arm_system()
-            elif command == "off":
-                self.disarm_system()
+        command = bytes(msg).strip().lower()
+        print(f"Alarm: MQTT command received: {command}")    #log the recived command
+        if command == b"on":
+            self.arm_system()
+        elif command == b"off":
+            self.disarm_system()
 
     def _is_debounced(self, min_interval_ms=1000):
         """Checks if the time since last interrpt is sufficient to be triggered again"""
@@ -192,16 +202,13 @@ async def led_blink_task(manager):
             await uasyncio.sleep_ms(100)
 
 
-async def mqtt_loop(client):
-    """Periodically checks for incoming MQTT messages, manage connections error."""
-    while True:
-        try:
-            client.check_msg()
-        except Exception as e:
-            print(f"Alarm: MQTT check_msg error: {e}. Resetting...")
-            await uasyncio.sleep(5)
-            reset()
-        await uasyncio.sleep_ms(200)
+async def mqtt_loop(client, subscriptions):
+    """
+    Dispatches incoming MQTT messages as they arrive, reconnects with backoff
+    when the link drops. The retained commands of the QoS 0 subscriptions
+    are replayed when the broker resumed the session.
+    """
+    await mqtt.ReconnectManager(client, on_connect=mqtt.replay_retained(client, subscriptions)).run()
 
 
 async def event_handler_task(manager):
@@ -224,11 +231,17 @@ async def main():
     try:
         manager = AlarmManager()                    #create the main istance thta handle the alarm logic
         wifi.connect_wifi(WIFI_SSID, WIFI_PASS)
+        router = mqtt.TopicRouter()
+        router.register(manager)
         mqtt_client = mqtt.connect_mqtt(
             MQTT_CLIENT_ID,
             MQTT_BROKER,
-            callback=manager.mqtt_callback,
-            subscriptions=MQTT_SUBSCRIPTIONS #enstablish a connection to MQTT broker, register the callbacks for remote comands
+            callback=router.dispatch,
+            subscriptions=router.subscriptions(), #enstablish a connection to MQTT broker, register the callbacks for remote comands
+            persistent=True,                      #commands sent while offline are queued by the broker
+            outbox_file=MQTT_OUTBOX_FILE,         #events raised while offline are kept on flash
+            stats=True,                           #traffic statistics, published by mqtt.publish_stats()
+            node="alarm"                          #birth and will on home/presence/alarm, tracked by the master
         )
         manager.set_mqtt_client(mqtt_client) #pass the client to the AlarmManager    
         
@@ -237,7 +250,8 @@ async def main():
         print("Alarm: Application running. Starting tasks.")
         await uasyncio.gather(
             led_blink_task(manager),
-            mqtt_loop(mqtt_client),
+            mqtt_loop(mqtt_client, router.subscriptions()),
+            mqtt.publish_stats(mqtt_client),
             event_handler_task(manager),
         )                                    #task launch, runs in parallel: led blinking, MQTT handling, event management
 
@@ -14,7 +14,7 @@ import time
 import uasyncio
 
 # MicroPython-specific imports
-from machine import Pin, I2C
+from machine import Pin, I2C, reset
 
 # Third-party library imports
 try:
@@ -24,7 +24,7 @@ except ImportError:
     BME680_I2C = None
 
 # Local application/library specific imports
-from smarthome.common import wifi, mqtt
+from smarthome.common import wifi, mqtt, aggregate
 
 # ==============================
 # CONFIGURATION
@@ -36,6 +36,8 @@ WIFI_PASS = "YOUR_WIFI_PASSWORD"
 # --- MQTT Configuration ---
 MQTT_BROKER = "YOUR_MQTT_BROKER_IP"
 MQTT_CLIENT_ID = "esp32-climate-slave"
+MQTT_OUTBOX_FILE = "outbox.bin"  # Messages published while offline, sent once reconnected
+MQTT_AGGREGATE_STATE = True     # Also publish all states in one binary message (common/aggregate.py), see MQTT_AGGREGATE_NODES of the master
 
 # --- Hardware Pin Configuration ---
 PIN_I2C_SDA = 8
@@ -58,26 +60,30 @@ TOPIC_TEMP_STAT = b"home/status/temperature"
 TOPIC_AUTO_MODE_CMD = b"home/auto_mode/command"
 TOPIC_DES_TEMP_CMD = b"home/desired_temperature/command"
 
-MQTT_SUBSCRIPTIONS = [
-    TOPIC_RISC_CMD,
-    TOPIC_ARIA_CMD,
-    TOPIC_AUTO_MODE_CMD,
-    TOPIC_DES_TEMP_CMD,
-]
-
 
 class ClimateManager:
     """
     Manages the climate control system, including sensor, relays, and logic.
     """
+    # Incoming MQTT messages: (topic filter, QoS, handler method).
+    # Relay commands use QoS 2 so a redelivered command never toggles a relay twice.
+    MQTT_ROUTES = (
+        (TOPIC_RISC_CMD, 2, "_on_heating_command"),
+        (TOPIC_ARIA_CMD, 2, "_on_conditioning_command"),
+        (TOPIC_AUTO_MODE_CMD, 0, "_on_auto_mode_command"),
+        (TOPIC_DES_TEMP_CMD, 0, "_on_desired_temperature_command"),
+    )
+
     def __init__(self):
         """Initializes the ClimateManager."""
         self.mqtt_client = None
         self._last_irq_time = 0
+        self.aggregate = aggregate.AggregatePublisher(b"climate") if MQTT_AGGREGATE_STATE else None
 
         # State variables
         self.state_risc = False
         self.state_cond = False
+        self.last_temperature = None
         self.auto_mode = False
         self.desired_temperature = 22.0
         
@@ -134,9 +140,16 @@ class ClimateManager:
         try:
             self.mqtt_client.publish(topic, msg, retain=True)
             print(f"Climate: → MQTT: Published {topic.decode()} = {msg.decode()}")
+            self._publish_aggregate()
         except Exception as e:
             print(f"Climate: MQTT publish error for {topic.decode()}: {e}")
 
+    def _publish_aggregate(self):
+        """Publishes the relay states and last temperature in one binary message, if enabled."""
+        if self.aggregate:
+            states = {"riscaldamento": self.state_risc, "aria_condizionata": self.state_cond}
+            self.aggregate.publish(self.mqtt_client, states, self.last_temperature)
+
     def set_heating(self, new_state, source="mqtt"):
         """
         Controls the heating relay. Ensures AC is off if heating is turned on.
@@ -186,8 +199,11 @@ class ClimateManager:
             temp = self.bme_sensor.temperature
             if -40 < temp < 100: # Sanity check
                 payload = f"{temp:.1f}".encode()
-                self.mqtt_client.publish(TOPIC_TEMP_STAT, payload, retain=True)
+                # QoS 1: every reading is kept and sent, even if taken offline
+                self.mqtt_client.publish(TOPIC_TEMP_STAT, payload, retain=True, qos=1)
                 print(f"Climate:  Temperature published: {payload.decode()} C")
+                self.last_temperature = float(payload)
+                self._publish_aggregate()
                 return temp
             else:
                 print(f"Climate: Unrealistic temperature reading: {temp}. Ignoring.")
@@ -216,39 +232,64 @@ class ClimateManager:
             self.set_heating(False, source="auto")
             self.set_conditioning(False, source="auto")
 
-    def mqtt_callback(self, topic, msg):
+    def _on_heating_command(self, topic, msg):
         """
-        Callback function for handling incoming MQTT messages.
+        Handles the MQTT heating command, which disables auto mode.
 
         :param topic: The topic the message was received on.
         :type topic: bytes
-        :param msg: The message payload.
-        :type msg: bytes
+        :param msg: The message payload, ``b"ON"`` or ``b"OFF"``.
+        :type msg: memoryview
         """
-        print(f"Climate: MQTT received: {topic.decode()} = {msg.decode()}")
-        
-        if topic == TOPIC_RISC_CMD:
-            self.auto_mode = False
-            self.set_heating(msg == b"ON", source="mqtt")
-        elif topic == TOPIC_ARIA_CMD:
-            self.auto_mode = False
-            self.set_conditioning(msg == b"ON", source="mqtt")
-        elif topic == TOPIC_AUTO_MODE_CMD:
-            self.auto_mode = (msg == b"ON")
-            print(f"Climate: Auto mode set to: {self.auto_mode}")
-            # Immediately evaluate logic if auto mode is turned on
+        self.auto_mode = False
+        self.set_heating(msg == b"ON", source="mqtt")
+
+    def _on_conditioning_command(self, topic, msg):
+        """
+        Handles the MQTT air conditioning command, which disables auto mode.
+
+        :param topic: The topic the message was received on.
+        :type topic: bytes
+        :param msg: The message payload, ``b"ON"`` or ``b"OFF"``.
+        :type msg: memoryview
+        """
+        self.auto_mode = False
+        self.set_conditioning(msg == b"ON", source="mqtt")
+
+    def _on_auto_mode_command(self, topic, msg):
+        """
+        Handles the MQTT auto mode command.
+
+        :param topic: The topic the message was received on.
+        :type topic: bytes
+        :param msg: The message payload, ``b"ON"`` or ``b"OFF"``.
+        :type msg: memoryview
+        """
+        self.auto_mode = (msg == b"ON")
+        print(f"Climate: Auto mode set to: {self.auto_mode}")
+        # Immediately evaluate logic if auto mode is turned on
+        if self.auto_mode:
+            temp = self.read_and_publish_temperature()
+            self.evaluate_auto_logic(temp)
+
+    def _on_desired_temperature_command(self, topic, msg):
+        """
+        Handles the MQTT desired temperature command.
+
+        :param topic: The topic the message was received on.
+        :type topic: bytes
+        :param msg: The temperature, e.g. ``b"22.0"``.
+        :type msg: memoryview
+        """
+        msg = bytes(msg)
+        try:
+            self.desired_temperature = float(msg)
+            print(f"Climate: Desired temperature set to: {self.desired_temperature}")
             if self.auto_mode:
                 temp = self.read_and_publish_temperature()
                 self.evaluate_auto_logic(temp)
-        elif topic == TOPIC_DES_TEMP_CMD:
-            try:
-                self.desired_temperature = float(msg)
-                print(f"Climate: Desired temperature set to: {self.desired_temperature}")
-                if self.auto_mode:
-                    temp = self.read_and_publish_temperature()
-                    self.evaluate_auto_logic(temp)
-            except (ValueError, TypeError):
-                print(f"Climate: Invalid desired temperature value: {msg}")
+        except (ValueError, TypeError):
+            print(f"Climate: Invalid desired temperature value: {msg}")
 
     def _is_debounced(self, min_interval_ms=1000):
         """Checks if the time since last interrpt is sufficient"""
@@ -286,16 +327,13 @@ async def temperature_loop(manager):
         await uasyncio.sleep(TEMP_PUBLISH_INTERVAL)
 
 
-async def mqtt_loop(client):
-    """Periodically checks for incoming MQTT messages."""
-    while True:
-        try:
-            client.check_msg()
-        except Exception as e:
-            print(f"Climate: MQTT check_msg error: {e}. Reconnecting...")
-            await uasyncio.sleep(5)
-            machine.reset()
-        await uasyncio.sleep_ms(200)
+async def mqtt_loop(client, subscriptions):
+    """
+    Dispatches incoming MQTT messages as they arrive, reconnects with backoff
+    when the link drops. The retained commands of the QoS 0 subscriptions
+    are replayed when the broker resumed the session.
+    """
+    await mqtt.ReconnectManager(client, on_connect=mqtt.replay_retained(client, subscriptions)).run()
 
 async def button_handler_task(manager):
     while True:
@@ -320,11 +358,17 @@ async def main():
     try:
         manager = ClimateManager()
         wifi.connect_wifi(WIFI_SSID, WIFI_PASS)
+        router = mqtt.TopicRouter()
+        router.register(manager)
         mqtt_client = mqtt.connect_mqtt(
             MQTT_CLIENT_ID,
             MQTT_BROKER,
-            callback=manager.mqtt_callback,
-            subscriptions=MQTT_SUBSCRIPTIONS
+            callback=router.dispatch,
+            subscriptions=router.subscriptions(),
+            persistent=True,
+            outbox_file=MQTT_OUTBOX_FILE,
+            stats=True,
+            node="climate"
         )
         manager.set_mqtt_client(mqtt_client)
         manager.publish_initial_states()
@@ -332,14 +376,15 @@ async def main():
         print("Climate: Application running. Starting tasks.")
         await uasyncio.gather(
             temperature_loop(manager),
-            mqtt_loop(mqtt_client),
+            mqtt_loop(mqtt_client, router.subscriptions()),
+            mqtt.publish_stats(mqtt_client),
             button_handler_task(manager),
         )
 
     except Exception as e:
         print(f"Climate: A fatal error occurred in main: {e}")
         await uasyncio.sleep(10)
-        machine.reset()
+        reset()
 
 # Run the application
 if __name__ == "__main__":
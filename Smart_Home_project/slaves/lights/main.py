@@ -13,10 +13,10 @@ import time
 import uasyncio
 
 # MicroPython-specific imports
-from machine import Pin
+from machine import Pin, reset
 
 # Local application/library specific imports
-from smarthome.common import wifi, mqtt
+from smarthome.common import wifi, mqtt, aggregate
 
 # ==============================
 # CONFIGURATION
@@ -28,6 +28,8 @@ WIFI_PASS = "YOUR_WIFI_PASSWORD"
 # --- MQTT Configuration ---
 MQTT_BROKER = "YOUR_MQTT_BROKER_IP"
 MQTT_CLIENT_ID = "esp32-lights-slave"
+MQTT_OUTBOX_FILE = "outbox.bin"  # Messages published while offline, sent once reconnected
+MQTT_AGGREGATE_STATE = True     # Also publish all states in one binary message (common/aggregate.py), see MQTT_AGGREGATE_NODES of the master
 
 # --- Hardware and Device Mapping ---
 # This dictionary maps a light's name to its specific configuration.
@@ -41,13 +43,15 @@ LIGHTS_CONFIG = {
 # Automatically create the topics based on the lights' names.
 MQTT_COMMAND_TOPICS = {f"home/led/{name}/command".encode(): name for name in LIGHTS_CONFIG}
 MQTT_STATE_TOPICS = {name: f"home/led/{name}/state".encode() for name in LIGHTS_CONFIG}
-MQTT_SUBSCRIPTIONS = list(MQTT_COMMAND_TOPICS.keys())
 
 
 class LightsManager:
     """
     Manages the state and hardware for all lights connected to this board.
     """
+    # Incoming MQTT messages: (topic filter, QoS, handler method)
+    MQTT_ROUTES = tuple((topic, 0, "_on_command") for topic in MQTT_COMMAND_TOPICS)
+
     def __init__(self, config):
         """
         Initializes the LightsManager.
@@ -59,6 +63,7 @@ class LightsManager:
         self.states = {name: False for name in config}
         self.pins = {}
         self.mqtt_client = None
+        self.aggregate = aggregate.AggregatePublisher(b"lights") if MQTT_AGGREGATE_STATE else None
         self._last_irq_time = 0 # For debouncing all buttons
 
         self._setup_pins()
@@ -131,6 +136,8 @@ class LightsManager:
         try:
             self.mqtt_client.publish(topic, msg, retain=True)
             print(f"→ MQTT: Published {topic.decode()} = {msg.decode()}")
+            if self.aggregate:
+                self.aggregate.publish(self.mqtt_client, self.states)
         except Exception as e:
             print(f"Lights: MQTT publish error for {name}: {e}")
 
@@ -140,14 +147,14 @@ class LightsManager:
         for name in self.states:
             self.publish_state(name)
 
-    def mqtt_callback(self, topic, msg):
+    def _on_command(self, topic, msg):
         """
-        Callback function for handling incoming MQTT messages.
+        Handles the MQTT command of a light.
 
         :param topic: The topic the message was received on.
         :type topic: bytes
         :param msg: The message payload.
-        :type msg: bytes
+        :type msg: memoryview
         """
         name = MQTT_COMMAND_TOPICS.get(topic)
         if name:
@@ -181,16 +188,13 @@ class LightsManager:
                     self.button_events[name].set()
                     break
 
-async def mqtt_loop(client):
-    """Periodically checks for incoming MQTT messages."""
-    while True:
-        try:
-            client.check_msg()
-        except Exception as e:
-            print(f"Climate: MQTT check_msg error: {e}. Reconnecting...")
-            await uasyncio.sleep(5)
-            machine.reset()
-        await uasyncio.sleep_ms(200)
+async def mqtt_loop(client, subscriptions):
+    """
+    Dispatches incoming MQTT messages as they arrive, reconnects with backoff
+    when the link drops. The retained commands of the QoS 0 subscriptions
+    are replayed when the broker resumed the session.
+    """
+    await mqtt.ReconnectManager(client, on_connect=mqtt.replay_retained(client, subscriptions)).run()
 
 async def button_handler_task(manager):
     """
@@ -224,11 +228,17 @@ async def main():
         wifi.connect_wifi(WIFI_SSID, WIFI_PASS)
 
         # 3. Connect to MQTT
+        router = mqtt.TopicRouter()
+        router.register(manager)
         mqtt_client = mqtt.connect_mqtt(
             MQTT_CLIENT_ID,
             MQTT_BROKER,
-            callback=manager.mqtt_callback,
-            subscriptions=MQTT_SUBSCRIPTIONS
+            callback=router.dispatch,
+            subscriptions=router.subscriptions(),
+            persistent=True,
+            outbox_file=MQTT_OUTBOX_FILE,
+            stats=True,
+            node="lights"
         )
         manager.set_mqtt_client(mqtt_client)
         
@@ -239,13 +249,14 @@ async def main():
         print("Lights: Application running. Waiting for button presses and MQTT messages.")
         
         await uasyncio.gather(
-            mqtt_loop(mqtt_client),
+            mqtt_loop(mqtt_client, router.subscriptions()),
+            mqtt.publish_stats(mqtt_client),
             button_handler_task(manager),
         )
     except Exception as e:
         print(f"Lights: A fatal error occurred: {e}")
         await uasyncio.time.sleep(10)
-        machine.reset()
+        reset()
 
 # Run the application
 if __name__ == "__main__":
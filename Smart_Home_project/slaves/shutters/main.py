@@ -29,6 +29,7 @@ WIFI_PASS = "YOUR_WIFI_PASSWORD"
 # --- MQTT Configuration ---
 MQTT_BROKER = "YOUR_MQTT_BROKER_IP"
 MQTT_CLIENT_ID = "esp32-shutters-slave"
+MQTT_OUTBOX_FILE = "outbox.bin"  # Messages published while offline, sent once reconnected
 
 # --- Hardware Pin Configuration ---
 PIN_BTN_UP = 9
@@ -42,13 +43,18 @@ MOTOR_RUN_TIME_MS = 2000  # Milliseconds to run the motor for a full open/close
 # --- MQTT Topics ---
 TOPIC_CMD = b"home/actuator/tapparella/set"
 TOPIC_STATE = b"home/actuator/tapparella/state" # Reports open, closed, moving
-MQTT_SUBSCRIPTIONS = [TOPIC_CMD]
 
 
 class ShuttersManager:
     """
     Manages the state and hardware for the window shutters.
     """
+    # Incoming MQTT messages: (topic filter, QoS, handler method).
+    # QoS 2: a motor command must run exactly once.
+    MQTT_ROUTES = (
+        (TOPIC_CMD, 2, "_on_command"),
+    )
+
     def __init__(self):
         """Initializes the ShuttersManager."""
         self.mqtt_client = None
@@ -146,20 +152,19 @@ class ShuttersManager:
         self.motor_task = None
         print(f"Shutters: Shutter move '{direction}' complete.")
 
-    def mqtt_callback(self, topic, msg):
+    def _on_command(self, topic, msg):
         """
-        Callback for handling incoming MQTT messages.
+        Handles the MQTT up/down commands.
 
         :param topic: The topic the message was received on.
         :type topic: bytes
         :param msg: The message payload.
-        :type msg: bytes
+        :type msg: memoryview
         """
-        if topic == TOPIC_CMD:
-            direction = msg.decode().strip().lower()
-            print(f"Shutters: MQTT command received: {direction}")
-            if direction in ["up", "down"]:
-                self.move_shutter(direction)
+        direction = bytes(msg).strip().lower()
+        print(f"Shutters: MQTT command received: {direction}")
+        if direction in (b"up", b"down"):
+            self.move_shutter(direction.decode())
 
     def _is_debounced(self, min_interval_ms=1000):
         """Checks if the time since last interrpt is sufficient"""
@@ -184,16 +189,13 @@ class ShuttersManager:
                 self.btn_down_triggered_event.set()
 
 
-async def mqtt_loop(client):
-    """Periodically checks for incoming MQTT messages."""
-    while True:
-        try:
-            client.check_msg()
-        except Exception as e:
-            print(f"Shutters: MQTT check_msg error: {e}. Resetting...")
-            await uasyncio.sleep(5)
-            reset()
-        await uasyncio.sleep_ms(200)
+async def mqtt_loop(client, subscriptions):
+    """
+    Dispatches incoming MQTT messages as they arrive, reconnects with backoff
+    when the link drops. The retained commands of the QoS 0 subscriptions
+    are replayed when the broker resumed the session.
+    """
+    await mqtt.ReconnectManager(client, on_connect=mqtt.replay_retained(client, subscriptions)).run()
 
 
 async def button_handler_task(manager):
@@ -221,11 +223,17 @@ async def main():
     try:
         manager = ShuttersManager()
         wifi.connect_wifi(WIFI_SSID, WIFI_PASS)
+        router = mqtt.TopicRouter()
+        router.register(manager)
         mqtt_client = mqtt.connect_mqtt(
             MQTT_CLIENT_ID,
             MQTT_BROKER,
-            callback=manager.mqtt_callback,
-            subscriptions=MQTT_SUBSCRIPTIONS
+            callback=router.dispatch,
+            subscriptions=router.subscriptions(),
+            persistent=True,
+            outbox_file=MQTT_OUTBOX_FILE,
+            stats=True,
+            node="shutters"
         )
         manager.set_mqtt_client(mqtt_client)
         
@@ -236,7 +244,8 @@ async def main():
         # The only background task needed is the MQTT loop.
         # Motor control is handled by tasks created on-demand.
         await uasyncio.gather(
-            mqtt_loop(mqtt_client),
+            mqtt_loop(mqtt_client, router.subscriptions()),
+            mqtt.publish_stats(mqtt_client),
             button_handler_task(manager),
         )
 
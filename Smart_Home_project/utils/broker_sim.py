@@ -0,0 +1,221 @@
+"""
+Simulation of the embedded broker with several clients, under CPython::
+
+    python Smart_Home_project/utils/broker_sim.py [clients] [messages]
+
+The broker of common/broker.py is started on a free local port, next to an
+in-process client of the master, and simulated nodes connect to it over
+TCP. Each scenario checks the deliveries and prints "ok" or what went
+wrong; the last one measures the routing throughput with every simulated
+client publishing at once.
+"""
+
+import asyncio
+import os
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.broker import Broker
+
+
+def _str(s):
+    return struct.pack("!H", len(s)) + s
+
+
+def _packet(op, body):
+    head = bytearray((op,))
+    size = len(body)
+    while True:
+        b = size & 0x7F
+        size >>= 7
+        head.append(b | 0x80 if size else b)
+        if not size:
+            return bytes(head) + body
+
+
+class SimClient:
+    """A node: connects, subscribes, publishes, and records what it receives."""
+    def __init__(self, port, client_id):
+        self.port = port
+        self.client_id = client_id
+        self.received = []  # (topic, msg, qos, retain)
+        self.session_present = None
+        self._pid = 0
+        self._acks = {}
+        self._task = None
+
+    async def connect(self, clean=True, will=None, keepalive=0):
+        self.reader, self.writer = await asyncio.open_connection("127.0.0.1", self.port)
+        flags = clean << 1
+        payload = _str(self.client_id)
+        if will:
+            flags |= 0x04 | will[2] << 3
+            payload += _str(will[0]) + _str(will[1])
+        self.writer.write(_packet(0x10, _str(b"MQTT") + bytes((4, flags)) + struct.pack("!H", keepalive) + payload))
+        connack = await self.reader.readexactly(4)
+        assert connack[3] == 0, connack
+        self.session_present = bool(connack[2] & 1)
+        self._task = asyncio.ensure_future(self._read_loop())
+
+    async def _read_loop(self):
+        try:
+            while True:
+                op = (await self.reader.readexactly(1))[0]
+                size = shift = 0
+                while True:
+                    b = (await self.reader.readexactly(1))[0]
+                    size |= (b & 0x7F) << shift
+                    shift += 7
+                    if not b & 0x80:
+                        break
+                data = await self.reader.readexactly(size) if size else b""
+                if op & 0xF0 == 0x30:
+                    n = data[0] << 8 | data[1]
+                    qos = op >> 1 & 3
+                    i = 2 + n
+                    if qos:
+                        self.writer.write(_packet(0x40, data[i : i + 2]))
+                        i += 2
+                    self.received.append((data[2 : 2 + n], data[i:], qos, bool(op & 1)))
+                elif op in (0x40, 0x90, 0xB0):
+                    future = self._acks.pop(data[0] << 8 | data[1], None)
+                    if future:
+                        future.set_result(data[2:])
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+
+    def _request(self):
+        self._pid += 1
+        future = asyncio.get_event_loop().create_future()
+        self._acks[self._pid] = future
+        return self._pid, future
+
+    async def subscribe(self, *filters):
+        pid, future = self._request()
+        body = struct.pack("!H", pid) + b"".join(_str(f) + bytes((q,)) for f, q in filters)
+        self.writer.write(_packet(0x82, body))
+        return await future
+
+    async def publish(self, topic, msg, qos=0, retain=False):
+        op = 0x30 | qos << 1 | retain
+        if not qos:
+            self.writer.write(_packet(op, _str(topic) + msg))
+            return
+        pid, future = self._request()
+        self.writer.write(_packet(op, _str(topic) + struct.pack("!H", pid) + msg))
+        await future
+
+    async def disconnect(self, clean=True):
+        if clean:
+            self.writer.write(b"\xe0\x00")
+        self.writer.close()
+        self._task.cancel()
+
+
+async def _settle():
+    await asyncio.sleep(0.05)
+
+
+def _check(name, ok, detail=""):
+    print(f"{name:<40} {'ok' if ok else 'FAILED ' + str(detail)}")
+    return ok
+
+
+async def scenarios(port, broker, local_messages):
+    results = []
+    a = SimClient(port, b"lights")
+    await a.connect()
+    await a.publish(b"home/led/cucina/state", b"ON", retain=True)
+    await a.publish(b"home/led/soggiorno/state", b"OFF", qos=1, retain=True)
+
+    b = SimClient(port, b"display")
+    await b.connect()
+    granted = await b.subscribe((b"home/led/+/state", 1), (b"home/#", 2), (b"bad/#/x", 0))
+    await _settle()
+    results.append(_check("subscribe grants QoS 0/1 only", granted == b"\x01\x01\x80", granted))
+    retained = sorted(m for m in b.received if m[3])
+    results.append(_check("retained messages on subscribe", len(retained) == 2 and retained[0][1] == b"ON", retained))
+
+    b.received.clear()
+    await a.publish(b"home/led/camera/state", b"ON", qos=1)
+    await _settle()
+    results.append(_check("one copy per client, highest QoS", b.received == [(b"home/led/camera/state", b"ON", 1, False)], b.received))
+
+    results.append(_check("local client gets remote messages", (b"home/led/camera/state", b"ON") in local_messages, local_messages))
+    a.received.clear()
+    await a.subscribe((b"home/led/+/command", 1))
+    broker.local.publish(b"home/led/cucina/command", b"OFF", qos=2)
+    await _settle()
+    results.append(_check("local publish reaches the nodes", a.received == [(b"home/led/cucina/command", b"OFF", 1, False)], a.received))
+
+    c = SimClient(port, b"shutters")
+    await c.connect(clean=False)
+    await c.subscribe((b"home/actuator/#", 1))
+    await c.disconnect()
+    await _settle()
+    await a.publish(b"home/actuator/tapparella/set", b"UP", qos=1)
+    await a.publish(b"home/actuator/tapparella/pos", b"50")
+    c = SimClient(port, b"shutters")
+    await c.connect(clean=False)
+    await _settle()
+    results.append(_check("persistent session keeps QoS 1 messages", c.session_present and [m[1] for m in c.received] == [b"UP"], c.received))
+
+    d = SimClient(port, b"alarm")
+    await d.connect(will=(b"home/status/alarm", b"offline", 1))
+    await d.disconnect(clean=False)
+    await _settle()
+    results.append(_check("will published on a dropped connection", (b"home/status/alarm", b"offline", 1, False) in b.received, b.received))
+
+    for client in (a, b, c):
+        await client.disconnect()
+    await _settle()
+    return all(results)
+
+
+async def load(port, clients, messages):
+    sink = SimClient(port, b"sink")
+    await sink.connect()
+    await sink.subscribe((b"home/+/value", 0))
+    nodes = [SimClient(port, f"node{i}".encode()) for i in range(clients)]
+    for node in nodes:
+        await node.connect()
+    expected = clients * messages
+    start = time.perf_counter()
+
+    async def burst(node, i):
+        for n in range(messages):
+            await node.publish(f"home/node{i}/value".encode(), b"%d" % n, qos=n & 1)
+
+    await asyncio.gather(*(burst(node, i) for i, node in enumerate(nodes)))
+    while len(sink.received) < expected and time.perf_counter() - start < 10:
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    _check(f"{clients} clients x {messages} messages", len(sink.received) == expected, f"{len(sink.received)}/{expected}")
+    print(f"{'routed':<40} {int(len(sink.received) / elapsed):>9} /s")
+    for node in nodes + [sink]:
+        await node.disconnect()
+    await _settle()
+
+
+async def main(clients, messages):
+    broker = Broker(port=0, host="127.0.0.1", max_clients=clients + 1, max_queue=messages * clients)
+    local_messages = []
+    broker.local = broker.local_client("master", lambda topic, msg: local_messages.append((topic, msg)))
+    broker.local.subscribe_many([(b"home/led/+/state", 0)])
+    server = await broker.start()
+    port = server.sockets[0].getsockname()[1]
+    local = asyncio.ensure_future(broker.local.run())
+    ok = await scenarios(port, broker, local_messages)
+    await load(port, clients, messages)
+    local.cancel()
+    server.close()
+    return ok
+
+
+if __name__ == "__main__":
+    args = [int(a) for a in sys.argv[1:3]]
+    ok = asyncio.run(main(*(args + [8, 200][len(args):])))
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,455 @@
+"""
+Micro-benchmarks for the bundled umqtt client.
+
+Runs under CPython (from the repository root) or on a board::
+
+    PYTHONPATH=lib python Smart_Home_project/utils/mqtt_bench.py [name ...]
+
+With no argument every benchmark is run. The client talks to an in-memory
+socket, so the numbers measure the client itself and not the network.
+"""
+
+import gc
+import struct
+import sys
+import time
+
+from umqtt.simple import MQTTClient
+
+
+try:
+    _ticks_us = time.ticks_us
+    _ticks_diff = time.ticks_diff
+except AttributeError:  # CPython
+    def _ticks_us():
+        return int(time.perf_counter() * 1000000)
+
+    def _ticks_diff(a, b):
+        return a - b
+
+
+class NullSocket:
+    """Socket stand-in that swallows writes and counts them."""
+    def __init__(self):
+        self.writes = 0
+        self.bytes = 0
+
+    def write(self, buf, n=None):
+        n = len(buf) if n is None else n
+        self.writes += 1
+        self.bytes += n
+        return n
+
+    def setblocking(self, flag):
+        pass
+
+
+class BufferSocket:
+    """Socket stand-in whose reads return the given bytes, then EOF."""
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def read(self, n):
+        res = self.data[self.pos : self.pos + n]
+        self.pos += len(res)
+        return res
+
+    def setblocking(self, flag):
+        pass
+
+
+def _client(sock):
+    client = MQTTClient("bench", "localhost")
+    client.sock = sock
+    return client
+
+
+def _legacy_publish(client, topic, msg, retain=False, qos=0):
+    # PUBLISH as sent before packets were assembled in one buffer
+    pkt = bytearray(b"\x30\0\0\0")
+    pkt[0] |= qos << 1 | retain
+    sz = 2 + len(topic) + len(msg)
+    if qos > 0:
+        sz += 2
+    i = 1
+    while sz > 0x7F:
+        pkt[i] = (sz & 0x7F) | 0x80
+        sz >>= 7
+        i += 1
+    pkt[i] = sz
+    client.sock.write(pkt, i + 1)
+    client.sock.write(struct.pack("!H", len(topic)))
+    client.sock.write(topic)
+    if qos > 0:
+        client.pid += 1
+        struct.pack_into("!H", pkt, 0, client.pid)
+        client.sock.write(pkt, 2)
+    client.sock.write(msg)
+
+
+def _rate(label, count, f, per_call=1):
+    start = _ticks_us()
+    for _ in range(count):
+        f()
+    elapsed = _ticks_diff(_ticks_us(), start) or 1
+    rate = count * per_call * 1000000 // elapsed
+    print(f"{label:<40} {rate:>9} /s")
+    return rate
+
+
+def bench_publish(count=20000):
+    """PUBLISH packets per second, legacy multi-write vs single write."""
+    cases = [
+        ("state", b"home/led/soggiorno/state", b"ON", 0),
+        ("temperature", b"home/status/temperature", b"21.5", 0),
+        ("state qos1", b"home/led/soggiorno/state", b"OFF", 1),
+    ]
+    for name, topic, msg, qos in cases:
+        for label, publish in (("legacy", _legacy_publish), ("single write", None)):
+            sock = NullSocket()
+            client = _client(sock)
+            if publish is None:
+                f = lambda: client._send_publish(topic, msg, True, qos)
+            else:
+                f = lambda: publish(client, topic, msg, True, qos)
+            _rate(f"publish {name} ({label})", count, f)
+            print(f"{'':<40} {sock.writes / count:>9.1f} writes/packet")
+
+
+def _legacy_wait_msg(client):
+    # PUBLISH reception as done before the receive buffer: one socket read
+    # (and one bytes object) per field, topic and message
+    res = client.sock.read(1)
+    sz = 0
+    sh = 0
+    while 1:
+        b = client.sock.read(1)[0]
+        sz |= (b & 0x7F) << sh
+        if not b & 0x80:
+            break
+        sh += 7
+    topic_len = client.sock.read(2)
+    topic_len = (topic_len[0] << 8) | topic_len[1]
+    topic = client.sock.read(topic_len)
+    sz -= topic_len + 2
+    if res[0] & 6:
+        pid = client.sock.read(2)
+        sz -= 2
+    msg = client.sock.read(sz)
+    client.cb(topic, msg)
+
+
+def _publish_packet(topic, msg):
+    return bytes((0x30, 2 + len(topic) + len(msg), 0, len(topic))) + topic + msg
+
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+def _allocated(f, count):
+    """
+    Bytes allocated per call of f. On MicroPython this is the total, read
+    from the heap with the collector off; CPython frees objects as soon as
+    they are unused, so there it is the peak traced by tracemalloc.
+    """
+    if tracemalloc is None:
+        gc.collect()
+        gc.disable()
+        before = gc.mem_alloc()
+        for _ in range(count):
+            f()
+        total = gc.mem_alloc() - before
+        gc.enable()
+        return total / count
+    tracemalloc.start()
+    total = 0
+    for _ in range(count):
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        f()
+        total += tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+    return total / count
+
+
+def bench_receive(count=2000):
+    """
+    Received PUBLISH packets per second and bytes allocated per message.
+
+    Under CPython a memoryview object takes about 180 bytes, more than the
+    bytes copies of a short topic and payload, so there only the rate shows
+    the gain of memoryviews. On MicroPython one takes a few words.
+    """
+    batch = 16  # as umqtt.aio dispatches them
+    stream = _publish_packet(b"home/led/soggiorno/set", b"ON") * batch
+
+    def legacy(n):
+        client = _client(BufferSocket(stream))
+        client.set_callback(lambda topic, msg: None)
+
+        def f():
+            client.sock.pos = 0
+            for _ in range(n):
+                _legacy_wait_msg(client)
+        return f
+
+    def buffered(n, copy):
+        client = _client(None)
+        client.set_callback(lambda topic, msg: None, copy)
+        client._rbuf[: len(stream)] = stream
+
+        def f():
+            # Rewind instead of reading: the same as a readinto() of the
+            # batch, which doesn't allocate on a real socket
+            client._rpos = 0
+            client._rlen = len(stream)
+            client._process(n)
+        return f
+
+    for label, make in (
+        ("legacy reads", legacy),
+        ("buffer, bytes copies", lambda n: buffered(n, True)),
+        ("buffer, memoryviews", lambda n: buffered(n, False)),
+    ):
+        _rate(f"receive ({label})", count, make(batch), batch)
+        # One message per call, so that on CPython the peak is the memory
+        # held while one message is handled
+        print(f"{'':<40} {_allocated(make(1), count):>9.1f} bytes/message")
+
+
+class StreamSocket:
+    """MicroPython-style stream methods over a CPython socket."""
+    def __init__(self, sock):
+        self.sock = sock
+
+    def write(self, buf, n=None):
+        buf = memoryview(buf)[:n] if n is not None else buf
+        self.sock.sendall(buf)
+        return len(buf)
+
+    def read(self, n):
+        res = b""
+        while len(res) < n:
+            data = self.sock.recv(n - len(res))
+            if not data:
+                break
+            res += data
+        return res
+
+    def readinto(self, buf, n=None):
+        try:
+            return self.sock.recv_into(buf, n or len(buf))
+        except BlockingIOError:
+            return None
+
+    def setblocking(self, flag):
+        self.sock.setblocking(flag)
+
+    def settimeout(self, timeout):
+        self.sock.settimeout(timeout)
+
+    def connect(self, addr):
+        self.sock.connect(addr)
+
+    def close(self):
+        self.sock.close()
+
+    @property
+    def session(self):
+        return getattr(self.sock, "session", None)
+
+
+class StreamSSLContext:
+    """SSL context whose sockets have the MicroPython-style stream methods."""
+    def __init__(self, context):
+        self.context = context
+        self.resumed = 0
+
+    def wrap_socket(self, sock, server_hostname=None, session=None):
+        tls = self.context.wrap_socket(sock.sock, server_hostname=server_hostname, session=session)
+        self.resumed += tls.session_reused
+        return StreamSocket(tls)
+
+
+def _broker_stand_in(sock, latency_ms):
+    # Answers every SUBSCRIBE with a SUBACK granting the requested QoS,
+    # after latency_ms (the round-trip time of a real broker on Wi-Fi)
+    stream = StreamSocket(sock)
+    while 1:
+        head = stream.read(1)
+        if not head:
+            sock.close()
+            return
+        sz = 0
+        sh = 0
+        while 1:
+            b = stream.read(1)[0]
+            sz |= (b & 0x7F) << sh
+            if not b & 0x80:
+                break
+            sh += 7
+        body = stream.read(sz)
+        if head[0] == 0x82:
+            codes = bytearray()
+            i = 2
+            while i < len(body):
+                i += 2 + (body[i] << 8 | body[i + 1])
+                codes.append(body[i])
+                i += 1
+            time.sleep(latency_ms / 1000)
+            stream.write(bytes((0x90, 2 + len(codes))) + body[:2] + codes)
+
+
+def bench_connect(rounds=20, latency_ms=5):
+    """Subscription phase of connect_mqtt(): one SUBSCRIBE per topic vs one for all."""
+    try:
+        import socket
+        import _thread
+        socket.socketpair
+    except (ImportError, AttributeError):
+        print("needs CPython (socketpair and threads)")
+        return
+    for count in (3, 8):
+        filters = [(f"home/led/device{i}/state".encode(), i % 3) for i in range(count)]
+        for label, many in (("one per topic", False), ("single packet", True)):
+            a, b = socket.socketpair()
+            _thread.start_new_thread(_broker_stand_in, (b, latency_ms))
+            client = _client(StreamSocket(a))
+            client.set_callback(lambda topic, msg: None)
+            start = _ticks_us()
+            for _ in range(rounds):
+                if many:
+                    client.subscribe_many(filters)
+                else:
+                    for topic, qos in filters:
+                        client.subscribe(topic, qos)
+            elapsed = _ticks_diff(_ticks_us(), start) / rounds / 1000
+            a.close()
+            print(f"{f'subscribe {count} topics ({label})':<40} {elapsed:>9.1f} ms")
+
+
+def _tls_broker_stand_in(server, context):
+    # Answers every CONNECT with a CONNACK, over TLS
+    while 1:
+        try:
+            sock, _ = server.accept()
+        except OSError:
+            return
+        if context:
+            try:
+                sock = context.wrap_socket(sock, server_side=True)
+            except OSError:
+                sock.close()
+                continue
+        # One CONNECT per connection, small enough for a single read
+        try:
+            if sock.recv(256):
+                sock.sendall(b"\x20\x02\x00\x00")
+            while sock.recv(256):
+                pass
+        except OSError:
+            pass
+        sock.close()
+
+
+def bench_tls(rounds=50):
+    """
+    connect() time in plaintext, with a full TLS handshake and with a resumed
+    TLS session. CPython only: the ssl module of MicroPython can't resume a
+    session, so on the nodes every reconnection is a full handshake.
+    """
+    try:
+        import os
+        import shutil
+        import socket
+        import ssl
+        import subprocess
+        import tempfile
+        import _thread
+    except ImportError:
+        print("needs CPython (ssl, threads and the openssl tool)")
+        return
+    import umqtt.simple
+
+    tmp = tempfile.mkdtemp()
+    cert = os.path.join(tmp, "broker.pem")
+    key = os.path.join(tmp, "broker.key")
+    try:
+        # P-256, as commonly used with mbedTLS on the ESP32
+        subprocess.run(
+            ["openssl", "req", "-x509", "-newkey", "ec", "-pkeyopt", "ec_paramgen_curve:prime256v1",
+             "-nodes", "-keyout", key, "-out", cert, "-subj", "/CN=broker", "-days", "1"],
+            check=True, capture_output=True)
+        server_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        server_context.load_cert_chain(cert, key)
+    except (OSError, subprocess.CalledProcessError):
+        print("needs the openssl tool to create a certificate")
+        return
+    finally:
+        shutil.rmtree(tmp)
+
+    plain_socket = umqtt.simple.socket
+
+    class SocketModule:
+        getaddrinfo = staticmethod(plain_socket.getaddrinfo)
+
+        @staticmethod
+        def socket():
+            return StreamSocket(plain_socket.socket())
+
+    umqtt.simple.socket = SocketModule
+    try:
+        for label, tls, resume in (
+            ("plaintext", False, False),
+            ("TLS, full handshake", True, False),
+            ("TLS, resumed session", True, True),
+        ):
+            server = socket.socket()
+            server.bind(("127.0.0.1", 0))
+            server.listen(4)
+            _thread.start_new_thread(_tls_broker_stand_in, (server, server_context if tls else None))
+            context = None
+            if tls:
+                client_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+                client_context.check_hostname = False
+                client_context.verify_mode = ssl.CERT_NONE
+                context = StreamSSLContext(client_context)
+            client = MQTTClient(b"bench", "127.0.0.1", server.getsockname()[1], ssl=context)
+            # First connection outside the measure: it fills the session cache
+            client.connect()
+            client.sock.close()
+            start = _ticks_us()
+            for _ in range(rounds):
+                if not resume:
+                    client.ssl_session = None
+                client.connect()
+                client.sock.close()
+            elapsed = _ticks_diff(_ticks_us(), start) / rounds / 1000
+            server.close()
+            print(f"{f'reconnect ({label})':<40} {elapsed:>9.2f} ms")
+            if context:
+                print(f"{'':<40} {context.resumed:>9} resumed")
+    finally:
+        umqtt.simple.socket = plain_socket
+
+
+BENCHMARKS = {
+    "publish": bench_publish,
+    "receive": bench_receive,
+    "connect": bench_connect,
+    "tls": bench_tls,
+}
+
+
+def main(names):
+    for name in names or BENCHMARKS:
+        print(f"--- {name}")
+        BENCHMARKS[name]()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
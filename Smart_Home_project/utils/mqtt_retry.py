@@ -1,12 +1,21 @@
+import random
 import time
 from umqtt.simple import MQTTClient as BaseMQTTClient
 
 class MQTTClient(BaseMQTTClient):
-    DELAY = 2
+    # Delay before the first reconnection attempt, doubled after every
+    # failure up to MAX_DELAY (seconds)
+    DELAY = 0.5
+    MAX_DELAY = 30
     DEBUG = True
 
+    # Capped exponential backoff, randomised between half and all of the
+    # nominal delay so clients don't retry in lockstep. Asyncio code should
+    # use umqtt.aio with smarthome.common.mqtt.ReconnectManager instead,
+    # which waits without blocking the event loop.
     def delay(self, i):
-        time.sleep(self.DELAY)
+        delay = min(self.DELAY * (1 << min(i - 1, 16)), self.MAX_DELAY)
+        time.sleep(delay / 2 * (1 + random.getrandbits(16) / 65536))
 
     def log(self, in_reconnect, e):
         if self.DEBUG:
@@ -15,20 +24,32 @@ class MQTTClient(BaseMQTTClient):
             else:
                 print("MQTT error:", e)
 
+    # With enable_stats(), the downtime runs from the first error to the
+    # successful connect(), and the publish latency of a message includes
+    # the reconnections it waited for.
     def reconnect(self):
+        if self.stats:
+            self.stats.down()
         i = 0
         while True:
             try:
-                return super().connect(False)
+                present = super().connect(False)
+                if self.stats:
+                    self.stats.up()
+                return present
             except OSError as e:
                 self.log(True, e)
                 i += 1
                 self.delay(i)
 
     def publish(self, topic, msg, retain=False, qos=0):
+        t = time.ticks_ms()
         while True:
             try:
-                return super().publish(topic, msg, retain, qos)
+                super().publish(topic, msg, retain, qos)
+                if self.stats:
+                    self.stats.publish_ms.add(time.ticks_diff(time.ticks_ms(), t))
+                return
             except OSError as e:
                 self.log(False, e)
                 self.reconnect()
@@ -43,10 +64,19 @@ class MQTTClient(BaseMQTTClient):
 
     def check_msg(self, attempts=2):
         while attempts:
-            self.sock.setblocking(False)
             try:
-                return super().wait_msg()
+                return super().check_msg()
+            except OSError as e:
+                self.log(False, e)
+                self.reconnect()
+            attempts -= 1
+
+    def check_msgs(self, budget=16, attempts=2):
+        while attempts:
+            try:
+                return super().check_msgs(budget)
             except OSError as e:
                 self.log(False, e)
                 self.reconnect()
             attempts -= 1
+        return 0
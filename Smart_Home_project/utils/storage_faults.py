@@ -0,0 +1,171 @@
+"""
+Fault injection for the state storage of common/storage.py, under CPython::
+
+    python Smart_Home_project/utils/storage_faults.py [rounds] [seed]
+
+Each round changes some states and saves them like the master does, while a
+simulated reset cuts the writes to flash at a random offset. The storage is
+then loaded again as on boot and must hold the states from before the save
+with a prefix of the changes applied: never a mix of two snapshots, never
+the defaults.
+"""
+
+import contextlib
+import io
+import os
+import random
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common import storage
+from common.storage import SlotFile, StateJournal
+
+
+class Reset(Exception):
+    """The board was reset in the middle of a write."""
+
+
+class FaultyFile:
+    """File that stops writing, and resets the board, past a byte budget."""
+    budget = None
+
+    def __init__(self, f):
+        self.f = f
+
+    def write(self, data):
+        if FaultyFile.budget is not None:
+            if len(data) > FaultyFile.budget:
+                self.f.write(data[: FaultyFile.budget])
+                self.f.close()
+                FaultyFile.budget = None
+                raise Reset()
+            FaultyFile.budget -= len(data)
+        return self.f.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.f.close()
+
+
+def _open(path, mode="r"):
+    f = open(path, mode)
+    return FaultyFile(f) if "w" in mode or "a" in mode else f
+
+
+def _check(name, ok, detail=""):
+    print(f"{name:<40} {'ok' if ok else 'FAILED ' + str(detail)}")
+    return ok
+
+
+def boot(path, max_journal_size):
+    """Loads the states like StateManager._load_states(), without faults."""
+    journal = StateJournal(path, max_journal_size)
+    try:
+        states = journal.load_snapshot()
+    except (OSError, ValueError):
+        states = None
+    if states is not None:
+        journal.replay(states)
+        if journal.needs_compaction():
+            journal.compact(states)
+    return journal, states
+
+
+def random_changes(rng):
+    changes = {}
+    for _ in range(rng.randint(1, 4)):
+        if rng.random() < 0.3:
+            changes["desired_temperature"] = rng.randint(160, 300) / 10
+        else:
+            changes[rng.choice(("soggiorno", "cucina", "camera", "riscaldamento", "auto_mode"))] = rng.random() < 0.5
+    return changes
+
+
+def faults(directory, rounds, rng):
+    path = os.path.join(directory, "states.json")
+    max_journal_size = 200  # Compact every few saves
+    states = {
+        "soggiorno": False,
+        "cucina": False,
+        "camera": False,
+        "riscaldamento": False,
+        "auto_mode": False,
+        "desired_temperature": 22.0,
+    }
+    journal, _ = boot(path, max_journal_size)
+    journal.compact(states)
+    resets = compactions = 0
+    failures = []
+    for n in range(rounds):
+        changes = random_changes(rng)
+        # Acceptable states after a reset: any prefix of the changes applied
+        expected = [dict(states)]
+        for key, value in changes.items():
+            expected.append(dict(expected[-1], **{key: value}))
+        FaultyFile.budget = rng.randint(0, 400) if rng.random() < 0.5 else None
+        try:
+            journal.append(changes)
+            if journal.needs_compaction():
+                compactions += 1
+                journal.compact(expected[-1])
+        except Reset:
+            resets += 1
+        FaultyFile.budget = None
+        journal, states = boot(path, max_journal_size)
+        if states not in expected:
+            failures.append((n, changes, states))
+            states = dict(expected[-1])
+            journal.compact(states)
+    ok = _check(f"{rounds} saves, {resets} resets", not failures, failures[:3])
+    return _check(f"{compactions} compactions", compactions > 0) and ok
+
+
+def corrupt_slot(directory):
+    slots = SlotFile(os.path.join(directory, "corrupt"))
+    slots.read()
+    slots.write(b"first")
+    slots.write(b"second")
+    # Flip a bit of the payload of the latest slot, keeping its size
+    with open(os.path.join(directory, "corrupt.b"), "r+b") as f:
+        f.seek(SlotFile.HEADER_SIZE)
+        f.write(b"S")
+    ok = _check("CRC mismatch falls back to the other slot", SlotFile(os.path.join(directory, "corrupt")).read() == b"first")
+    slots = SlotFile(os.path.join(directory, "corrupt"))
+    slots.read()
+    slots.write(b"third")
+    return _check("next write replaces the corrupt slot", SlotFile(os.path.join(directory, "corrupt")).read() == b"third") and ok
+
+
+def legacy(directory):
+    path = os.path.join(directory, "legacy.json")
+    with open(path, "w") as f:
+        f.write('{"cucina": true}')
+    _, states = boot(path, 4096)
+    ok = _check("old state file moved to the slots", states == {"cucina": True} and not os.path.exists(path), states)
+    _, states = boot(path, 4096)
+    return _check("slots read once the old file is gone", states == {"cucina": True}, states) and ok
+
+
+def main(rounds, seed):
+    rng = random.Random(seed)
+    storage.open = _open
+    with tempfile.TemporaryDirectory() as directory:
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            results = [faults(directory, rounds, rng), corrupt_slot(directory), legacy(directory)]
+    # Only the check lines, not the messages of the storage
+    print("\n".join(line for line in output.getvalue().splitlines() if not line.startswith("Storage:")))
+    return all(results)
+
+
+if __name__ == "__main__":
+    args = [int(a) for a in sys.argv[1:3]]
+    ok = main(*(args + [2000, 1][len(args):]))
+    sys.exit(0 if ok else 1)
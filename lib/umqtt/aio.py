@@ -0,0 +1,432 @@
+import errno
+import time
+import uasyncio as asyncio
+from umqtt.simple import MQTTClient as SimpleMQTTClient
+
+
+# Delivery of a QoS 1 or 2 message, as returned by MQTTClient.publish().
+# done becomes True once the broker acknowledged the message (PUBACK or
+# PUBCOMP); wait() can be
+# awaited for it, and the callback given to publish() is called with the
+# topic at the same time. If the message is dropped from a full queue
+# instead, failed becomes True and wait() returns too, without callback.
+class Delivery:
+    def __init__(self, callback=None):
+        self.done = False
+        self.failed = False
+        self._callback = callback
+        self._event = asyncio.Event()
+
+    def _complete(self, topic):
+        self.done = True
+        self._event.set()
+        if self._callback:
+            self._callback(topic)
+
+    def _fail(self):
+        self.failed = True
+        self._event.set()
+
+    async def wait(self):
+        await self._event.wait()
+
+
+# uasyncio flavour of umqtt.simple.MQTTClient.
+#
+# connect(), subscribe() and publish() keep the umqtt.simple signatures and
+# can be called from plain (non-async) code. Incoming packets are handled by
+# the run() coroutine, which awaits on the socket instead of polling it, so
+# a message is dispatched as soon as it arrives and a packet that is only
+# partially received never blocks the other tasks.
+#
+# publish() only queues the message and returns. While run() is active a
+# sender task writes the queue out, at most one message per
+# publish_interval_ms. Queued retained QoS 0 messages (states) are
+# coalesced per topic: only the latest value is sent, in the position of
+# the first one. QoS 1 and 2 messages are events and are all sent.
+#
+# An outbox object can be given to keep the messages published while the
+# connection is down (from the failure of run() to the next connect()) in
+# place of the queue, e.g. on flash. It needs append(topic, msg, retain,
+# qos), entries(), take() and discard(topic). No Delivery is returned for
+# those messages; once run() is active again they are taken out of the
+# outbox and queued one per OUTBOX_INTERVAL_MS, so a message already queued
+# or in flight is never sent twice if the connection drops again. A state
+# published online is newer than the one of the outbox, which is discarded.
+#
+# QoS 1 and 2 messages are pipelined: up to inflight_window of them may wait
+# for their acknowledgement at the same time. A message not acknowledged
+# within ack_timeout_ms, or still unacknowledged when run() restarts after a
+# reconnect, is sent again with the DUP flag (or, for a QoS 2 message that
+# already got its PUBREC, its PUBREL is sent again).
+#
+# With a keepalive, a PINGREQ is sent only once the link has been idle (in
+# either direction) for ping_interval_ms, a quarter of the keepalive by
+# default. If nothing at all is received within ping_timeout_ms after it,
+# the connection is considered dead and run() raises OSError(ETIMEDOUT);
+# awaiting reconnect() then opens a new connection and subscribes again,
+# after which run() can be awaited again.
+#
+# A birth message set with set_birth() is queued after every successful
+# connect(), e.g. to announce the node as online again where its will
+# announced it offline.
+#
+# With enable_stats(), the time a message spent in the queue is counted as
+# its publish latency, and the time from its first PUBLISH to the PUBACK or
+# PUBCOMP as its round-trip; downtime runs from the failure of run() to the
+# next connect().
+class MQTTClient(SimpleMQTTClient):
+    # Packets dispatched before yielding to the other tasks
+    BATCH_BUDGET = 16
+    # Queued messages kept at most; when full the oldest QoS 0 message that
+    # is not a state is dropped. Failing that, a new QoS 1 or 2 message
+    # replaces the oldest QoS 1 or 2 one, while a new QoS 0 message (or any
+    # new one if only states are queued) is dropped itself
+    QUEUE_SIZE = 32
+    # Delay between two messages queued from the outbox after a reconnect
+    OUTBOX_INTERVAL_MS = 100
+
+    def __init__(
+        self,
+        *args,
+        publish_interval_ms=20,
+        inflight_window=4,
+        ack_timeout_ms=5000,
+        ping_interval_ms=None,
+        ping_timeout_ms=2000,
+        outbox=None,
+        **kwargs
+    ):
+        super().__init__(*args, **kwargs)
+        self._stream = None
+        self.publish_interval_ms = publish_interval_ms
+        self.inflight_window = inflight_window
+        self.ack_timeout_ms = ack_timeout_ms
+        if ping_interval_ms is None:
+            ping_interval_ms = self.keepalive * 250
+        self.ping_interval_ms = ping_interval_ms
+        self.ping_timeout_ms = ping_timeout_ms
+        self.outbox = outbox
+        # True from connect() until run() fails
+        self._online = False
+        # Entries are [topic, msg, retain, qos, delivery, queued ticks]
+        self._queue = []
+        # Queued retained QoS 0 entries by topic
+        self._retained = {}
+        self._queued = asyncio.Event()
+        # Unacknowledged messages:
+        # pid -> [entry, last send ticks, PUBREC seen, first send ticks]
+        self._inflight = {}
+        self._window = asyncio.Event()
+        self._reader = None
+        self._send_error = None
+        # Subscribed topics, to subscribe again after reconnect()
+        self._subs = {}
+        self._clean_session = True
+        self._last_rx = 0
+        self._last_tx = 0
+        # Ticks of the unanswered PINGREQ, if any
+        self._ping_sent = None
+        self._birth = None
+
+    def set_birth(self, topic, msg, retain=False, qos=0):
+        assert 0 <= qos <= 2
+        assert topic
+        self._birth = (topic, msg, retain, qos)
+
+    def connect(self, clean_session=True, timeout=None):
+        self._stream = None
+        self._clean_session = clean_session
+        present = super().connect(clean_session, timeout)
+        self._connected()
+        return present
+
+    def _connected(self):
+        self._online = True
+        if self.stats:
+            self.stats.up()
+        if self._birth:
+            self.publish(*self._birth)
+
+    def disconnect(self):
+        self._stream = None
+        self.sock.settimeout(self._timeout)
+        super().disconnect()
+
+    # Replace a dropped connection, with the clean_session flag of the last
+    # connect(), and subscribe again to every topic unless the broker kept
+    # the session (and with it the subscriptions). Returns whether it did.
+    #
+    # Unlike connect() this is a coroutine, which doesn't hold up the other
+    # tasks: asyncio.open_connection() connects the socket in non-blocking
+    # mode (the TLS handshake, if any, runs as the stream is used) and the
+    # CONNECT and CONNACK go through the stream, all within timeout seconds.
+    # Only the name resolution of the server blocks, which is immediate for
+    # an IP address. The SUBACK is not awaited either: run() checks it.
+    async def reconnect(self, timeout=5):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+        self._stream = None
+        self._timeout = timeout
+        present = await asyncio.wait_for(self._open(), timeout)
+        self._connected()
+        if self._subs and not present:
+            self.subscribe_many(list(self._subs.items()))
+        return present
+
+    async def _open(self):
+        self._rpos = self._rlen = 0
+        stream, _ = await asyncio.open_connection(self.server, self.port, ssl=self.ssl or None)
+        self.sock = stream.s
+        stream.write(self._connect_packet(self._clean_session))
+        await stream.drain()
+        present = self._connack(await stream.readexactly(4))
+        self._stream = stream
+        return present
+
+    # Writes are done in blocking mode, bounded by the timeout of connect();
+    # only the reader relies on the socket being non-blocking.
+    def _write_blocking(self, f, *args):
+        self.sock.settimeout(self._timeout)
+        try:
+            r = f(*args)
+            self._last_tx = time.ticks_ms()
+            return r
+        finally:
+            if self._stream is not None:
+                self.sock.setblocking(False)
+
+    def ping(self):
+        self._write_blocking(super().ping)
+
+    def _next_pid(self):
+        pid = super()._next_pid()
+        while pid in self._inflight:
+            pid = super()._next_pid()
+        return pid
+
+    # Queue a message. For QoS 1 and 2 a Delivery is returned, and callback
+    # is called with the topic once the broker acknowledged the message.
+    def publish(self, topic, msg, retain=False, qos=0, callback=None):
+        assert 0 <= qos <= 2
+        if not self._online and self.outbox is not None:
+            self.outbox.append(topic, msg, retain, qos)
+            return None
+        if retain and not qos:
+            if self.outbox is not None:
+                self.outbox.discard(topic)
+            entry = self._retained.get(topic)
+            if entry is not None:
+                entry[1] = msg
+                return None
+        delivery = Delivery(callback) if qos else None
+        if len(self._queue) >= self.QUEUE_SIZE:
+            index = None
+            for i, queued in enumerate(self._queue):
+                if not queued[3] and self._retained.get(queued[0]) is not queued:
+                    index = i
+                    break
+            if index is None and qos:
+                for i, queued in enumerate(self._queue):
+                    if queued[3]:
+                        index = i
+                        break
+            if index is None:
+                print("MQTT: publish queue full, dropped", topic)
+                if delivery:
+                    delivery._fail()
+                return delivery
+            dropped = self._queue.pop(index)
+            if dropped[4]:
+                dropped[4]._fail()
+            print("MQTT: publish queue full, dropped", dropped[0])
+        entry = [topic, msg, retain, qos, delivery, time.ticks_ms()]
+        self._queue.append(entry)
+        if retain and not qos:
+            self._retained[topic] = entry
+        self._queued.set()
+        return entry[4]
+
+    def _unindex(self, entry):
+        if self._retained.get(entry[0]) is entry:
+            del self._retained[entry[0]]
+
+    # Stop run() with the given error, from one of its helper tasks
+    def _abort(self, e):
+        self._send_error = e
+        self._reader.cancel()
+
+    async def _send_loop(self):
+        while 1:
+            await self._queued.wait()
+            self._queued.clear()
+            while self._queue:
+                if self._queue[0][3]:
+                    while len(self._inflight) >= self.inflight_window:
+                        self._window.clear()
+                        await self._window.wait()
+                entry = self._queue.pop(0)
+                self._unindex(entry)
+                try:
+                    pid = self._write_blocking(self._send_publish, *entry[:4])
+                except OSError as e:
+                    # Keep the message for the next connection
+                    self._queue.insert(0, entry)
+                    if entry[2] and not entry[3]:
+                        self._retained[entry[0]] = entry
+                    self._abort(e)
+                    return
+                now = time.ticks_ms()
+                if pid:
+                    self._inflight[pid] = [entry, now, False, now]
+                if self.stats:
+                    self.stats.publish_ms.add(time.ticks_diff(now, entry[5]))
+                await asyncio.sleep_ms(self.publish_interval_ms)
+
+    async def _drain_outbox(self):
+        while 1:
+            # Leave room in the queue for the live messages
+            while len(self._queue) >= self.QUEUE_SIZE // 2:
+                await asyncio.sleep_ms(self.OUTBOX_INTERVAL_MS)
+            entry = self.outbox.take()
+            if entry is None:
+                return
+            # Queued from now on, a pending state is only overwritten by a
+            # newer one
+            self.publish(*entry)
+            await asyncio.sleep_ms(self.OUTBOX_INTERVAL_MS)
+
+    # Send again every message in flight for at least age ms: the PUBLISH
+    # with the DUP flag, or the PUBREL once the PUBREC was received
+    def _resend(self, age):
+        now = time.ticks_ms()
+        for pid, item in self._inflight.items():
+            if time.ticks_diff(now, item[1]) >= age:
+                if item[2]:
+                    self._send_ack(0x62, pid)
+                else:
+                    topic, msg, retain, qos = item[0][:4]
+                    self._write_blocking(self._send_publish, topic, msg, retain, qos, pid, True)
+                item[1] = now
+
+    async def _retry_loop(self):
+        while 1:
+            await asyncio.sleep_ms(self.ack_timeout_ms // 4)
+            try:
+                self._resend(self.ack_timeout_ms)
+            except OSError as e:
+                self._abort(e)
+                return
+
+    def subscribe_many(self, filters):
+        for topic, qos in filters:
+            self._subs[topic] = qos
+        if self._stream is None:
+            return super().subscribe_many(filters)
+        # The SUBACK is checked by run()
+        self._write_blocking(self._send_subscribe, filters)
+
+    async def _keepalive_loop(self):
+        while 1:
+            now = time.ticks_ms()
+            if self._ping_sent is None:
+                idle = max(
+                    time.ticks_diff(now, self._last_rx),
+                    time.ticks_diff(now, self._last_tx),
+                )
+                wait = self.ping_interval_ms - idle
+                if wait <= 0:
+                    try:
+                        self.ping()
+                    except OSError as e:
+                        self._abort(e)
+                        return
+                    self._ping_sent = now
+                    wait = self.ping_timeout_ms
+            else:
+                wait = self.ping_timeout_ms - time.ticks_diff(now, self._ping_sent)
+                if wait <= 0:
+                    self._abort(OSError(errno.ETIMEDOUT))
+                    return
+            await asyncio.sleep_ms(wait)
+
+    def _fill(self):
+        n = super()._fill()
+        if self._stream is not None:
+            self.sock.setblocking(False)
+        return n
+
+    def _send_ack(self, op, pid):
+        self._write_blocking(super()._send_ack, op, pid)
+
+    def _handle_packet(self, op, data):
+        kind = op & 0xF0
+        if kind == 0x40 or kind == 0x70:  # PUBACK, PUBCOMP
+            item = self._inflight.pop(data[0] << 8 | data[1], None)
+            if item is not None:
+                self._window.set()
+                if self.stats:
+                    self.stats.ack_ms.add(time.ticks_diff(time.ticks_ms(), item[3]))
+                item[0][4]._complete(item[0][0])
+        elif kind == 0x50:  # PUBREC, the PUBREL is sent by the base class
+            item = self._inflight.get(data[0] << 8 | data[1])
+            if item is not None:
+                item[1] = time.ticks_ms()
+                item[2] = True
+        super()._handle_packet(op, data)
+
+    # Receive and dispatch packets, and send the queued messages, until the
+    # connection fails, in which case OSError is raised. Must be started
+    # after connect() and the initial subscribe() calls, or reconnect().
+    async def run(self):
+        if self._stream is None:
+            self.sock.setblocking(False)
+            self._stream = asyncio.StreamReader(self.sock)
+        self._reader = asyncio.current_task()
+        self._send_error = None
+        self._last_rx = self._last_tx = time.ticks_ms()
+        self._ping_sent = None
+        tasks = []
+        # Anything failing from here on leaves the client offline
+        try:
+            # Whatever is still in flight was sent on a previous connection
+            self._resend(0)
+            if self._queue:
+                self._queued.set()
+            tasks.append(asyncio.create_task(self._send_loop()))
+            tasks.append(asyncio.create_task(self._retry_loop()))
+            if self.ping_interval_ms:
+                tasks.append(asyncio.create_task(self._keepalive_loop()))
+            if self.outbox is not None and self.outbox.entries():
+                tasks.append(asyncio.create_task(self._drain_outbox()))
+            await self._receive()
+        except asyncio.CancelledError:
+            if self._send_error is None:
+                raise
+            raise self._send_error
+        finally:
+            self._online = False
+            self._stream = None
+            if self.stats:
+                self.stats.down()
+            for task in tasks:
+                task.cancel()
+
+    async def _receive(self):
+        while 1:
+            n = await self._stream.readinto(self._rspace())
+            if n is None:
+                continue
+            if not n:
+                raise OSError(-1)
+            # Any packet proves the link alive, not only the PINGRESP
+            self._last_rx = time.ticks_ms()
+            self._ping_sent = None
+            self._rlen += n
+            # Dispatch everything received so far, letting other tasks run
+            # between batches when the broker sends a burst (e.g. the
+            # retained messages replayed on connect)
+            while self.check_msgs(self.BATCH_BUDGET) == self.BATCH_BUDGET:
+                await asyncio.sleep(0)
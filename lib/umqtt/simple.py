@@ -1,5 +1,6 @@
 import socket
 import struct
+import time
 from binascii import hexlify
 
 
@@ -8,6 +9,14 @@ class MQTTException(Exception):
 
 
 class MQTTClient:
+    # Size of the receive buffer, which bounds the largest incoming packet
+    RBUF_SIZE = 1024
+    # Size of the buffer outgoing PUBLISH packets are assembled in
+    WBUF_SIZE = 256
+    # Received QoS 2 messages remembered until their PUBREL; the oldest is
+    # forgotten when more are pending
+    QOS2_RX_SIZE = 16
+
     def __init__(
         self,
         client_id,
@@ -23,12 +32,18 @@ class MQTTClient:
             port = 8883 if ssl else 1883
         self.client_id = client_id
         self.sock = None
+        # Socket timeout given to connect(), restored after non-blocking reads
+        self._timeout = None
         self.server = server
         self.port = port
         self.ssl = ssl
         self.ssl_params = ssl_params
+        # TLS session of the last connection, resumed by the next one.
+        # Always None on MicroPython, whose ssl sockets have no session.
+        self.ssl_session = None
         self.pid = 0
         self.cb = None
+        self.cb_copy = True
         self.user = user
         self.pswd = password
         self.keepalive = keepalive
@@ -36,23 +51,41 @@ class MQTTClient:
         self.lw_msg = None
         self.lw_qos = 0
         self.lw_retain = False
+        self._rbuf = bytearray(self.RBUF_SIZE)
+        self._rmv = memoryview(self._rbuf)
+        self._wbuf = bytearray(self.WBUF_SIZE)
+        self._rpos = 0
+        self._rlen = 0
+        self._op = None
+        self._acked_pid = 0
+        # Return codes of the last SUBACK
+        self._granted = b""
+        # Packet ids of received QoS 2 messages awaiting PUBREL, oldest first
+        self._qos2_rx = []
+        # umqtt.stats.Stats, once enable_stats() was called
+        self.stats = None
 
     def _send_str(self, s):
         self.sock.write(struct.pack("!H", len(s)))
         self.sock.write(s)
 
-    def _recv_len(self):
-        n = 0
-        sh = 0
-        while 1:
-            b = self.sock.read(1)[0]
-            n |= (b & 0x7F) << sh
-            if not b & 0x80:
-                return n
-            sh += 7
-
-    def set_callback(self, f):
+    # The callback is called with the topic and message of every received
+    # PUBLISH, as bytes. With copy=False they are passed as memoryviews into
+    # the receive buffer instead, so a message is delivered without copying
+    # its payload; they are only valid until the callback returns, a
+    # callback keeping or parsing them must copy them with bytes().
+    def set_callback(self, f, copy=True):
         self.cb = f
+        self.cb_copy = copy
+
+    # Count packets, bytes and timings in a umqtt.stats.Stats object, read
+    # with client.stats.snapshot(). Off by default: when on, every packet
+    # costs a dict lookup and a copy of its topic class.
+    def enable_stats(self, levels=2):
+        from umqtt.stats import Stats
+
+        self.stats = Stats(levels)
+        return self.stats
 
     def set_last_will(self, topic, msg, retain=False, qos=0):
         assert 0 <= qos <= 2
@@ -63,7 +96,9 @@ class MQTTClient:
         self.lw_retain = retain
 
     def connect(self, clean_session=True, timeout=None):
+        self._rpos = self._rlen = 0
         self.sock = socket.socket()
+        self._timeout = timeout
         self.sock.settimeout(timeout)
         addr = socket.getaddrinfo(self.server, self.port)[0][-1]
         self.sock.connect(addr)
@@ -73,148 +108,379 @@ class MQTTClient:
 
             self.sock = ssl.wrap_socket(self.sock, **self.ssl_params)
         elif self.ssl:
-            self.sock = self.ssl.wrap_socket(self.sock, server_hostname=self.server)
-        premsg = bytearray(b"\x10\0\0\0\0\0")
-        msg = bytearray(b"\x04MQTT\x04\x02\0\0")
+            self.sock = self._wrap_socket(self.sock)
+        self.sock.write(self._connect_packet(clean_session))
+        return self._connack(self.sock.read(4))
+
+    # Build the CONNECT packet, to be sent in a single write
+    def _connect_packet(self, clean_session):
+        msg = bytearray(b"\0\x04MQTT\x04\x02\0\0")
+        strings = [self.client_id]
 
         sz = 10 + 2 + len(self.client_id)
-        msg[6] = clean_session << 1
+        msg[7] = clean_session << 1
         if self.user:
             sz += 2 + len(self.user) + 2 + len(self.pswd)
-            msg[6] |= 0xC0
+            msg[7] |= 0xC0
         if self.keepalive:
             assert self.keepalive < 65536
-            msg[7] |= self.keepalive >> 8
-            msg[8] |= self.keepalive & 0x00FF
+            msg[8] |= self.keepalive >> 8
+            msg[9] |= self.keepalive & 0x00FF
         if self.lw_topic:
             sz += 2 + len(self.lw_topic) + 2 + len(self.lw_msg)
-            msg[6] |= 0x4 | (self.lw_qos & 0x1) << 3 | (self.lw_qos & 0x2) << 3
-            msg[6] |= self.lw_retain << 5
+            msg[7] |= 0x4 | (self.lw_qos & 0x1) << 3 | (self.lw_qos & 0x2) << 3
+            msg[7] |= self.lw_retain << 5
+            strings += (self.lw_topic, self.lw_msg)
+        if self.user:
+            strings += (self.user, self.pswd)
 
-        i = 1
+        pkt = bytearray(b"\x10")
         while sz > 0x7F:
-            premsg[i] = (sz & 0x7F) | 0x80
+            pkt.append((sz & 0x7F) | 0x80)
             sz >>= 7
-            i += 1
-        premsg[i] = sz
+        pkt.append(sz)
+        pkt += msg
+        for s in strings:
+            if isinstance(s, str):
+                s = s.encode()
+            pkt += struct.pack("!H", len(s))
+            pkt += s
+        # print(hex(len(pkt)), hexlify(pkt, ":"))
+        if self.stats:
+            self.stats.sent(None, len(pkt))
+        return pkt
 
-        self.sock.write(premsg, i + 2)
-        self.sock.write(msg)
-        # print(hex(len(msg)), hexlify(msg, ":"))
-        self._send_str(self.client_id)
-        if self.lw_topic:
-            self._send_str(self.lw_topic)
-            self._send_str(self.lw_msg)
-        if self.user:
-            self._send_str(self.user)
-            self._send_str(self.pswd)
-        resp = self.sock.read(4)
+    # Check the CONNACK answering the CONNECT. Returns the session present
+    # flag.
+    def _connack(self, resp):
         assert resp[0] == 0x20 and resp[1] == 0x02
         if resp[3] != 0:
             raise MQTTException(resp[3])
+        if self.ssl and self.ssl is not True:
+            # With TLS 1.3 the session ticket arrives after the handshake,
+            # so it is only there once the CONNACK was read
+            self.ssl_session = getattr(self.sock, "session", None)
+        if self.stats:
+            self.stats.received(None, 4)
         return resp[2] & 1
 
+    # Wrap the socket with the SSL context given as ssl. The session of the
+    # previous connection is offered where the ssl module supports it (the
+    # CPython one): the broker can then resume it with an abbreviated
+    # handshake, without the certificate exchange and key agreement. A
+    # broker that refuses falls back to a full one. MicroPython's ssl has no
+    # sessions (no .session, no session= argument), so there every
+    # connection is a full handshake and only the context is reused.
+    def _wrap_socket(self, sock):
+        if self.ssl_session is not None:
+            try:
+                return self.ssl.wrap_socket(sock, server_hostname=self.server, session=self.ssl_session)
+            except TypeError:
+                # No session resumption in this ssl module
+                self.ssl_session = None
+        return self.ssl.wrap_socket(sock, server_hostname=self.server)
+
     def disconnect(self):
         self.sock.write(b"\xe0\0")
         self.sock.close()
+        if self.stats:
+            self.stats.sent(None, 2)
 
     def ping(self):
         self.sock.write(b"\xc0\0")
+        if self.stats:
+            self.stats.sent(None, 2)
+
+    # Packet ids run from 1 to 65535 and then wrap around
+    def _next_pid(self):
+        self.pid = self.pid % 65535 + 1
+        return self.pid
 
     def publish(self, topic, msg, retain=False, qos=0):
-        pkt = bytearray(b"\x30\0\0\0")
-        pkt[0] |= qos << 1 | retain
-        sz = 2 + len(topic) + len(msg)
+        if qos and self.stats:
+            t = time.ticks_ms()
+        pid = self._send_publish(topic, msg, retain, qos)
+        # Wait for the PUBACK (QoS 1) or PUBCOMP (QoS 2); the PUBREL in
+        # between is sent by _handle_packet()
+        while qos and self._acked_pid != pid:
+            self.wait_msg()
+        if qos and self.stats:
+            self.stats.ack_ms.add(time.ticks_diff(time.ticks_ms(), t))
+
+    # Write a PUBLISH packet without waiting for any acknowledgement.
+    # Returns the packet id used (0 for QoS 0). A retransmission passes the
+    # packet id of the original message and sets dup.
+    #
+    # The packet is assembled in a preallocated buffer and sent with a
+    # single write; only packets larger than the buffer are written in
+    # pieces.
+    def _send_publish(self, topic, msg, retain, qos, pid=0, dup=False):
+        if isinstance(topic, str):
+            topic = topic.encode()
+        if isinstance(msg, str):
+            msg = msg.encode()
+        topic_len = len(topic)
+        sz = 2 + topic_len + len(msg)
         if qos > 0:
             sz += 2
         assert sz < 2097152
-        i = 1
-        while sz > 0x7F:
-            pkt[i] = (sz & 0x7F) | 0x80
-            sz >>= 7
+        buf = self._wbuf
+        buf[0] = 0x30 | dup << 3 | qos << 1 | retain
+        if sz < 0x80:
+            # Fast path: state topics and payloads fit a one byte length
+            buf[1] = sz
+            i = 2
+        else:
+            n = sz
+            i = 1
+            while n > 0x7F:
+                buf[i] = (n & 0x7F) | 0x80
+                n >>= 7
+                i += 1
+            buf[i] = n
             i += 1
-        pkt[i] = sz
-        # print(hex(len(pkt)), hexlify(pkt, ":"))
-        self.sock.write(pkt, i + 1)
-        self._send_str(topic)
+        if qos > 0 and not pid:
+            pid = self._next_pid()
+        if self.stats:
+            self.stats.sent(topic, i + sz)
+        struct.pack_into("!H", buf, i, topic_len)
+        i += 2
+        if i + sz - 2 > len(buf):
+            self.sock.write(buf, i)
+            self.sock.write(topic)
+            if qos > 0:
+                struct.pack_into("!H", buf, 0, pid)
+                self.sock.write(buf, 2)
+            self.sock.write(msg)
+            return pid
+        buf[i : i + topic_len] = topic
+        i += topic_len
         if qos > 0:
-            self.pid += 1
-            pid = self.pid
-            struct.pack_into("!H", pkt, 0, pid)
-            self.sock.write(pkt, 2)
-        self.sock.write(msg)
-        if qos == 1:
-            while 1:
-                op = self.wait_msg()
-                if op == 0x40:
-                    sz = self.sock.read(1)
-                    assert sz == b"\x02"
-                    rcv_pid = self.sock.read(2)
-                    rcv_pid = rcv_pid[0] << 8 | rcv_pid[1]
-                    if pid == rcv_pid:
-                        return
-        elif qos == 2:
-            assert 0
+            struct.pack_into("!H", buf, i, pid)
+            i += 2
+        buf[i : i + len(msg)] = msg
+        self.sock.write(buf, i + len(msg))
+        return pid
 
     def subscribe(self, topic, qos=0):
+        self.subscribe_many(((topic, qos),))
+
+    # Subscribe to several (topic, qos) filters with a single SUBSCRIBE
+    # packet, i.e. a single round-trip. Returns the QoS granted for each.
+    def subscribe_many(self, filters):
+        pid = self._send_subscribe(filters)
+        # A rejected subscription raises from wait_msg()
+        while self._acked_pid != pid:
+            self.wait_msg()
+        if len(self._granted) != len(filters):
+            raise MQTTException("SUBACK does not match SUBSCRIBE")
+        return self._granted
+
+    # Write a SUBSCRIBE packet for a sequence of (topic, qos) filters
+    # without waiting for the SUBACK. Returns the packet id used.
+    def _send_subscribe(self, filters):
         assert self.cb is not None, "Subscribe callback is not set"
-        pkt = bytearray(b"\x82\0\0\0")
-        self.pid += 1
-        struct.pack_into("!BH", pkt, 1, 2 + 2 + len(topic) + 1, self.pid)
-        # print(hex(len(pkt)), hexlify(pkt, ":"))
+        sz = 2
+        for topic, qos in filters:
+            assert 0 <= qos <= 2
+            sz += 2 + len(topic) + 1
+        assert sz < 2097152
+        pkt = bytearray(sz + 4)
+        pkt[0] = 0x82
+        i = 1
+        n = sz
+        while n > 0x7F:
+            pkt[i] = (n & 0x7F) | 0x80
+            n >>= 7
+            i += 1
+        pkt[i] = n
+        i += 1
+        pid = self._next_pid()
+        struct.pack_into("!H", pkt, i, pid)
+        i += 2
+        for topic, qos in filters:
+            if isinstance(topic, str):
+                topic = topic.encode()
+            struct.pack_into("!H", pkt, i, len(topic))
+            i += 2
+            pkt[i : i + len(topic)] = topic
+            i += len(topic)
+            pkt[i] = qos
+            i += 1
+        self.sock.write(pkt, i)
+        if self.stats:
+            self.stats.sent(None, i)
+        return pid
+
+    # Move the unprocessed tail of the receive buffer to its start and
+    # return a memoryview of the free space after it. Packets are always
+    # contiguous in the buffer (it is not a ring), so the callback can get
+    # slices of it; only the partial packet at the end is ever moved.
+    def _rspace(self):
+        if self._rpos:
+            n = self._rlen - self._rpos
+            if n:
+                self._rmv[:n] = self._rmv[self._rpos : self._rlen]
+            self._rpos = 0
+            self._rlen = n
+        if self._rlen == len(self._rbuf):
+            raise MQTTException("Packet too large")
+        return self._rmv[self._rlen :]
+
+    # Read whatever the socket already has into the receive buffer,
+    # without blocking. Returns the number of bytes read. The timeout of
+    # connect() applies again afterwards, so a later blocking read (e.g.
+    # for a SUBACK) cannot wait forever on a silent broker.
+    def _fill(self):
+        self.sock.setblocking(False)
+        try:
+            n = self.sock.readinto(self._rspace())
+        finally:
+            self.sock.settimeout(self._timeout)
+        if n is None:
+            return 0
+        if not n:
+            raise OSError(-1)
+        self._rlen += n
+        return n
+
+    # Dispatch up to budget complete packets from the receive buffer.
+    # Returns the number of packets processed.
+    def _process(self, budget):
+        buf = self._rbuf
+        count = 0
+        while count < budget:
+            pos = self._rpos
+            end = self._rlen
+            # Remaining length, right after the packet type byte
+            i = pos + 1
+            sz = 0
+            sh = 0
+            while 1:
+                if i >= end:
+                    return count
+                b = buf[i]
+                i += 1
+                sz |= (b & 0x7F) << sh
+                if not b & 0x80:
+                    break
+                sh += 7
+            if i + sz > end:
+                return count
+            # Consume the packet first, so the callback may receive again
+            self._rpos = i + sz
+            self._op = buf[pos]
+            if self.stats:
+                topic = None
+                if self._op & 0xF0 == 0x30:
+                    topic = self._rmv[i + 2 : i + 2 + (buf[i] << 8 | buf[i + 1])]
+                self.stats.received(topic, i + sz - pos)
+            if self._op & 0xF0 == 0x30:
+                # Sliced straight from the buffer, without a view of the
+                # whole packet
+                self._handle_publish(self._op, i, i + sz)
+            else:
+                self._handle_packet(self._op, self._rmv[i : i + sz])
+            count += 1
+        return count
+
+    # Deliver the PUBLISH packet whose variable header starts at start in
+    # the receive buffer and which ends at end
+    def _handle_publish(self, op, start, end):
+        buf = self._rbuf
+        pos = start + 2 + (buf[start] << 8 | buf[start + 1])
+        if self.cb_copy:
+            topic = bytes(buf[start + 2 : pos])
+        else:
+            topic = self._rmv[start + 2 : pos]
+        if op & 6:
+            pid = buf[pos] << 8 | buf[pos + 1]
+            pos += 2
+        if self.cb_copy:
+            msg = bytes(buf[pos:end])
+        else:
+            msg = self._rmv[pos:end]
+        if op & 6 == 4:
+            # QoS 2: deliver once, a retransmission before the PUBREL
+            # is only acknowledged again
+            if pid not in self._qos2_rx:
+                if len(self._qos2_rx) >= self.QOS2_RX_SIZE:
+                    self._qos2_rx.pop(0)
+                self._qos2_rx.append(pid)
+                self._deliver(topic, msg)
+            self._send_ack(0x50, pid)  # PUBREC
+            return
+        self._deliver(topic, msg)
+        if op & 6 == 2:
+            self._send_ack(0x40, pid)  # PUBACK
+
+    def _handle_packet(self, op, data):
+        kind = op & 0xF0
+        if len(data) < 2:  # PINGRESP
+            return
+        pid = data[0] << 8 | data[1]
+        if kind == 0x40 or kind == 0x70:  # PUBACK, PUBCOMP
+            self._acked_pid = pid
+        elif kind == 0x50:  # PUBREC
+            self._send_ack(0x62, pid)  # PUBREL
+        elif kind == 0x60:  # PUBREL
+            if pid in self._qos2_rx:
+                self._qos2_rx.remove(pid)
+            self._send_ack(0x70, pid)  # PUBCOMP
+        elif kind == 0x90:  # SUBACK, one return code per filter
+            self._acked_pid = pid
+            self._granted = bytes(data[2:])
+            if 0x80 in self._granted:
+                raise MQTTException(0x80)
+
+    def _deliver(self, topic, msg):
+        if not self.stats:
+            self.cb(topic, msg)
+            return
+        t = time.ticks_us()
+        try:
+            self.cb(topic, msg)
+        finally:
+            self.stats.callback_us.add(time.ticks_diff(time.ticks_us(), t))
+
+    # Write a two byte acknowledgement packet (PUBACK, PUBREC, ...)
+    def _send_ack(self, op, pid):
+        pkt = bytearray(b"\0\x02\0\0")
+        pkt[0] = op
+        struct.pack_into("!H", pkt, 2, pid)
         self.sock.write(pkt)
-        self._send_str(topic)
-        self.sock.write(qos.to_bytes(1, "little"))
-        while 1:
-            op = self.wait_msg()
-            if op == 0x90:
-                resp = self.sock.read(4)
-                # print(resp)
-                assert resp[1] == pkt[2] and resp[2] == pkt[3]
-                if resp[3] == 0x80:
-                    raise MQTTException(resp[3])
-                return
+        if self.stats:
+            self.stats.sent(None, 4)
 
     # Wait for a single incoming MQTT message and process it.
     # Subscribed messages are delivered to a callback previously
     # set by .set_callback() method. Other (internal) MQTT
     # messages processed internally.
     def wait_msg(self):
-        res = self.sock.read(1)
-        self.sock.setblocking(True)
-        if res is None:
-            return None
-        if res == b"":
-            raise OSError(-1)
-        if res == b"\xd0":  # PINGRESP
-            sz = self.sock.read(1)[0]
-            assert sz == 0
-            return None
-        op = res[0]
-        if op & 0xF0 != 0x30:
-            return op
-        sz = self._recv_len()
-        topic_len = self.sock.read(2)
-        topic_len = (topic_len[0] << 8) | topic_len[1]
-        topic = self.sock.read(topic_len)
-        sz -= topic_len + 2
-        if op & 6:
-            pid = self.sock.read(2)
-            pid = pid[0] << 8 | pid[1]
-            sz -= 2
-        msg = self.sock.read(sz)
-        self.cb(topic, msg)
-        if op & 6 == 2:
-            pkt = bytearray(b"\x40\x02\0\0")
-            struct.pack_into("!H", pkt, 2, pid)
-            self.sock.write(pkt)
-        elif op & 6 == 4:
-            assert 0
-        return op
+        while not self._process(1):
+            if not self._fill():
+                # Nothing buffered: block (honouring the socket timeout)
+                # until the next byte arrives
+                res = self.sock.read(1)
+                if not res:
+                    raise OSError(-1)
+                self._rspace()[0] = res[0]
+                self._rlen += 1
+        return self._op
 
     # Checks whether a pending message from server is available.
     # If not, returns immediately with None. Otherwise, does
     # the same processing as wait_msg.
     def check_msg(self):
-        self.sock.setblocking(False)
-        return self.wait_msg()
+        if self._process(1) or (self._fill() and self._process(1)):
+            return self._op
+        return None
+
+    # Read everything the socket already has and dispatch up to budget
+    # packets in one pass, without blocking. Returns the number of packets
+    # processed, which equals budget when more may be pending.
+    def check_msgs(self, budget=16):
+        count = self._process(budget)
+        while count < budget and self._fill():
+            count += self._process(budget - count)
+        return count
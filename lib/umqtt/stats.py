@@ -0,0 +1,137 @@
+import time
+
+
+# Histogram of non-negative integers with power of two buckets: bucket 0
+# counts the zeros, bucket i the values from 2**(i-1) to 2**i - 1, and the
+# last bucket everything above. Adding a value doesn't allocate.
+class Histogram:
+    BUCKETS = 16
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.buckets = [0] * self.BUCKETS
+
+    def add(self, v):
+        self.count += 1
+        self.total += v
+        if v > self.max:
+            self.max = v
+        i = 0
+        while v and i < self.BUCKETS - 1:
+            v >>= 1
+            i += 1
+        self.buckets[i] += 1
+
+    # Upper bound of the bucket holding the p-th percentile, capped by the
+    # largest value seen
+    def percentile(self, p):
+        rank = (self.count * p + 99) // 100
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= rank:
+                return min((1 << i) - 1, self.max)
+        return self.max
+
+    def summary(self):
+        if not self.count:
+            return {"n": 0}
+        return {
+            "n": self.count,
+            "avg": self.total // self.count,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "max": self.max,
+        }
+
+
+# Traffic and timing statistics of a client, kept once enable_stats() was
+# called on it.
+#
+# Packets and bytes are counted in both directions per topic class: the
+# first `levels` levels of the topic of a PUBLISH (b"home/led" for
+# b"home/led/cucina/state"), or "control" for every other packet. The
+# histograms are in ms, except callback_us:
+# - publish_ms: from publish() until the PUBLISH is written, i.e. the time
+#   spent in the queue (umqtt.aio) or reconnecting (mqtt_retry)
+# - ack_ms: from the PUBLISH until its PUBACK (QoS 1) or PUBCOMP (QoS 2)
+# - downtime_ms: from the loss of the connection until the next connect()
+# - callback_us: time spent in the message callback
+class Stats:
+    CONTROL = "control"
+
+    def __init__(self, levels=2):
+        self.levels = levels
+        self._down_since = None
+        self.reset()
+
+    def reset(self):
+        # Topic class -> [packets in, bytes in, packets out, bytes out]
+        self.traffic = {}
+        self.reconnects = 0
+        self.publish_ms = Histogram()
+        self.ack_ms = Histogram()
+        self.downtime_ms = Histogram()
+        self.callback_us = Histogram()
+        self._since = time.ticks_ms()
+
+    def topic_class(self, topic):
+        topic = bytes(topic)
+        i = -1
+        for _ in range(self.levels):
+            i = topic.find(b"/", i + 1)
+            if i < 0:
+                return topic
+        return topic[:i]
+
+    def _counters(self, topic):
+        key = self.CONTROL if topic is None else self.topic_class(topic)
+        c = self.traffic.get(key)
+        if c is None:
+            c = self.traffic[key] = [0, 0, 0, 0]
+        return c
+
+    def received(self, topic, size):
+        c = self._counters(topic)
+        c[0] += 1
+        c[1] += size
+
+    def sent(self, topic, size):
+        c = self._counters(topic)
+        c[2] += 1
+        c[3] += size
+
+    # The connection was lost; repeated calls keep the first time
+    def down(self):
+        if self._down_since is None:
+            self._down_since = time.ticks_ms()
+
+    # A connection was made, counted as a reconnection after down()
+    def up(self):
+        if self._down_since is not None:
+            self.reconnects += 1
+            self.downtime_ms.add(time.ticks_diff(time.ticks_ms(), self._down_since))
+            self._down_since = None
+
+    # Plain dict of everything, ready for json.dumps()
+    def snapshot(self):
+        traffic = {}
+        for key, c in self.traffic.items():
+            if isinstance(key, bytes):
+                key = key.decode()
+            traffic[key] = {"in": c[0], "in_bytes": c[1], "out": c[2], "out_bytes": c[3]}
+        return {
+            "uptime_ms": time.ticks_diff(time.ticks_ms(), self._since),
+            "connected": self._down_since is None,
+            "reconnects": self.reconnects,
+            "traffic": traffic,
+            "publish_ms": self.publish_ms.summary(),
+            "ack_ms": self.ack_ms.summary(),
+            "downtime_ms": self.downtime_ms.summary(),
+            "callback_us": self.callback_us.summary(),
+        }